@@ -1,31 +1,262 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
+import httpx
 from typing import List, Optional
+from contextlib import aclosing, asynccontextmanager, contextmanager
 import sqlite3
+import json
+import csv
+import io
+import zlib
+import threading
+import asyncio
+import heapq
+import time
+import logging
+import queue
 import os
-from datetime import datetime
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from metricas import registro, span, instrumentar
+from cache_http import RespuestaJSON, coincide, comprimir, etag_de, respuesta_condicional
 
-app = FastAPI(title="ArbitrajePro API")
-app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+logger = logging.getLogger(__name__)
 
 DB_PATH = os.environ.get("DB_PATH", "arbitraje.db")
 ADMIN_PASSWORD = os.environ.get("ADMIN_PASSWORD", "Mau10")
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+# ============ ALMACENAMIENTO (POOL SQLITE + WAL) ============
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 8))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", 5000))
+DB_CACHE_SIZE_KB = int(os.environ.get("DB_CACHE_SIZE_KB", 16384))
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", 64 * 1024 * 1024))
 
-def init_db():
-    with get_db() as conn:
-        conn.execute("""CREATE TABLE IF NOT EXISTS operaciones (
+DB_CONSULTAS = registro.histograma("db_consulta_segundos", "Duración de cada bloque de acceso a SQLite", ("consulta",))
+ESPERA_POOL = registro.histograma("db_pool_espera_segundos", "Espera para obtener una conexión del pool")
+
+class PoolSQLite:
+    """Pool acotado de conexiones SQLite reutilizables (WAL + pragmas afinados)"""
+
+    def __init__(self, path: str, size: int = DB_POOL_SIZE, timeout: float = DB_POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._libres = queue.LifoQueue()
+        self._creadas = 0
+        self._lock = threading.Lock()
+        self._cerrado = False
+
+    def _conectar(self):
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute(f"PRAGMA cache_size={-DB_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def adquirir(self):
+        try:
+            return self._libres.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._creadas < self.size:
+                self._creadas += 1
+                crear = True
+            else:
+                crear = False
+        if crear:
+            try:
+                return self._conectar()
+            except Exception:
+                with self._lock: self._creadas -= 1
+                raise
+        try:
+            return self._libres.get(timeout=self.timeout)
+        except queue.Empty:
+            raise HTTPException(status_code=503, detail="Base de datos ocupada, reintenta")
+
+    def liberar(self, conn):
+        if conn.in_transaction: conn.rollback()
+        if self._cerrado:
+            conn.close()
+            with self._lock: self._creadas -= 1
+        else:
+            self._libres.put(conn)
+
+    @contextmanager
+    def conexion(self, consulta: str = "otra"):
+        """Presta una conexión: commit al salir, rollback si hay error"""
+        inicio = time.perf_counter()
+        conn = self.adquirir()
+        ESPERA_POOL.observar(time.perf_counter() - inicio)
+        try:
+            yield conn
+            if conn.in_transaction: conn.commit()
+        except BaseException:
+            if conn.in_transaction: conn.rollback()
+            raise
+        finally:
+            self.liberar(conn)
+            DB_CONSULTAS.observar(time.perf_counter() - inicio, consulta=consulta)
+
+    def abrir(self):
+        self._cerrado = False
+
+    def cerrar(self):
+        """Cierra las conexiones ociosas; las prestadas se cierran al devolverse"""
+        self._cerrado = True
+        while True:
+            try:
+                conn = self._libres.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                conn.execute("PRAGMA optimize")
+            finally:
+                conn.close()
+                with self._lock: self._creadas -= 1
+
+pool = PoolSQLite(DB_PATH)
+
+def get_db(consulta: str = "otra"):
+    """Conexión prestada del pool; el bloque `with` se mide en db_consulta_segundos{consulta=...}"""
+    return pool.conexion(consulta)
+
+# ============ ESQUEMA (MIGRACIONES VERSIONADAS) ============
+# Descuenta OLD de su grupo del resumen y borra ese grupo (y solo ese) si quedó vacío
+GRUPO_OLD = """inv = COALESCE(OLD.inv, '') AND etapa = COALESCE(OLD.etapa, 0)
+              AND tipo = COALESCE(OLD.tipo, '') AND dia = substr(COALESCE(OLD.fecha, ''), 1, 10)"""
+SQL_RESUMEN_RESTAR = f"""UPDATE operaciones_resumen SET n = n - 1,
+                miBs = miBs - COALESCE(OLD.miBs, 0), miUsd = miUsd - COALESCE(OLD.miUsd, 0),
+                resultBs = resultBs - COALESCE(OLD.resultBs, 0), resultUsd = resultUsd - COALESCE(OLD.resultUsd, 0)
+            WHERE {GRUPO_OLD};
+            DELETE FROM operaciones_resumen WHERE {GRUPO_OLD} AND n <= 0;"""
+# Cada entrada (versión, sentencias) se aplica una sola vez; PRAGMA user_version guarda la última aplicada.
+MIGRACIONES = [
+    (1, ["""CREATE TABLE IF NOT EXISTS operaciones (
             id INTEGER PRIMARY KEY AUTOINCREMENT, fecha TEXT, etapa INTEGER, inv TEXT,
-            miBs REAL, miUsd REAL, resultBs REAL, resultUsd REAL, tipo TEXT)""")
-        conn.execute("""CREATE TABLE IF NOT EXISTS sesiones (
-            usuario TEXT PRIMARY KEY, inicio TEXT, ultima_accion TEXT, dispositivo TEXT)""")
-        conn.commit()
-init_db()
+            miBs REAL, miUsd REAL, resultBs REAL, resultUsd REAL, tipo TEXT)""",
+         """CREATE TABLE IF NOT EXISTS sesiones (
+            usuario TEXT PRIMARY KEY, inicio TEXT, ultima_accion TEXT, dispositivo TEXT)"""]),
+    (2, ["CREATE INDEX IF NOT EXISTS idx_operaciones_inv_id ON operaciones (inv, id DESC)",
+         "CREATE INDEX IF NOT EXISTS idx_operaciones_inv_fecha ON operaciones (inv, fecha, id)",
+         "CREATE INDEX IF NOT EXISTS idx_operaciones_fecha ON operaciones (fecha, id)",
+         "CREATE INDEX IF NOT EXISTS idx_operaciones_etapa_id ON operaciones (etapa, id DESC)"]),
+    # Resumen por (inv, etapa, tipo, día) mantenido por triggers en cada INSERT/UPDATE/DELETE
+    (3, ["""CREATE TABLE IF NOT EXISTS operaciones_resumen (
+            inv TEXT NOT NULL, etapa INTEGER NOT NULL, tipo TEXT NOT NULL, dia TEXT NOT NULL,
+            n INTEGER NOT NULL DEFAULT 0, miBs REAL NOT NULL DEFAULT 0, miUsd REAL NOT NULL DEFAULT 0,
+            resultBs REAL NOT NULL DEFAULT 0, resultUsd REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (inv, etapa, tipo, dia)) WITHOUT ROWID""",
+         """CREATE TRIGGER IF NOT EXISTS trg_operaciones_resumen_ins AFTER INSERT ON operaciones BEGIN
+            INSERT INTO operaciones_resumen (inv, etapa, tipo, dia, n, miBs, miUsd, resultBs, resultUsd)
+            VALUES (COALESCE(NEW.inv, ''), COALESCE(NEW.etapa, 0), COALESCE(NEW.tipo, ''), substr(COALESCE(NEW.fecha, ''), 1, 10),
+                    1, COALESCE(NEW.miBs, 0), COALESCE(NEW.miUsd, 0), COALESCE(NEW.resultBs, 0), COALESCE(NEW.resultUsd, 0))
+            ON CONFLICT (inv, etapa, tipo, dia) DO UPDATE SET n = n + 1,
+                miBs = miBs + excluded.miBs, miUsd = miUsd + excluded.miUsd,
+                resultBs = resultBs + excluded.resultBs, resultUsd = resultUsd + excluded.resultUsd;
+            END""",
+         """CREATE TRIGGER IF NOT EXISTS trg_operaciones_resumen_del AFTER DELETE ON operaciones BEGIN
+            UPDATE operaciones_resumen SET n = n - 1,
+                miBs = miBs - COALESCE(OLD.miBs, 0), miUsd = miUsd - COALESCE(OLD.miUsd, 0),
+                resultBs = resultBs - COALESCE(OLD.resultBs, 0), resultUsd = resultUsd - COALESCE(OLD.resultUsd, 0)
+            WHERE inv = COALESCE(OLD.inv, '') AND etapa = COALESCE(OLD.etapa, 0)
+              AND tipo = COALESCE(OLD.tipo, '') AND dia = substr(COALESCE(OLD.fecha, ''), 1, 10);
+            DELETE FROM operaciones_resumen WHERE n <= 0;
+            END""",
+         """CREATE TRIGGER IF NOT EXISTS trg_operaciones_resumen_upd AFTER UPDATE ON operaciones BEGIN
+            UPDATE operaciones_resumen SET n = n - 1,
+                miBs = miBs - COALESCE(OLD.miBs, 0), miUsd = miUsd - COALESCE(OLD.miUsd, 0),
+                resultBs = resultBs - COALESCE(OLD.resultBs, 0), resultUsd = resultUsd - COALESCE(OLD.resultUsd, 0)
+            WHERE inv = COALESCE(OLD.inv, '') AND etapa = COALESCE(OLD.etapa, 0)
+              AND tipo = COALESCE(OLD.tipo, '') AND dia = substr(COALESCE(OLD.fecha, ''), 1, 10);
+            DELETE FROM operaciones_resumen WHERE n <= 0;
+            INSERT INTO operaciones_resumen (inv, etapa, tipo, dia, n, miBs, miUsd, resultBs, resultUsd)
+            VALUES (COALESCE(NEW.inv, ''), COALESCE(NEW.etapa, 0), COALESCE(NEW.tipo, ''), substr(COALESCE(NEW.fecha, ''), 1, 10),
+                    1, COALESCE(NEW.miBs, 0), COALESCE(NEW.miUsd, 0), COALESCE(NEW.resultBs, 0), COALESCE(NEW.resultUsd, 0))
+            ON CONFLICT (inv, etapa, tipo, dia) DO UPDATE SET n = n + 1,
+                miBs = miBs + excluded.miBs, miUsd = miUsd + excluded.miUsd,
+                resultBs = resultBs + excluded.resultBs, resultUsd = resultUsd + excluded.resultUsd;
+            END""",
+         """INSERT OR REPLACE INTO operaciones_resumen (inv, etapa, tipo, dia, n, miBs, miUsd, resultBs, resultUsd)
+            SELECT COALESCE(inv, ''), COALESCE(etapa, 0), COALESCE(tipo, ''), substr(COALESCE(fecha, ''), 1, 10), COUNT(*),
+                   TOTAL(miBs), TOTAL(miUsd), TOTAL(resultBs), TOTAL(resultUsd)
+            FROM operaciones GROUP BY 1, 2, 3, 4"""]),
+    # Contador de cambios por tabla: validador barato para ETags (sirve entre workers y procesos)
+    (4, ["""CREATE TABLE IF NOT EXISTS contadores (tabla TEXT PRIMARY KEY, version INTEGER NOT NULL) WITHOUT ROWID""",
+         "INSERT OR IGNORE INTO contadores (tabla, version) VALUES ('operaciones', 0)",
+         *(f"""CREATE TRIGGER IF NOT EXISTS trg_operaciones_contador_{evento.lower()} AFTER {evento} ON operaciones BEGIN
+            UPDATE contadores SET version = version + 1 WHERE tabla = 'operaciones';
+            END""" for evento in ("INSERT", "UPDATE", "DELETE"))]),
+    # v3 borraba los grupos vacíos recorriendo todo el resumen en cada fila; ahora solo el grupo de OLD (por su PK)
+    (5, ["DROP TRIGGER IF EXISTS trg_operaciones_resumen_del",
+         "DROP TRIGGER IF EXISTS trg_operaciones_resumen_upd",
+         f"""CREATE TRIGGER trg_operaciones_resumen_del AFTER DELETE ON operaciones BEGIN
+            {SQL_RESUMEN_RESTAR}
+            END""",
+         f"""CREATE TRIGGER trg_operaciones_resumen_upd AFTER UPDATE ON operaciones BEGIN
+            {SQL_RESUMEN_RESTAR}
+            INSERT INTO operaciones_resumen (inv, etapa, tipo, dia, n, miBs, miUsd, resultBs, resultUsd)
+            VALUES (COALESCE(NEW.inv, ''), COALESCE(NEW.etapa, 0), COALESCE(NEW.tipo, ''), substr(COALESCE(NEW.fecha, ''), 1, 10),
+                    1, COALESCE(NEW.miBs, 0), COALESCE(NEW.miUsd, 0), COALESCE(NEW.resultBs, 0), COALESCE(NEW.resultUsd, 0))
+            ON CONFLICT (inv, etapa, tipo, dia) DO UPDATE SET n = n + 1,
+                miBs = miBs + excluded.miBs, miUsd = miUsd + excluded.miUsd,
+                resultBs = resultBs + excluded.resultBs, resultUsd = resultUsd + excluded.resultUsd;
+            END""",
+         "DELETE FROM operaciones_resumen WHERE n <= 0"]),
+]
+
+def version_tabla(conn, tabla: str) -> int:
+    fila = conn.execute("SELECT version FROM contadores WHERE tabla = ?", (tabla,)).fetchone()
+    return fila[0] if fila else 0
+
+def init_db():
+    with get_db("init_db") as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for v, sentencias in MIGRACIONES:
+            if v <= version: continue
+            for sql in sentencias: conn.execute(sql)
+            conn.execute(f"PRAGMA user_version = {v}")
+            conn.commit()
+
+# Las sesiones vivas y el feed de cambios están en la memoria de cada proceso: con más workers cada uno vería
+# solo una parte. gunicorn.conf.py respeta este tope; súbelo solo con afinidad de sesión delante.
+WORKERS_MAX = int(os.environ.get("WORKERS_MAX", 1))
+
+def preparar():
+    """Arranque en frío, idempotente: migra el esquema. Con gunicorn --preload corre una sola vez en el maestro
+    antes del fork; luego suelta las conexiones para que ningún worker herede un descriptor SQLite abierto."""
+    init_db()
+    pool.cerrar()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    preparar()
+    pool.abrir()
+    registro_sesiones.cargar()
+    volcado = asyncio.create_task(volcar_sesiones_periodicamente())
+    tasas = asyncio.create_task(servicio_tasas.ciclo())
+    yield
+    volcado.cancel()
+    tasas.cancel()
+    await servicio_tasas.cerrar()
+    registro_sesiones.flush()
+    pool.cerrar()
+
+app = FastAPI(title="ArbitrajePro API", lifespan=lifespan)
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"],
+                   expose_headers=["X-Next-Cursor"])
+comprimir(app)
+instrumentar(app, "arbitraje")
 
 class Operacion(BaseModel):
     id: Optional[int] = None
@@ -43,73 +274,894 @@ class Sesion(BaseModel):
 @app.get("/")
 def root(): return {"status": "online", "app": "ArbitrajePro API v2"}
 
+@app.get("/salud/vivo")
+async def salud_vivo():
+    """Liveness: el proceso responde (no revisa dependencias)"""
+    return {"status": "vivo", "pid": os.getpid()}
+
+@app.get("/salud/listo")
+def salud_listo():
+    """Readiness: 200 con el esquema al día, la base accesible y las sesiones restauradas; 503 mientras no"""
+    estado = {"pid": os.getpid(), "esquema_esperado": MIGRACIONES[-1][0]}
+    try:
+        with get_db("salud") as conn:
+            estado["esquema"] = conn.execute("PRAGMA user_version").fetchone()[0]
+    except (sqlite3.Error, HTTPException) as e:
+        estado["error"] = str(e)
+    estado.update(sesiones_cargadas=registro_sesiones.cargadas, tasas=sorted(servicio_tasas.valores))
+    listo = estado.get("esquema") == estado["esquema_esperado"] and registro_sesiones.cargadas
+    estado["status"] = "listo" if listo else "calentando"
+    return RespuestaJSON(estado, status_code=200 if listo else 503, headers={"Cache-Control": "no-store"})
+
+# ============ CAMBIOS EN TIEMPO REAL (PUB/SUB EN PROCESO) ============
+CAMBIOS_BUFFER = int(os.environ.get("CAMBIOS_BUFFER", 5000))       # eventos retenidos para reanudar
+CAMBIOS_COLA_MAX = int(os.environ.get("CAMBIOS_COLA_MAX", 1000))   # eventos pendientes por suscriptor
+CAMBIOS_PING_SEG = float(os.environ.get("CAMBIOS_PING_SEG", 15))
+
+SUSCRIPTORES = registro.medidor("cambios_suscriptores", "Suscriptores conectados al feed de cambios")
+
+class Suscriptor:
+    def __init__(self, user: Optional[str], admin: bool):
+        self.user = user
+        self.admin = admin
+        self.loop = asyncio.get_running_loop()
+        self.cola = asyncio.Queue(CAMBIOS_COLA_MAX)
+        self.desbordado = False
+
+    def acepta(self, evento: dict) -> bool:
+        return self.admin or evento["user"] is None or evento["user"] == self.user
+
+    def _entregar(self, evento: dict):
+        try:
+            self.cola.put_nowait(evento)
+        except asyncio.QueueFull:
+            self.desbordado = True   # cliente lento: se le pide recargar en vez de crecer sin límite
+
+class FeedCambios:
+    """Eventos de operaciones y sesiones con id creciente. Se publican desde cualquier hilo (los endpoints
+    sync corren en el threadpool) y se entregan en el loop de cada suscriptor. Los últimos CAMBIOS_BUFFER
+    eventos quedan en memoria para reanudar desde un id (Last-Event-ID)."""
+
+    def __init__(self, capacidad: int = CAMBIOS_BUFFER):
+        self._eventos = deque(maxlen=capacidad)
+        self._suscriptores = set()
+        self._ultimo_id = 0
+        self._lock = threading.Lock()
+
+    def publicar(self, tipo: str, user: Optional[str], datos: dict):
+        """`user` None = evento para todos (p. ej. purga)"""
+        with self._lock:
+            self._ultimo_id += 1
+            evento = {"id": self._ultimo_id, "tipo": tipo, "user": user, "datos": datos,
+                      "fecha": datetime.now().isoformat()}
+            self._eventos.append(evento)
+            destinos = [s for s in self._suscriptores if s.acepta(evento)]
+        for s in destinos:
+            try:
+                s.loop.call_soon_threadsafe(s._entregar, evento)
+            except RuntimeError:   # loop cerrado
+                pass
+
+    def suscribir(self, user: Optional[str], admin: bool, desde: Optional[int]):
+        """Registra el suscriptor y devuelve (suscriptor, eventos pendientes desde `desde`, completo).
+        completo=False si el buffer ya no contiene todo lo ocurrido desde `desde` (el cliente debe recargar)."""
+        s = Suscriptor(user, admin)
+        with self._lock:
+            self._suscriptores.add(s)
+            SUSCRIPTORES.set(len(self._suscriptores))
+            if desde is None: return s, [], True
+            pendientes = [e for e in self._eventos if e["id"] > desde and s.acepta(e)]
+            primero = self._eventos[0]["id"] if self._eventos else self._ultimo_id + 1
+            completo = desde >= primero - 1 and desde <= self._ultimo_id
+        return s, pendientes, completo
+
+    def desuscribir(self, s: Suscriptor):
+        with self._lock:
+            self._suscriptores.discard(s)
+            SUSCRIPTORES.set(len(self._suscriptores))
+
+    @property
+    def ultimo_id(self) -> int:
+        return self._ultimo_id
+
+cambios = FeedCambios()
+
 # ============ OPERACIONES ============
+COLUMNAS_OPERACION = ("id", "fecha", "etapa", "inv", "miBs", "miUsd", "resultBs", "resultUsd", "tipo")
+LIMITE_MAXIMO = 5000
+
+def filtros_operaciones(user=None, desde=None, hasta=None, etapa=None, tipo=None, cursor=None):
+    """Construye el WHERE (y sus parámetros) compartido por las consultas de operaciones"""
+    where, params = [], []
+    if user: where.append("inv = ?"); params.append(user)
+    if desde: where.append("fecha >= ?"); params.append(desde)
+    if hasta: where.append("fecha <= ?"); params.append(hasta)
+    if etapa is not None: where.append("etapa = ?"); params.append(etapa)
+    if tipo: where.append("tipo = ?"); params.append(tipo)
+    if cursor is not None: where.append("id < ?"); params.append(cursor)
+    return (" WHERE " + " AND ".join(where) if where else ""), params
+
+def columnas_proyeccion(campos: Optional[str]):
+    if not campos: return COLUMNAS_OPERACION
+    pedidas = [c.strip() for c in campos.split(",") if c.strip()]
+    invalidas = [c for c in pedidas if c not in COLUMNAS_OPERACION]
+    if invalidas: raise HTTPException(status_code=400, detail=f"Campos inválidos: {', '.join(invalidas)}")
+    return ("id",) + tuple(c for c in pedidas if c != "id")
+
 @app.get("/api/operaciones")
-def get_operaciones(user: Optional[str] = None, admin: Optional[bool] = False):
-    with get_db() as conn:
-        if admin: rows = conn.execute("SELECT * FROM operaciones ORDER BY id DESC").fetchall()
-        elif user: rows = conn.execute("SELECT * FROM operaciones WHERE inv = ? ORDER BY id DESC", (user,)).fetchall()
-        else: rows = conn.execute("SELECT * FROM operaciones ORDER BY id DESC").fetchall()
-        return [dict(row) for row in rows]
+def get_operaciones(request: Request, user: Optional[str] = None, admin: Optional[bool] = False,
+                    cursor: Optional[int] = None, limit: Optional[int] = Query(None, ge=1, le=LIMITE_MAXIMO),
+                    desde: Optional[str] = None, hasta: Optional[str] = None,
+                    etapa: Optional[int] = None, tipo: Optional[str] = None, campos: Optional[str] = None):
+    """Lista operaciones (id DESC). Con `limit` pagina por keyset: la siguiente página se pide con
+    `cursor` = cabecera X-Next-Cursor. Sin `limit` devuelve todo (compatibilidad con clientes antiguos).
+    El ETag sale del contador de cambios de la tabla: si no hubo cambios se responde 304 sin consultar."""
+    columnas = columnas_proyeccion(campos)
+    where, params = filtros_operaciones(None if admin else user, desde, hasta, etapa, tipo, cursor)
+    sql = f"SELECT {', '.join(columnas)} FROM operaciones{where} ORDER BY id DESC"
+    if limit: sql += " LIMIT ?"; params.append(limit)
+    with get_db("listar_operaciones") as conn:
+        etag = etag_de("operaciones", version_tabla(conn, "operaciones"), str(request.url.query))
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if coincide(request, etag): return Response(status_code=304, headers=headers)
+        rows = conn.execute(sql, params).fetchall()
+    if limit and len(rows) == limit:
+        headers["X-Next-Cursor"] = str(rows[-1]["id"])
+    with span("serializar_operaciones"):
+        return RespuestaJSON([dict(zip(columnas, row)) for row in rows], headers=headers)
+
+SQL_INSERT_OPERACION = """INSERT INTO operaciones (id, fecha, etapa, inv, miBs, miUsd, resultBs, resultUsd, tipo)
+            VALUES (?,?,?,?,?,?,?,?,?)"""
+
+def fila_operacion(op: Operacion):
+    return (op.id, op.fecha, op.etapa, op.inv, op.miBs, op.miUsd, op.resultBs, op.resultUsd, op.tipo)
 
 @app.post("/api/operaciones")
-def save_operacion(op: Operacion):
-    with get_db() as conn:
-        cursor = conn.execute("""INSERT INTO operaciones (id, fecha, etapa, inv, miBs, miUsd, resultBs, resultUsd, tipo)
-            VALUES (?,?,?,?,?,?,?,?,?)""",
-            (op.id, op.fecha, op.etapa, op.inv, op.miBs, op.miUsd, op.resultBs, op.resultUsd, op.tipo))
-        conn.commit()
-        return {"status": "success", "id": cursor.lastrowid}
+def save_operacion(op: Operacion, validar: bool = True):
+    """Se recalcula la operación y, si es de hoy, su tasa implícita se compara con la instantánea de mercado;
+    si no cuadra se rechaza con 422. `validar=false` lo omite (importaciones y correcciones del administrador)."""
+    if validar:
+        errores = validar_operacion(op.model_dump())
+        if errores: raise HTTPException(status_code=422, detail={"mensaje": "La operación no cuadra", "errores": errores})
+    with get_db("insertar_operacion") as conn:
+        cursor = conn.execute(SQL_INSERT_OPERACION, fila_operacion(op))
+    op.id = cursor.lastrowid
+    cambios.publicar("operacion.insertada", op.inv, op.model_dump())
+    return {"status": "success", "id": op.id}
+
+# ============ CARGA MASIVA (SINCRONIZACIÓN OFFLINE) ============
+MAX_LOTE = int(os.environ.get("MAX_LOTE", 10000))
+
+async def leer_lote(request: Request):
+    """Lee un arreglo JSON o un flujo NDJSON (una operación por línea) del cuerpo"""
+    if "ndjson" in request.headers.get("content-type", ""):
+        registros, resto = [], b""
+        async for chunk in request.stream():
+            lineas = (resto + chunk).split(b"\n")
+            resto = lineas.pop()
+            registros.extend(json.loads(l) for l in lineas if l.strip())
+            if len(registros) > MAX_LOTE: break
+        if resto.strip(): registros.append(json.loads(resto))
+        return registros
+    registros = json.loads(await request.body())
+    if not isinstance(registros, list): raise ValueError("Se esperaba un arreglo JSON")
+    return registros
+
+def insertar_lote(registros: list, validar: bool = True):
+    """Inserta en una sola transacción; las operaciones cuyo id ya existe se reportan como duplicadas.
+    El id del cliente es obligatorio: sin él un reintento del mismo lote duplicaría filas.
+    Con `validar` las que no cuadran (ver `validar_operacion`) se reportan como error y no se insertan."""
+    resultados, validas, referencias = [], [], referencias_mercado()
+    for i, r in enumerate(registros):
+        try:
+            op = Operacion.model_validate(r)
+        except ValidationError as e:
+            resultados.append({"indice": i, "id": r.get("id") if isinstance(r, dict) else None,
+                               "status": "error", "detalle": e.errors(include_url=False)[0]["msg"]})
+            continue
+        errores = validar_operacion(op.model_dump(), referencias) if validar else []
+        if op.id is None:
+            resultados.append({"indice": i, "id": None, "status": "error", "detalle": "id requerido para la carga idempotente"})
+        elif errores:
+            resultados.append({"indice": i, "id": op.id, "status": "error", "detalle": "La operación no cuadra", "errores": errores})
+        else:
+            validas.append((i, op))
+    with get_db("insertar_lote") as conn:
+        conn.execute("BEGIN IMMEDIATE")   # otro lote concurrente no puede insertar entre la verificación y el INSERT
+        ids = [op.id for _, op in validas]
+        existentes = set()
+        for k in range(0, len(ids), 500):
+            parte = ids[k:k + 500]
+            existentes.update(row[0] for row in conn.execute(
+                f"SELECT id FROM operaciones WHERE id IN ({','.join('?' * len(parte))})", parte))
+        nuevas = []
+        for i, op in validas:
+            if op.id in existentes:
+                resultados.append({"indice": i, "id": op.id, "status": "duplicada"}); continue
+            existentes.add(op.id); nuevas.append(fila_operacion(op))
+            resultados.append({"indice": i, "id": op.id, "status": "insertada"})
+        conn.executemany(SQL_INSERT_OPERACION, nuevas)
+    insertadas = {r["indice"] for r in resultados if r["status"] == "insertada"}
+    for i, op in validas:
+        if i in insertadas: cambios.publicar("operacion.insertada", op.inv, op.model_dump())
+    resultados.sort(key=lambda r: r["indice"])
+    return resultados
+
+@app.post("/api/operaciones/bulk")
+async def save_operaciones_bulk(request: Request, validar: bool = True):
+    """Carga masiva idempotente: reenviar el mismo lote no duplica filas (cada operación debe traer su id).
+    Cada fila se valida como en POST /api/operaciones salvo con `validar=false`."""
+    try:
+        registros = await leer_lote(request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Cuerpo inválido: {e}")
+    if len(registros) > MAX_LOTE:
+        raise HTTPException(status_code=413, detail=f"Máximo {MAX_LOTE} operaciones por lote")
+    resultados = await run_in_threadpool(insertar_lote, registros, validar)
+    conteo = {"insertada": 0, "duplicada": 0, "error": 0}
+    for r in resultados: conteo[r["status"]] += 1
+    return {"status": "success", "insertadas": conteo["insertada"], "duplicadas": conteo["duplicada"],
+            "errores": conteo["error"], "resultados": resultados}
+
+# ============ ESTADÍSTICAS (RESUMEN INCREMENTAL) ============
+# Semana ISO 8601: el jueves de la semana (lunes a domingo) da el año y el número de semana
+JUEVES_ISO = "date(dia, '-3 days', 'weekday 4')"
+DIMENSIONES_STATS = {"inv": "inv", "etapa": "etapa", "tipo": "tipo", "dia": "dia",
+                     "semana": f"printf('%s-W%02d', strftime('%Y', {JUEVES_ISO}), (strftime('%j', {JUEVES_ISO}) - 1) / 7 + 1)",
+                     "mes": "substr(dia, 1, 7)"}
+
+@app.get("/api/operaciones/stats")
+def get_stats(request: Request, agrupar: str = "inv", user: Optional[str] = None, desde: Optional[str] = None,
+              hasta: Optional[str] = None, etapa: Optional[int] = None, tipo: Optional[str] = None):
+    """Totales y ganancia agrupados (inv, etapa, tipo, dia, semana, mes) leídos de operaciones_resumen"""
+    dims = [d.strip() for d in agrupar.split(",") if d.strip()]
+    invalidas = [d for d in dims if d not in DIMENSIONES_STATS]
+    if invalidas: raise HTTPException(status_code=400, detail=f"Agrupación inválida: {', '.join(invalidas)}")
+    where, params = [], []
+    if user: where.append("inv = ?"); params.append(user)
+    if desde: where.append("dia >= ?"); params.append(desde[:10])
+    if hasta: where.append("dia <= ?"); params.append(hasta[:10])
+    if etapa is not None: where.append("etapa = ?"); params.append(etapa)
+    if tipo: where.append("tipo = ?"); params.append(tipo)
+    select = [f"{DIMENSIONES_STATS[d]} AS {d}" for d in dims]
+    sql = (f"SELECT {', '.join(select + ['SUM(n)', 'SUM(miBs)', 'SUM(miUsd)', 'SUM(resultBs)', 'SUM(resultUsd)'])}"
+           f" FROM operaciones_resumen{' WHERE ' + ' AND '.join(where) if where else ''}")
+    if dims: sql += f" GROUP BY {', '.join(dims)} ORDER BY {', '.join(dims)}"
+    with get_db("estadisticas") as conn:
+        etag = etag_de("stats", version_tabla(conn, "operaciones"), str(request.url.query))
+        if coincide(request, etag): return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+        rows = conn.execute(sql, params).fetchall()
+    grupos = []
+    for row in rows:
+        n, miBs, miUsd, resultBs, resultUsd = (v or 0 for v in row[len(dims):])
+        if not n: continue
+        grupo = dict(zip(dims, row[:len(dims)]))
+        grupo.update({"n": n, "miBs": round(miBs, 2), "miUsd": round(miUsd, 2),
+                      "resultBs": round(resultBs, 2), "resultUsd": round(resultUsd, 2),
+                      "gananciaBs": round(resultBs - miBs, 2), "gananciaUsd": round(resultUsd - miUsd, 2)})
+        grupos.append(grupo)
+    return RespuestaJSON({"agrupar": dims, "grupos": grupos}, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+
+# ============ EXPORTACIÓN EN STREAMING ============
+LOTE_EXPORTACION = 1000
+
+def filas_exportacion(where: str, params: list, formato: str):
+    """Generador: recorre el cursor con fetchmany y emite cada lote ya serializado"""
+    with get_db("exportar") as conn:
+        cur = conn.execute(f"SELECT {', '.join(COLUMNAS_OPERACION)} FROM operaciones{where} ORDER BY id", params)
+        if formato == "csv":
+            buf = io.StringIO()
+            escritor = csv.writer(buf)
+            escritor.writerow(COLUMNAS_OPERACION)
+            yield "\ufeff" + buf.getvalue()
+        while True:
+            filas = cur.fetchmany(LOTE_EXPORTACION)
+            if not filas: break
+            if formato == "csv":
+                buf.seek(0); buf.truncate()
+                escritor.writerows(filas)
+                yield buf.getvalue()
+            else:
+                yield "".join(json.dumps(dict(zip(COLUMNAS_OPERACION, f)), ensure_ascii=False) + "\n" for f in filas)
+
+def comprimir_gzip(partes):
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for parte in partes:
+        datos = z.compress(parte.encode("utf-8"))
+        if datos: yield datos
+    yield z.flush()
+
+@app.get("/api/operaciones/export")
+def export_operaciones(formato: str = Query("csv", pattern="^(csv|ndjson)$"), gzip: bool = False,
+                       user: Optional[str] = None, desde: Optional[str] = None, hasta: Optional[str] = None,
+                       etapa: Optional[int] = None, tipo: Optional[str] = None):
+    """Exporta operaciones en CSV o NDJSON sin cargar la tabla en memoria (opcionalmente gzip)"""
+    where, params = filtros_operaciones(user, desde, hasta, etapa, tipo)
+    cuerpo = filas_exportacion(where, params, formato)
+    media = "text/csv; charset=utf-8" if formato == "csv" else "application/x-ndjson"
+    headers = {"Content-Disposition": f'attachment; filename="operaciones.{formato}"'}
+    if gzip:
+        cuerpo = comprimir_gzip(cuerpo)
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(cuerpo, media_type=media, headers=headers)
+
+# ============ MOTOR DE ARBITRAJE (MISMAS FÓRMULAS QUE index.html) ============
+# Etapa 1 (Compra BDV):           u = Bs / tc
+# Etapa 2 (Transferencia Binance): n = u * (1 - (bdv + bpay) / 100), equivalente Bs = n * tv
+# Etapa 3 (Venta P2P):            Bs = usdt * tv
+# Un ciclo completo (runSim) multiplica el capital en Bs por f = tv * (1 - comisión / 100) / tc.
+MAX_ESCENARIOS = int(os.environ.get("MAX_ESCENARIOS", 200000))
+MAX_CICLOS = 365
+TOLERANCIA_VALIDACION = 0.01   # diferencia relativa admitida al recalcular una operación guardada
+TOLERANCIA_MERCADO = float(os.environ.get("TOLERANCIA_MERCADO", 0.05))   # desvío admitido frente a la tasa de mercado
+ZONA_VE = timezone(timedelta(hours=-4))
+
+class Simulacion(BaseModel):
+    montos: List[float]                         # capital inicial en Bs
+    tasas_bcv: List[float]                      # tasa de compra (Bs por $)
+    spreads: Optional[List[float]] = None       # % de la tasa P2P de venta sobre la BCV
+    tasas_venta: Optional[List[float]] = None   # o bien tasas P2P absolutas (Bs por USDT)
+    comisiones: List[float] = [6.6]             # % total BDV + BPAY
+    ciclos: int = 1
+    detalle: bool = True                        # False: solo resumen y mejor escenario
+
+def ejes_simulacion(sim: Simulacion):
+    if (sim.spreads is None) == (sim.tasas_venta is None):
+        raise HTTPException(status_code=400, detail="Indica spreads o tasas_venta (uno de los dos)")
+    ejes = {"montos": sim.montos, "tasas_bcv": sim.tasas_bcv,
+            "spreads" if sim.spreads is not None else "tasas_venta": sim.spreads or sim.tasas_venta,
+            "comisiones": sim.comisiones}
+    if any(not v for v in ejes.values()): raise HTTPException(status_code=400, detail="Ningún eje puede estar vacío")
+    if any(x <= 0 for x in sim.montos + sim.tasas_bcv + (sim.tasas_venta or [])):
+        raise HTTPException(status_code=400, detail="Montos y tasas deben ser positivos")
+    if any(not 0 <= c < 100 for c in sim.comisiones):
+        raise HTTPException(status_code=400, detail="Las comisiones deben estar entre 0 y 100")
+    if not 1 <= sim.ciclos <= MAX_CICLOS:
+        raise HTTPException(status_code=400, detail=f"ciclos debe estar entre 1 y {MAX_CICLOS}")
+    total = 1
+    for v in ejes.values(): total *= len(v)
+    if total > MAX_ESCENARIOS:
+        raise HTTPException(status_code=413, detail=f"{total} escenarios; máximo {MAX_ESCENARIOS}")
+    return ejes, total
+
+def factores_ciclo(tasas_bcv, ventas, comisiones, por_spread: bool):
+    """Factor de crecimiento por ciclo para cada (tasa_bcv, venta, comisión), en orden row-major.
+    Se calcula una sola vez y luego se escala por cada monto: la ganancia es lineal en el capital."""
+    netos = [1 - c / 100 for c in comisiones]
+    if por_spread:
+        return [(1 + s / 100) * k for _ in tasas_bcv for s in ventas for k in netos]
+    return [tv * k / tc for tc in tasas_bcv for tv in ventas for k in netos]
+
+def detalle_ciclos(capital: float, tc: float, tv: float, comision: float, ciclos: int):
+    """Tabla por ciclo equivalente a la de runSim() en index.html"""
+    filas = []
+    for i in range(ciclos):
+        neto = capital / tc * (1 - comision / 100)
+        retorno = neto * tv
+        filas.append({"ciclo": i + 1, "capital": round(capital, 2), "neto": round(neto, 4),
+                      "retorno": round(retorno, 2), "ganancia": round(retorno - capital, 2)})
+        capital = retorno
+    return filas
+
+@app.post("/api/simular")
+def simular(sim: Simulacion):
+    """Evalúa la rejilla montos × tasas_bcv × (spreads | tasas_venta) × comisiones con `ciclos` reinversiones.
+    `ganancia` (Bs) es plana en orden row-major según `forma`; `roi` (%) no depende del monto y tiene forma[1:]."""
+    ejes, total = ejes_simulacion(sim)
+    por_spread = sim.spreads is not None
+    ventas = sim.spreads if por_spread else sim.tasas_venta
+    with span("simular"):
+        crecimiento = [f ** sim.ciclos - 1 for f in factores_ciclo(sim.tasas_bcv, ventas, sim.comisiones, por_spread)]
+        roi = [round(g * 100, 4) for g in crecimiento]
+        i_mejor = max(range(len(crecimiento)), key=crecimiento.__getitem__)
+        monto_mejor = max(sim.montos) if crecimiento[i_mejor] >= 0 else min(sim.montos)
+        n_ventas, n_comisiones = len(ventas), len(sim.comisiones)
+        i_tc, resto = divmod(i_mejor, n_ventas * n_comisiones)
+        i_venta, i_comision = divmod(resto, n_comisiones)
+        tc = sim.tasas_bcv[i_tc]
+        tv = tc * (1 + ventas[i_venta] / 100) if por_spread else ventas[i_venta]
+        comision = sim.comisiones[i_comision]
+        resultado = {
+            "escenarios": total, "ciclos": sim.ciclos, "ejes": ejes, "forma": [len(v) for v in ejes.values()],
+            "rentables": sum(1 for g in crecimiento if g > 0) * len(sim.montos),
+            # Spread P2P mínimo para no perder con cada comisión: (1 + s)(1 - c) = 1
+            "equilibrio": {str(c): round((1 / (1 - c / 100) - 1) * 100, 4) for c in sim.comisiones},
+            "mejor": {"monto": monto_mejor, "tasa_bcv": tc, "tasa_venta": round(tv, 4), "comision": comision,
+                      "roi": roi[i_mejor], "ganancia": round(monto_mejor * crecimiento[i_mejor], 2),
+                      "detalle": detalle_ciclos(monto_mejor, tc, tv, comision, sim.ciclos)},
+        }
+        if sim.detalle:
+            resultado["roi"] = roi
+            resultado["ganancia"] = [round(m * g, 2) for m in sim.montos for g in crecimiento]
+    return resultado
+
+def recalcular_operacion(op: dict, tasa_bcv: Optional[float] = None, tasa_venta: Optional[float] = None,
+                         comision: Optional[float] = None):
+    """Valores esperados (miBs, miUsd, resultBs, resultUsd) de una operación guardada según su etapa.
+    Sin tasas explícitas se usan las implícitas en la propia operación, lo que valida su consistencia interna."""
+    etapa, miBs, miUsd = op["etapa"], op["miBs"] or 0, op["miUsd"] or 0
+    if etapa == 1:
+        tc = tasa_bcv or (miBs / miUsd if miUsd else None)
+        if not tc: return None
+        return {"miBs": miBs, "miUsd": miBs / tc, "resultBs": miBs, "resultUsd": miBs / tc}
+    if etapa == 2:
+        if comision is None:
+            return {"miBs": miBs, "miUsd": miUsd, "resultBs": miBs, "resultUsd": op["resultUsd"]}
+        neto = miUsd * (1 - comision / 100)
+        return {"miBs": neto * tasa_venta if tasa_venta else miBs, "miUsd": miUsd,
+                "resultBs": neto * tasa_venta if tasa_venta else miBs, "resultUsd": neto}
+    if etapa == 3:
+        tv = tasa_venta or (miBs / miUsd if miUsd else None)
+        if not tv: return None
+        return {"miBs": miUsd * tv, "miUsd": miUsd, "resultBs": miUsd * tv, "resultUsd": miUsd}
+    return None
+
+def discrepancias(op: dict, esperado: dict, tolerancia: float):
+    errores = []
+    for campo, valor in esperado.items():
+        guardado = op[campo] or 0
+        if abs(guardado - valor) > tolerancia * max(abs(valor), 1):
+            errores.append({"campo": campo, "guardado": guardado, "esperado": round(valor, 4)})
+    if op["etapa"] == 2 and op["resultUsd"] is not None and not 0 <= (op["resultUsd"] or 0) <= (op["miUsd"] or 0):
+        errores.append({"campo": "resultUsd", "guardado": op["resultUsd"], "esperado": "0 <= resultUsd <= miUsd"})
+    return errores
+
+def errores_operacion(op, tasa_bcv=None, tasa_venta=None, comision=None, tolerancia=TOLERANCIA_VALIDACION):
+    esperado = recalcular_operacion(op, tasa_bcv, tasa_venta, comision)
+    if esperado is None: return [{"campo": "etapa", "guardado": op["etapa"], "esperado": "etapa 1, 2 o 3 con montos"}]
+    return discrepancias(op, esperado, tolerancia)
+
+def referencias_mercado() -> dict:
+    """Tasa de referencia por etapa según la instantánea de ServicioTasas: BCV para la compra (etapa 1) y la mediana
+    de los anuncios BUY de Binance P2P, lo que recibe quien vende USDT, para la venta (etapa 3).
+    Solo trae las fuentes que ya respondieron; la etapa 2 no tiene tasa de mercado (solo comisiones)."""
+    valores, referencias = servicio_tasas.valores, {}
+    if "bcv" in valores: referencias[1] = ("tasa_bcv", valores["bcv"]["datos"]["precio"])
+    if "p2p_buy" in valores: referencias[3] = ("tasa_venta", valores["p2p_buy"]["datos"]["mediana"])
+    return referencias
+
+def es_de_hoy(fecha: str) -> bool:
+    """Solo se compara con la instantánea lo fechado hoy (en Venezuela o en UTC, según cómo lo fechó el cliente)"""
+    ahora = datetime.now(timezone.utc)
+    return fecha[:10] in (ahora.date().isoformat(), ahora.astimezone(ZONA_VE).date().isoformat())
+
+def errores_mercado(op, referencias: dict, tolerancia: float = TOLERANCIA_MERCADO):
+    """Tasa implícita de la operación (miBs / miUsd) frente a la de mercado de su etapa"""
+    if op["etapa"] not in referencias or not op["miUsd"]: return []
+    campo, referencia = referencias[op["etapa"]]
+    implicita = (op["miBs"] or 0) / op["miUsd"]
+    if abs(implicita - referencia) <= tolerancia * referencia: return []
+    return [{"campo": campo, "guardado": round(implicita, 4), "esperado": referencia, "tolerancia": tolerancia}]
+
+def validar_operacion(op, referencias: Optional[dict] = None, tolerancia=TOLERANCIA_VALIDACION):
+    """Fórmulas de la etapa y, para las operaciones de hoy, tasa implícita frente al mercado"""
+    errores = errores_operacion(op, tolerancia=tolerancia)
+    if not errores and es_de_hoy(op["fecha"]):
+        errores = errores_mercado(op, referencias_mercado() if referencias is None else referencias)
+    return errores
+
+@app.get("/api/operaciones/validar")
+def validar_operaciones(user: Optional[str] = None, desde: Optional[str] = None, hasta: Optional[str] = None,
+                        etapa: Optional[int] = None, tasa_bcv: Optional[float] = Query(None, gt=0),
+                        tasa_venta: Optional[float] = Query(None, gt=0), comision: Optional[float] = Query(None, ge=0, lt=100),
+                        tolerancia: float = Query(TOLERANCIA_VALIDACION, ge=0), limite: int = Query(500, ge=1, le=LIMITE_MAXIMO)):
+    """Recalcula en el servidor las operaciones guardadas y devuelve las que no cuadran con las fórmulas.
+    Sin tasas explícitas las de hoy también se comparan con la instantánea de mercado (TOLERANCIA_MERCADO)."""
+    where, params = filtros_operaciones(user, desde, hasta, etapa)
+    revisadas, inconsistentes = 0, []
+    explicitas = tasa_bcv is not None or tasa_venta is not None or comision is not None
+    referencias = referencias_mercado()
+    with get_db("validar_operaciones") as conn:
+        cur = conn.execute(f"SELECT {', '.join(COLUMNAS_OPERACION)} FROM operaciones{where} ORDER BY id", params)
+        while len(inconsistentes) < limite:
+            filas = cur.fetchmany(LOTE_EXPORTACION)
+            if not filas: break
+            for fila in filas:
+                revisadas += 1
+                errores = (errores_operacion(fila, tasa_bcv, tasa_venta, comision, tolerancia) if explicitas
+                           else validar_operacion(fila, referencias, tolerancia))
+                if errores:
+                    inconsistentes.append({"id": fila["id"], "etapa": fila["etapa"], "inv": fila["inv"], "errores": errores})
+                    if len(inconsistentes) >= limite: break
+    return {"revisadas": revisadas, "inconsistentes": inconsistentes, "completo": len(inconsistentes) < limite}
 
 @app.delete("/api/operaciones/{op_id}")
 def delete_operacion(op_id: int, password: str):
     if password != ADMIN_PASSWORD: raise HTTPException(status_code=401)
-    with get_db() as conn: conn.execute("DELETE FROM operaciones WHERE id = ?", (op_id,)); conn.commit()
+    with get_db("borrar_operacion") as conn:
+        fila = conn.execute("SELECT inv FROM operaciones WHERE id = ?", (op_id,)).fetchone()
+        conn.execute("DELETE FROM operaciones WHERE id = ?", (op_id,))
+    if fila: cambios.publicar("operacion.borrada", fila["inv"], {"id": op_id})
     return {"status": "success"}
 
 @app.delete("/api/admin/purge")
 def purge_all(password: str):
     if password != ADMIN_PASSWORD: raise HTTPException(status_code=401)
-    with get_db() as conn: conn.execute("DELETE FROM operaciones"); conn.commit()
+    with get_db("purgar") as conn: conn.execute("DELETE FROM operaciones")
+    cambios.publicar("operaciones.purgadas", None, {})
     return {"status": "success"}
 
 # ============ SESIONES (MONITOREO REAL) ============
+SESION_TTL_SEG = int(os.environ.get("SESION_TTL_SEG", 30 * 60))
+SESIONES_FLUSH_SEG = float(os.environ.get("SESIONES_FLUSH_SEG", 5))
+INSTANCIA = os.urandom(4).hex()
+
+class RegistroSesiones:
+    """Sesiones vivas en memoria (dict + heap de vencimientos) con persistencia diferida en lotes.
+    Los latidos solo tocan memoria; flush() vuelca los cambios pendientes a la tabla sesiones."""
+
+    def __init__(self, ttl: int = SESION_TTL_SEG):
+        self.ttl = ttl
+        self._sesiones = {}   # usuario -> {"datos": dict, "vence": float}
+        self._heap = []       # (vence, usuario); entradas obsoletas se descartan al sacarlas
+        self._sucias = set()
+        self._borradas = set()
+        self._lock = threading.Lock()
+        self.version = 0      # sube con cada cambio visible en listar(); base del ETag de /api/sesiones
+        self.cargadas = False
+
+    def _programar(self, usuario: str, vence: float):
+        self._sesiones[usuario]["vence"] = vence
+        heapq.heappush(self._heap, (vence, usuario))
+
+    def _expirar(self, ahora: float):
+        while self._heap and self._heap[0][0] <= ahora:
+            vence, usuario = heapq.heappop(self._heap)
+            s = self._sesiones.get(usuario)
+            if s and s["vence"] == vence:
+                del self._sesiones[usuario]
+                self._sucias.discard(usuario)
+                self._borradas.add(usuario)
+                self.version += 1
+                cambios.publicar("sesion.expirada", usuario, {"usuario": usuario})
+
+    def guardar(self, datos: dict):
+        ahora = time.monotonic()
+        with self._lock:
+            self._expirar(ahora)
+            self._sesiones[datos["usuario"]] = {"datos": dict(datos), "vence": 0}
+            self._programar(datos["usuario"], ahora + self.ttl)
+            self._sucias.add(datos["usuario"]); self._borradas.discard(datos["usuario"])
+            self.version += 1
+        cambios.publicar("sesion.activa", datos["usuario"], dict(datos))
+
+    def latido(self, usuario: str) -> bool:
+        ahora = time.monotonic()
+        with self._lock:
+            self._expirar(ahora)
+            s = self._sesiones.get(usuario)
+            if s is None: return False
+            s["datos"]["ultima_accion"] = datetime.now().isoformat()
+            self._programar(usuario, ahora + self.ttl)
+            self._sucias.add(usuario)
+            self.version += 1
+            datos = dict(s["datos"])
+        cambios.publicar("sesion.actividad", usuario, datos)
+        return True
+
+    def eliminar(self, usuario: str):
+        with self._lock:
+            existia = self._sesiones.pop(usuario, None) is not None
+            self._sucias.discard(usuario); self._borradas.add(usuario)
+            if existia: self.version += 1
+        if existia: cambios.publicar("sesion.cerrada", usuario, {"usuario": usuario})
+
+    def listar(self):
+        with self._lock:
+            self._expirar(time.monotonic())
+            return [dict(s["datos"]) for s in self._sesiones.values()]
+
+    def etag(self) -> str:
+        """Las sesiones viven en la memoria de cada worker: INSTANCIA y el pid (con --preload todos los workers heredan
+        la INSTANCIA del maestro) evitan confundir versiones de otro proceso"""
+        with self._lock:
+            self._expirar(time.monotonic())
+            return etag_de("sesiones", INSTANCIA, os.getpid(), self.version)
+
+    def limpiar(self):
+        with self._lock: self._expirar(time.monotonic())
+
+    def cargar(self):
+        """Restaura desde la tabla las sesiones que siguen dentro del TTL (tras un reinicio)"""
+        with get_db("cargar_sesiones") as conn:
+            rows = [dict(r) for r in conn.execute("SELECT * FROM sesiones")]
+        ahora, reloj = time.monotonic(), datetime.now()
+        with self._lock:
+            for r in rows:
+                try:
+                    ultima = datetime.fromisoformat(r["ultima_accion"])
+                    if ultima.tzinfo: ultima = ultima.astimezone().replace(tzinfo=None)
+                    transcurrido = (reloj - ultima).total_seconds()
+                except (TypeError, ValueError):
+                    transcurrido = 0
+                if transcurrido >= self.ttl:
+                    self._borradas.add(r["usuario"]); continue
+                self._sesiones[r["usuario"]] = {"datos": r, "vence": 0}
+                self._programar(r["usuario"], ahora + self.ttl - max(transcurrido, 0))
+            self.version += 1
+            self.cargadas = True
+
+    def flush(self):
+        """Escribe en una sola transacción las sesiones modificadas y borra las expiradas"""
+        with self._lock:
+            self._expirar(time.monotonic())
+            filas = [tuple(self._sesiones[u]["datos"].get(c) for c in ("usuario", "inicio", "ultima_accion", "dispositivo"))
+                     for u in self._sucias]
+            borradas = [(u,) for u in self._borradas]
+            self._sucias, self._borradas = set(), set()
+        if not filas and not borradas: return
+        try:
+            with get_db("volcar_sesiones") as conn:
+                conn.executemany("DELETE FROM sesiones WHERE usuario = ?", borradas)
+                conn.executemany("INSERT OR REPLACE INTO sesiones (usuario, inicio, ultima_accion, dispositivo) VALUES (?,?,?,?)", filas)
+        except Exception:
+            with self._lock:  # se reintenta en el próximo ciclo
+                self._sucias.update(f[0] for f in filas if f[0] in self._sesiones)
+                self._borradas.update(u for (u,) in borradas if u not in self._sesiones)
+            raise
+
+registro_sesiones = RegistroSesiones()
+
+async def volcar_sesiones_periodicamente():
+    while True:
+        await asyncio.sleep(SESIONES_FLUSH_SEG)
+        try:
+            await run_in_threadpool(registro_sesiones.flush)
+        except Exception as e:
+            logger.error(f"Error volcando sesiones: {e}")
+
 @app.get("/api/sesiones")
-def get_sesiones():
-    with get_db() as conn:
-        rows = conn.execute("SELECT * FROM sesiones").fetchall()
-        return [dict(row) for row in rows]
+def get_sesiones(request: Request):
+    return respuesta_condicional(request, registro_sesiones.etag(), registro_sesiones.listar, "private, no-cache")
 
 @app.post("/api/sesiones")
 def save_sesion(sesion: Sesion):
-    with get_db() as conn:
-        conn.execute("INSERT OR REPLACE INTO sesiones (usuario, inicio, ultima_accion, dispositivo) VALUES (?,?,?,?)",
-                     (sesion.usuario, sesion.inicio, sesion.ultima_accion, sesion.dispositivo))
-        conn.commit()
+    registro_sesiones.guardar(sesion.model_dump())
     return {"status": "success"}
 
+# ============ LIMPIEZA AUTOMÁTICA DE SESIONES INACTIVAS ============
+# Declarada antes de /api/sesiones/{usuario} para que "cleanup" no se tome como un usuario.
+@app.delete("/api/sesiones/cleanup")
+def cleanup_sesiones():
+    registro_sesiones.limpiar()
+    registro_sesiones.flush()
+    return {"status": "cleaned"}
+
 @app.put("/api/sesiones/{usuario}")
 def update_sesion(usuario: str):
-    with get_db() as conn:
-        conn.execute("UPDATE sesiones SET ultima_accion = ? WHERE usuario = ?", 
-                     (datetime.now().isoformat(), usuario))
-        conn.commit()
+    registro_sesiones.latido(usuario)
     return {"status": "success"}
 
 @app.delete("/api/sesiones/{usuario}")
 def delete_sesion(usuario: str):
-    with get_db() as conn:
-        conn.execute("DELETE FROM sesiones WHERE usuario = ?", (usuario,))
-        conn.commit()
+    registro_sesiones.eliminar(usuario)
     return {"status": "success"}
 
-# ============ LIMPIEZA AUTOMÁTICA DE SESIONES INACTIVAS ============
-@app.delete("/api/sesiones/cleanup")
-def cleanup_sesiones():
-    with get_db() as conn:
-        conn.execute("DELETE FROM sesiones WHERE datetime(ultima_accion) < datetime('now', '-30 minutes')")
-        conn.commit()
-    return {"status": "cleaned"}
+# ============ FEED DE CAMBIOS: SSE Y WEBSOCKET ============
+def evento_sse(evento: dict) -> str:
+    return f"id: {evento['id']}\nevent: {evento['tipo']}\ndata: {json.dumps(evento, ensure_ascii=False)}\n\n"
+
+def aviso_reinicio() -> dict:
+    """Se pidió reanudar desde un id que ya no está en memoria (o el cliente se atrasó): recargar listas completas"""
+    return {"id": cambios.ultimo_id, "tipo": "reiniciar", "user": None, "datos": {}, "fecha": datetime.now().isoformat()}
+
+async def eventos_suscriptor(user: Optional[str], admin: bool, desde: Optional[int]):
+    """Generador común de SSE y WebSocket: pendientes desde `desde`, luego eventos en vivo; None = ping"""
+    suscriptor, pendientes, completo = cambios.suscribir(user, admin, desde)
+    try:
+        if not completo: yield aviso_reinicio()
+        for evento in pendientes: yield evento
+        ultimo = pendientes[-1]["id"] if pendientes else (desde or 0)
+        while True:
+            try:
+                evento = await asyncio.wait_for(suscriptor.cola.get(), CAMBIOS_PING_SEG)
+            except asyncio.TimeoutError:
+                yield None; continue
+            if suscriptor.desbordado:
+                yield aviso_reinicio(); return
+            if evento["id"] <= ultimo: continue   # ya entregado entre los pendientes
+            ultimo = evento["id"]
+            yield evento
+    finally:
+        cambios.desuscribir(suscriptor)
+
+@app.get("/api/cambios")
+async def stream_cambios(request: Request, user: Optional[str] = None, admin: bool = False,
+                         password: Optional[str] = None, desde: Optional[int] = None):
+    """SSE con inserciones/borrados de operaciones y presencia de sesiones del usuario
+    (todo con admin=true, que exige `password`: EventSource no puede mandar cabeceras).
+    Se reanuda con `desde` o con la cabecera Last-Event-ID que EventSource envía al reconectar."""
+    if admin and password != ADMIN_PASSWORD: raise HTTPException(status_code=401)
+    ultimo = request.headers.get("last-event-id")
+    if ultimo and ultimo.isdigit(): desde = int(ultimo)
+
+    async def generar():
+        yield f"retry: 3000\n: conectado {cambios.ultimo_id}\n\n"
+        async with aclosing(eventos_suscriptor(user, admin, desde)) as eventos:
+            async for evento in eventos:
+                if await request.is_disconnected(): break
+                yield ": ping\n\n" if evento is None else evento_sse(evento)
+
+    return StreamingResponse(generar(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.websocket("/api/cambios/ws")
+async def ws_cambios(websocket: WebSocket, user: Optional[str] = None, admin: bool = False,
+                     password: Optional[str] = None, desde: Optional[int] = None):
+    """Mismo feed por WebSocket: un mensaje JSON por evento ({"tipo": "ping"} como keep-alive)"""
+    if admin and password != ADMIN_PASSWORD:
+        await websocket.close(code=1008); return   # antes de aceptar: el handshake responde 403
+    await websocket.accept()
+    try:
+        async with aclosing(eventos_suscriptor(user, admin, desde)) as eventos:
+            async for evento in eventos:
+                await websocket.send_json(evento if evento is not None else {"tipo": "ping"})
+    except WebSocketDisconnect:
+        pass
+
+# ============ TASAS DE MERCADO (BCV + BINANCE P2P) ============
+# Un solo proceso consulta las fuentes cada TASAS_INTERVALO_SEG y todos los clientes leen la misma
+# instantánea ya serializada, en lugar de que cada navegador consulte Binance por el proxy CORS.
+TASAS_INTERVALO_SEG = float(os.environ.get("TASAS_INTERVALO_SEG", 30))
+TASAS_PROFUNDIDAD = int(os.environ.get("TASAS_PROFUNDIDAD", 10))
+TASAS_HTTP_TIMEOUT = float(os.environ.get("TASAS_HTTP_TIMEOUT", 8))
+BCV_URL = os.environ.get("BCV_URL", "https://ve.dolarapi.com/v1/dolares/oficial")
+BINANCE_P2P_URL = os.environ.get("BINANCE_P2P_URL", "https://p2p.binance.com/bapi/c2c/v2/friendly/c2c/adv/search")
+
+CONSULTAS_TASAS = registro.contador("tasas_consultas_total", "Consultas a las fuentes de tasas", ("fuente", "resultado"))
+
+def mediana(valores: List[float]) -> Optional[float]:
+    if not valores: return None
+    orden = sorted(valores)
+    mitad = len(orden) // 2
+    return orden[mitad] if len(orden) % 2 else (orden[mitad - 1] + orden[mitad]) / 2
+
+class FuenteBCV:
+    """Tasa oficial BCV (dolarapi). Devuelve {"precio": float}"""
+    nombre = "bcv"
+
+    def __init__(self, url: str = BCV_URL):
+        self.url = url
+
+    async def consultar(self, http: httpx.AsyncClient) -> dict:
+        res = await http.get(self.url)
+        res.raise_for_status()
+        datos = res.json()
+        precio = float(datos.get("promedio") or datos.get("price") or 0)
+        if precio <= 0: raise ValueError("respuesta sin precio")
+        return {"precio": round(precio, 4)}
+
+class FuenteBinanceP2P:
+    """Anuncios USDT/VES de Binance P2P para un lado del libro.
+    tradeType SELL = anuncios de venta (lo que paga quien compra USDT); BUY = anuncios de compra (lo que recibe quien vende)."""
+
+    def __init__(self, lado: str, url: str = BINANCE_P2P_URL, profundidad: int = TASAS_PROFUNDIDAD):
+        self.lado = lado
+        self.nombre = f"p2p_{lado.lower()}"
+        self.url = url
+        self.profundidad = profundidad
+
+    async def consultar(self, http: httpx.AsyncClient) -> dict:
+        cuerpo = {"asset": "USDT", "fiat": "VES", "merchantCheck": False, "page": 1,
+                  "rows": self.profundidad, "tradeType": self.lado}
+        res = await http.post(self.url, json=cuerpo)
+        res.raise_for_status()
+        ofertas = []
+        for anuncio in (res.json().get("data") or [])[:self.profundidad]:
+            adv = anuncio.get("adv") or {}
+            ofertas.append({"precio": float(adv["price"]), "disponible": float(adv.get("surplusAmount") or 0),
+                            "minimo": float(adv.get("minSingleTransAmount") or 0),
+                            "maximo": float(adv.get("maxSingleTransAmount") or 0),
+                            "comerciante": (anuncio.get("advertiser") or {}).get("nickName")})
+        if not ofertas: raise ValueError("libro vacío")
+        precios = [o["precio"] for o in ofertas]
+        volumen = sum(o["disponible"] for o in ofertas)
+        return {"mejor": precios[0], "mediana": round(mediana(precios), 4),
+                "ponderado": round(sum(o["precio"] * o["disponible"] for o in ofertas) / volumen, 4) if volumen else None,
+                "profundidad": ofertas}
+
+class ServicioTasas:
+    """Instantánea de tasas refrescada en segundo plano.
+    - Las fuentes son objetos con `nombre` y `async consultar(http) -> dict`; se inyectan para pruebas.
+    - Si una fuente falla se conserva su último valor bueno y se reporta el error.
+    - El cuerpo JSON y su ETag se calculan una vez por refresco; Last-Modified solo avanza si el contenido cambia."""
+
+    def __init__(self, fuentes=None, intervalo: float = TASAS_INTERVALO_SEG):
+        self.fuentes = fuentes if fuentes is not None else [FuenteBCV(), FuenteBinanceP2P("BUY"), FuenteBinanceP2P("SELL")]
+        self.intervalo = intervalo
+        self.valores = {}        # nombre -> {"datos", "actualizada"}
+        self.errores = {}        # nombre -> mensaje del último fallo
+        self.cuerpo = None       # bytes JSON servidos tal cual
+        self.etag = None
+        self.modificada = None   # datetime (UTC, con zona) del último cambio de contenido
+        self.refrescada = 0.0    # time.time() del último refresco
+        self.http = None
+        self._en_vuelo = None
+
+    async def _consultar(self, fuente):
+        try:
+            datos = await fuente.consultar(self.http)
+            CONSULTAS_TASAS.inc(fuente=fuente.nombre, resultado="ok")
+            return fuente.nombre, datos, None
+        except Exception as e:
+            CONSULTAS_TASAS.inc(fuente=fuente.nombre, resultado="error")
+            logger.warning(f"Fuente de tasas {fuente.nombre} falló: {e}")
+            return fuente.nombre, None, str(e) or type(e).__name__
+
+    async def _refrescar(self):
+        if self.http is None: self.http = httpx.AsyncClient(timeout=TASAS_HTTP_TIMEOUT)
+        ahora = datetime.now(timezone.utc).replace(microsecond=0)
+        for nombre, datos, error in await asyncio.gather(*(self._consultar(f) for f in self.fuentes)):
+            if error is None:
+                anterior = self.valores.get(nombre)
+                if anterior is None or anterior["datos"] != datos:
+                    self.valores[nombre] = {"datos": datos, "actualizada": ahora.strftime("%Y-%m-%dT%H:%M:%SZ")}
+                self.errores.pop(nombre, None)
+            else:
+                self.errores[nombre] = error
+        contenido = {"fuentes": self.valores, "errores": self.errores, "intervalo": self.intervalo}
+        cuerpo = json.dumps(contenido, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        if cuerpo != self.cuerpo:
+            self.cuerpo = cuerpo
+            self.etag = etag_de("tasas", zlib.crc32(cuerpo), len(cuerpo))   # débil: gzip reescribe el cuerpo
+            self.modificada = ahora
+        self.refrescada = time.time()
+
+    async def refrescar(self):
+        """Single-flight: las llamadas concurrentes esperan la misma consulta"""
+        if self._en_vuelo is None:
+            self._en_vuelo = asyncio.ensure_future(self._refrescar())
+            self._en_vuelo.add_done_callback(lambda _: setattr(self, "_en_vuelo", None))
+        await asyncio.shield(self._en_vuelo)
+
+    async def obtener(self):
+        if self.cuerpo is None: await self.refrescar()
+        return self
+
+    async def ciclo(self):
+        while True:
+            try:
+                await self.refrescar()
+            except Exception as e:
+                logger.error(f"Error refrescando tasas: {e}")
+            await asyncio.sleep(self.intervalo)
+
+    async def cerrar(self):
+        if self.http is not None: await self.http.aclose(); self.http = None
+
+servicio_tasas = ServicioTasas()
+TASAS_REINTENTO_SEG = int(os.environ.get("TASAS_REINTENTO_SEG", 30))   # Retry-After del 503 sin datos
+
+def no_modificado(request: Request, etag: str, modificada: Optional[datetime]) -> bool:
+    """Evalúa If-None-Match (prioritario) e If-Modified-Since"""
+    if request.headers.get("if-none-match") is not None:
+        return coincide(request, etag)
+    si_modificado = request.headers.get("if-modified-since")
+    if si_modificado and modificada is not None:
+        try:
+            fecha = parsedate_to_datetime(si_modificado)
+            return modificada <= (fecha if fecha.tzinfo else fecha.replace(tzinfo=timezone.utc))
+        except (TypeError, ValueError):
+            return False
+    return False
+
+@app.get("/api/tasas")
+async def get_tasas(request: Request):
+    """BCV y Binance P2P (BUY/SELL con mejor precio, mediana, promedio ponderado y top-N), con ETag/Last-Modified"""
+    try:
+        servicio = await servicio_tasas.obtener()
+    except Exception as e:
+        logger.error(f"Error refrescando tasas: {e}")
+        servicio = servicio_tasas
+    if servicio.cuerpo is None or not servicio.valores:   # ninguna fuente ha respondido todavía
+        return RespuestaJSON({"detail": "Tasas no disponibles todavía", "errores": servicio.errores}, status_code=503,
+                             headers={"Retry-After": str(TASAS_REINTENTO_SEG), "Cache-Control": "no-store"})
+    restante = max(0, int(servicio.refrescada + servicio.intervalo - time.time()))
+    headers = {"ETag": servicio.etag, "Last-Modified": servicio.modificada.strftime("%a, %d %b %Y %H:%M:%S GMT"),
+               "Cache-Control": f"public, max-age={restante}"}
+    if no_modificado(request, servicio.etag, servicio.modificada):
+        return Response(status_code=304, headers=headers)
+    return Response(content=servicio.cuerpo, media_type="application/json", headers=headers)
 
 if __name__ == "__main__":
     import uvicorn
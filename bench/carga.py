@@ -0,0 +1,165 @@
+"""Pruebas de carga de punta a punta: levanta con uvicorn el servidor falso (Groq + BCV), la app de chat
+(main:app) y la API de arbitraje (arbitraje_api:app) en puertos locales y las somete a concurrencia fija.
+Nada sale a la red: Groq se redirige con GROQ_BASE_URL, la tasa con TASA_FUENTES_URLS y las fuentes de /api/tasas
+con BCV_URL y BINANCE_P2P_URL."""
+import asyncio
+import itertools
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from bench.comun import resumir
+from bench.micro import filas_operaciones
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ARRANQUE_MAX_SEG = 30
+LOTE_PRECARGA = 5000
+
+def puerto_libre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class Servidor:
+    """Proceso uvicorn hijo con su salida en `log`; se detiene al salir del bloque with"""
+
+    def __init__(self, modulo: str, env: dict, salud: str, log: str):
+        self.puerto = puerto_libre()
+        self.url = f"http://127.0.0.1:{self.puerto}"
+        self.modulo = modulo
+        self.env = {**os.environ, **env}
+        self.salud = salud
+        self.log = log
+        self.proceso = None
+        self.arranque = None   # segundos hasta que `salud` respondió
+
+    def _fallo(self, motivo: str):
+        with open(self.log, "r", encoding="utf-8", errors="replace") as f:
+            cola = "".join(f.readlines()[-20:])
+        return RuntimeError(f"{self.modulo} {motivo}\n{cola}")
+
+    def __enter__(self):
+        self.proceso = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", self.modulo, "--host", "127.0.0.1", "--port", str(self.puerto),
+             "--log-level", "warning", "--no-access-log"], cwd=RAIZ, env=self.env,
+            stdout=open(self.log, "w"), stderr=subprocess.STDOUT)
+        inicio = time.monotonic()
+        limite = inicio + ARRANQUE_MAX_SEG
+        while time.monotonic() < limite:
+            if self.proceso.poll() is not None:
+                raise self._fallo(f"terminó al arrancar (código {self.proceso.returncode})")
+            try:
+                if httpx.get(self.url + self.salud, timeout=1).status_code < 500:
+                    self.arranque = time.monotonic() - inicio
+                    return self
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.05)
+        self.__exit__()
+        raise self._fallo(f"no respondió en {ARRANQUE_MAX_SEG}s")
+
+    def __exit__(self, *exc):
+        if self.proceso and self.proceso.poll() is None:
+            self.proceso.terminate()
+            try:
+                self.proceso.wait(10)
+            except subprocess.TimeoutExpired:
+                self.proceso.kill()
+
+async def disparar(cliente: httpx.AsyncClient, peticion: dict):
+    if peticion.get("stream"):
+        async with cliente.stream(peticion["metodo"], peticion["url"], json=peticion.get("json"),
+                                  headers=peticion.get("headers")) as res:
+            async for _ in res.aiter_bytes(): pass
+            return res.status_code
+    res = await cliente.request(peticion["metodo"], peticion["url"], json=peticion.get("json"),
+                                headers=peticion.get("headers"))
+    return res.status_code
+
+async def escenario(generar, total: int, concurrencia: int, calentamiento: int = 20):
+    """Lanza `total` peticiones (generar(i) -> dict) con `concurrencia` trabajadores en paralelo"""
+    limites = httpx.Limits(max_connections=concurrencia, max_keepalive_connections=concurrencia)
+    async with httpx.AsyncClient(timeout=60, limits=limites) as cliente:
+        for i in range(min(calentamiento, total)):
+            await disparar(cliente, generar(-1 - i))
+        contador = itertools.count()
+        latencias, errores = [], [0]
+
+        async def trabajador():
+            while (i := next(contador)) < total:
+                t = time.perf_counter()
+                try:
+                    estado = await disparar(cliente, generar(i))
+                    if estado >= 400: errores[0] += 1
+                except httpx.HTTPError:
+                    errores[0] += 1
+                latencias.append(time.perf_counter() - t)
+
+        inicio = time.perf_counter()
+        await asyncio.gather(*(trabajador() for _ in range(concurrencia)))
+        return resumir(latencias, time.perf_counter() - inicio, errores[0])
+
+def escenarios_chat(url: str):
+    chat = f"{url}/chat/ferreteria"
+    bypass = {"X-Cache-Bypass": "1"}
+    return {
+        "chat.llm": lambda i: {"metodo": "POST", "url": chat, "headers": bypass,
+                               "json": {"mensaje": f"¿Qué me recomiendas para una reparación número {i}?"}},
+        "chat.cache": lambda i: {"metodo": "POST", "url": chat,
+                                 "json": {"mensaje": "¿Qué me recomiendas para pintar una pared?"}},
+        "chat.rapida": lambda i: {"metodo": "POST", "url": chat, "json": {"mensaje": "¿Cuál es el horario?"}},
+        "chat.stream": lambda i: {"metodo": "POST", "url": chat + "/stream", "headers": bypass, "stream": True,
+                                  "json": {"mensaje": f"Necesito cemento para la obra {i}"}},
+        "chat.config": lambda i: {"metodo": "GET", "url": f"{url}/config/ferreteria"},
+        "chat.tasa": lambda i: {"metodo": "GET", "url": f"{url}/tasa-bcv"},
+    }
+
+def escenarios_arbitraje(url: str, filas: int):
+    ops = f"{url}/api/operaciones"
+    return {
+        "arbitraje.pagina": lambda i: {"metodo": "GET", "url": f"{ops}?user=inversor{i % 50:02d}&limit=50"},
+        "arbitraje.insertar": lambda i: {"metodo": "POST", "url": ops, "json": {
+            "id": filas + 1_000_000 + i, "fecha": "2025-06-01", "etapa": 1, "inv": "inversor00",
+            "miBs": 1000, "miUsd": 20, "resultBs": 1000, "resultUsd": 20}},
+        "arbitraje.stats": lambda i: {"metodo": "GET", "url": f"{ops}/stats?agrupar=mes"},
+        "arbitraje.sesion": lambda i: {"metodo": "PUT", "url": f"{url}/api/sesiones/usuario{i % 200}"},
+    }
+
+def precargar(url: str, filas: int):
+    generador = filas_operaciones(filas)
+    columnas = ("id", "fecha", "etapa", "inv", "miBs", "miUsd", "resultBs", "resultUsd", "tipo")
+    for desde in range(0, filas, LOTE_PRECARGA):
+        lote = [dict(zip(columnas, next(generador))) for _ in range(min(LOTE_PRECARGA, filas - desde))]
+        # filas sintéticas (montos al azar): se cargan sin validar
+        httpx.post(f"{url}/api/operaciones/bulk?validar=false", json=lote, timeout=120).raise_for_status()
+
+def ejecutar(total: int = 2000, concurrencia: int = 32, filas: int = 10000):
+    """Corre todos los escenarios de carga y devuelve {nombre: resumen}"""
+    directorio = tempfile.mkdtemp(prefix="bench_carga_")
+    resultados = {}
+    try:
+        with Servidor("bench.falsos:app", {}, "/contadores", os.path.join(directorio, "falsos.log")) as falso:
+            env_chat = {"GROQ_API_KEY": "falsa", "GROQ_BASE_URL": falso.url, "GROQ_MAX_RETRIES": "0",
+                        "TASA_FUENTES_URLS": f"falso={falso.url}/bcv", "RATE_POR_SEG": "1000000",
+                        "RATE_RAFAGA": "1000000", "LLM_COLA_MAX": str(concurrencia * 4),
+                        "CATALOGO_DB": os.path.join(directorio, "catalogo.db")}
+            with Servidor("main:app", env_chat, "/salud/listo", os.path.join(directorio, "chat.log")) as chat:
+                resultados["carga.arranque.chat"] = resumir([chat.arranque], chat.arranque)
+                for nombre, generar in escenarios_chat(chat.url).items():
+                    resultados[f"carga.{nombre}"] = asyncio.run(escenario(generar, total, concurrencia))
+            env_api = {"DB_PATH": os.path.join(directorio, "arbitraje.db"),
+                       "BCV_URL": f"{falso.url}/bcv", "BINANCE_P2P_URL": f"{falso.url}/p2p"}
+            with Servidor("arbitraje_api:app", env_api, "/salud/listo", os.path.join(directorio, "arbitraje.log")) as api:
+                resultados["carga.arranque.arbitraje"] = resumir([api.arranque], api.arranque)
+                precargar(api.url, filas)
+                for nombre, generar in escenarios_arbitraje(api.url, filas).items():
+                    resultados[f"carga.{nombre}"] = asyncio.run(escenario(generar, total, concurrencia))
+    finally:
+        shutil.rmtree(directorio, ignore_errors=True)
+    return resultados
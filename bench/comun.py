@@ -0,0 +1,76 @@
+"""Utilidades compartidas por los benchmarks: percentiles, reporte y comparación contra un baseline"""
+import json
+import os
+import platform
+import sys
+import time
+from typing import Callable, Dict, List
+
+# Métricas donde un valor más alto es mejor; en el resto (latencias) más bajo es mejor
+MAYOR_ES_MEJOR = {"ops_s"}
+
+def percentil(ordenadas: List[float], p: float) -> float:
+    """Percentil por interpolación lineal sobre una lista ya ordenada"""
+    if not ordenadas: return 0.0
+    k = (len(ordenadas) - 1) * p / 100
+    i = int(k)
+    if i + 1 >= len(ordenadas): return ordenadas[-1]
+    return ordenadas[i] + (ordenadas[i + 1] - ordenadas[i]) * (k - i)
+
+def resumir(latencias: List[float], duracion: float, errores: int = 0, operaciones: int = None) -> Dict:
+    """Latencias en segundos -> {n, ops_s, p50_ms, p95_ms, p99_ms, max_ms, errores}.
+    `operaciones` permite contar filas cuando cada medición cubre un lote."""
+    ordenadas = sorted(latencias)
+    n = len(ordenadas)
+    return {"n": n, "errores": errores,
+            "ops_s": round((operaciones if operaciones is not None else n) / duracion, 1) if duracion else 0.0,
+            "p50_ms": round(percentil(ordenadas, 50) * 1000, 4),
+            "p95_ms": round(percentil(ordenadas, 95) * 1000, 4),
+            "p99_ms": round(percentil(ordenadas, 99) * 1000, 4),
+            "max_ms": round(ordenadas[-1] * 1000, 4) if n else 0.0}
+
+def medir(fn: Callable, repeticiones: int, calentamiento: int = 10) -> Dict:
+    """Ejecuta fn() `repeticiones` veces midiendo cada llamada con perf_counter"""
+    for _ in range(calentamiento): fn()
+    latencias = []
+    inicio = time.perf_counter()
+    for _ in range(repeticiones):
+        t = time.perf_counter()
+        fn()
+        latencias.append(time.perf_counter() - t)
+    return resumir(latencias, time.perf_counter() - inicio)
+
+def entorno() -> Dict:
+    import sqlite3
+    return {"python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+            "plataforma": platform.platform(), "cpus": os.cpu_count()}
+
+def imprimir(resultados: Dict[str, Dict], salida=sys.stdout):
+    ancho = max((len(n) for n in resultados), default=10)
+    print(f"{'benchmark':<{ancho}}  {'n':>8}  {'ops/s':>12}  {'p50 ms':>10}  {'p95 ms':>10}  {'p99 ms':>10}  {'err':>5}",
+          file=salida)
+    for nombre, r in resultados.items():
+        print(f"{nombre:<{ancho}}  {r['n']:>8}  {r['ops_s']:>12.1f}  {r['p50_ms']:>10.3f}  {r['p95_ms']:>10.3f}"
+              f"  {r['p99_ms']:>10.3f}  {r['errores']:>5}", file=salida)
+
+def guardar(ruta: str, resultados: Dict[str, Dict]):
+    with open(ruta, "w", encoding="utf-8") as f:
+        json.dump({"entorno": entorno(), "resultados": resultados}, f, indent=2, ensure_ascii=False)
+
+def comparar(resultados: Dict[str, Dict], ruta_baseline: str, tolerancia: float) -> List[str]:
+    """Compara contra el baseline guardado y devuelve las regresiones mayores a `tolerancia` (0.2 = 20 %).
+    Solo se comparan ops_s y p95_ms, los benchmarks nuevos o ausentes se ignoran."""
+    with open(ruta_baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)["resultados"]
+    regresiones = []
+    for nombre, actual in resultados.items():
+        previo = baseline.get(nombre)
+        if not previo: continue
+        for metrica in ("ops_s", "p95_ms"):
+            antes, ahora = previo.get(metrica), actual.get(metrica)
+            if not antes or ahora is None: continue
+            cambio = (ahora - antes) / antes
+            peor = -cambio if metrica in MAYOR_ES_MEJOR else cambio
+            if peor > tolerancia:
+                regresiones.append(f"{nombre} {metrica}: {antes} -> {ahora} ({cambio:+.0%})")
+    return regresiones
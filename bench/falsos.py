@@ -0,0 +1,66 @@
+"""Servidor falso de Groq (API compatible con OpenAI), de la tasa BCV y de Binance P2P para las pruebas de carga.
+Latencia simulada por variables de entorno:
+    FALSO_LATENCIA_MS    espera antes de responder (default 80)
+    FALSO_TOKENS         trozos emitidos en modo stream (default 20)
+    FALSO_TOKEN_MS       pausa entre trozos del stream (default 5)
+Uso: uvicorn bench.falsos:app --port 9100"""
+import asyncio
+import json
+import os
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+LATENCIA_MS = float(os.environ.get("FALSO_LATENCIA_MS", 80))
+TOKENS = int(os.environ.get("FALSO_TOKENS", 20))
+TOKEN_MS = float(os.environ.get("FALSO_TOKEN_MS", 5))
+RESPUESTA = "¡Hola! Con gusto te ayudo. Ese producto está disponible, ¿quieres que te lo aparte?"
+
+app = FastAPI(title="Groq/BCV/P2P falsos")
+contadores = {"completions": 0, "bcv": 0, "p2p": 0}
+
+def trozo(modelo: str, texto: str = None, fin: str = None) -> str:
+    delta = {"content": texto} if texto is not None else {}
+    datos = {"id": "chatcmpl-falso", "object": "chat.completion.chunk", "created": int(time.time()), "model": modelo,
+             "choices": [{"index": 0, "delta": delta, "finish_reason": fin}]}
+    return f"data: {json.dumps(datos)}\n\n"
+
+@app.post("/openai/v1/chat/completions")
+async def completions(request: Request):
+    cuerpo = await request.json()
+    contadores["completions"] += 1
+    modelo = cuerpo.get("model", "falso")
+    await asyncio.sleep(LATENCIA_MS / 1000)
+    if cuerpo.get("stream"):
+        async def generar():
+            palabras = RESPUESTA.split(" ")
+            por_trozo = max(1, len(palabras) // max(TOKENS, 1))
+            for i in range(0, len(palabras), por_trozo):
+                yield trozo(modelo, " ".join(palabras[i:i + por_trozo]) + " ")
+                await asyncio.sleep(TOKEN_MS / 1000)
+            yield trozo(modelo, fin="stop")
+            yield "data: [DONE]\n\n"
+        return StreamingResponse(generar(), media_type="text/event-stream")
+    tokens_prompt = sum(len(str(m.get("content", ""))) for m in cuerpo.get("messages", [])) // 4
+    return {"id": "chatcmpl-falso", "object": "chat.completion", "created": int(time.time()), "model": modelo,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": RESPUESTA}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": tokens_prompt, "completion_tokens": 25, "total_tokens": tokens_prompt + 25}}
+
+@app.get("/bcv")
+async def bcv():
+    contadores["bcv"] += 1
+    return {"fuente": "falso", "price": 45.5}
+
+@app.post("/p2p")
+async def p2p(request: Request):
+    cuerpo = await request.json()
+    contadores["p2p"] += 1
+    base = 47.0 if cuerpo.get("tradeType") == "SELL" else 46.5
+    return {"data": [{"adv": {"price": str(round(base + i * 0.05, 2)), "surplusAmount": "500",
+                              "minSingleTransAmount": "10", "maxSingleTransAmount": "1000"},
+                      "advertiser": {"nickName": f"falso{i}"}} for i in range(int(cuerpo.get("rows", 10)))]}
+
+@app.get("/contadores")
+async def get_contadores():
+    return contadores
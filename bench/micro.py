@@ -0,0 +1,127 @@
+"""Micro-benchmarks en proceso: prompts por tienda/asesor, carga de configuración, disparadores de
+WhatsApp y SQLite (inserción y consultas) a distintas escalas de filas.
+
+Se importan los módulos reales (main, arbitraje_api); la base de datos se crea en un directorio temporal."""
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from bench.comun import medir, resumir
+
+TIPOS = ("Compra BDV", "Transferencia Binance", "Venta P2P")
+USUARIOS = [f"inversor{i:02d}" for i in range(50)]
+LOTE_INSERCION = 1000
+
+ASESORES = {"multikap": ("motos", "papeleria", "hogar")}
+
+MENSAJES_WHATSAPP = [
+    ("Hola, ¿tienen tornillos de 1/4?", "Sí, tenemos tornillos galvanizados a $0.10 la unidad."),
+    ("Quiero comprar 3 cajas de cerámica", "Perfecto, el total sería $45. ¿Te lo apartamos?"),
+    ("¿Cuál es el horario?", "Abrimos de lunes a sábado de 8am a 6pm."),
+    ("Necesito hacer un pedido grande para mi obra", "Con gusto, podemos coordinar el despacho."),
+]
+
+def bench_prompts(main, resultados, repeticiones):
+    tasa = 45.0
+    for store_id in main.registro_tiendas.ids():
+        info = main.cargar_config_tienda(store_id)
+        for advisor in ASESORES.get(store_id, ("default",)):
+            def frio():
+                fragmentos = main.FragmentosPrompt(info)
+                fragmentos.completar(main.construir_prompt(store_id, info, tasa, advisor, fragmentos), "precio del martillo")
+            resultados[f"prompt.frio.{store_id}.{advisor}"] = medir(frio, repeticiones)
+            resultados[f"prompt.cache.{store_id}.{advisor}"] = medir(
+                lambda: main.generar_prompt_segun_tienda(store_id, info, tasa, advisor, "precio del martillo"), repeticiones)
+
+def bench_config(main, resultados, repeticiones):
+    ids = main.registro_tiendas.ids()
+    def lectura_disco():
+        registro = main.RegistroTiendas()
+        registro.cargar_todas()
+    resultados["config.cargar_todas"] = medir(lectura_disco, max(repeticiones // 20, 20), calentamiento=2)
+    resultados["config.memoria"] = medir(lambda: [main.cargar_config_tienda(s) for s in ids], repeticiones)
+
+def bench_whatsapp(main, resultados, repeticiones):
+    resultados["whatsapp.disparadores"] = medir(
+        lambda: [main.debe_mostrar_whatsapp(m, r) for m, r in MENSAJES_WHATSAPP], repeticiones * 10)
+
+def filas_operaciones(n, inicio_id=1, semilla=42):
+    azar = random.Random(semilla)
+    for i in range(inicio_id, inicio_id + n):
+        etapa = azar.randint(1, 3)
+        bs = round(azar.uniform(100, 50000), 2)
+        tasa = azar.uniform(40, 60)
+        usd = round(bs / tasa, 2)
+        yield (i, f"2025-{azar.randint(1, 12):02d}-{azar.randint(1, 28):02d}", etapa, azar.choice(USUARIOS),
+               bs, usd, round(bs * azar.uniform(0.97, 1.05), 2), round(usd * azar.uniform(0.97, 1.05), 2), TIPOS[etapa - 1])
+
+def peticion_vacia():
+    """Request sin cabeceras condicionales para invocar los endpoints directamente (siempre responde 200)"""
+    from fastapi import Request
+    return Request({"type": "http", "method": "GET", "scheme": "http", "server": ("bench", 80), "path": "/",
+                    "query_string": b"", "headers": []})
+
+def bench_sqlite(api, resultados, filas, repeticiones):
+    directorio = tempfile.mkdtemp(prefix="bench_sqlite_")
+    pool_original = api.pool
+    api.pool = api.PoolSQLite(os.path.join(directorio, "bench.db"))
+    try:
+        api.init_db()
+        generador = filas_operaciones(filas)
+        latencias, inicio = [], time.perf_counter()
+        for desde in range(0, filas, LOTE_INSERCION):
+            lote = [next(generador) for _ in range(min(LOTE_INSERCION, filas - desde))]
+            t = time.perf_counter()
+            with api.get_db("bench") as conn:
+                conn.executemany(api.SQL_INSERT_OPERACION, lote)
+            latencias.append(time.perf_counter() - t)
+        resultados[f"sqlite.{filas}.insertar_lote_{LOTE_INSERCION}"] = resumir(
+            latencias, time.perf_counter() - inicio, operaciones=filas)
+
+        siguiente_id = [filas + 1]
+        def insertar_una():
+            op = api.Operacion(id=siguiente_id[0], fecha="2025-06-01", etapa=1, inv="inversor00",
+                               miBs=1000, miUsd=20, resultBs=1000, resultUsd=20)
+            siguiente_id[0] += 1
+            api.save_operacion(op)
+        resultados[f"sqlite.{filas}.insertar_una"] = medir(insertar_una, repeticiones)
+
+        def listar(**filtros):
+            parametros = dict(user=None, admin=False, cursor=None, limit=50, desde=None, hasta=None,
+                              etapa=None, tipo=None, campos=None)
+            parametros.update(filtros)
+            return lambda: api.get_operaciones(peticion_vacia(), **parametros)
+        resultados[f"sqlite.{filas}.pagina_usuario"] = medir(listar(user="inversor07"), repeticiones)
+        resultados[f"sqlite.{filas}.pagina_profunda"] = medir(listar(user="inversor07", cursor=filas // 2), repeticiones)
+        resultados[f"sqlite.{filas}.pagina_rango_fechas"] = medir(
+            listar(admin=True, desde="2025-03-01", hasta="2025-03-31"), repeticiones)
+        resultados[f"sqlite.{filas}.stats_inv"] = medir(
+            lambda: api.get_stats(peticion_vacia(), agrupar="inv", user=None, desde=None, hasta=None, etapa=None, tipo=None), repeticiones)
+        resultados[f"sqlite.{filas}.stats_mes_usuario"] = medir(
+            lambda: api.get_stats(peticion_vacia(), agrupar="mes", user="inversor07", desde=None, hasta=None, etapa=None, tipo=None),
+            repeticiones)
+    finally:
+        api.pool.cerrar()
+        api.pool = pool_original
+        shutil.rmtree(directorio, ignore_errors=True)
+
+def ejecutar(escalas=(10000, 100000), repeticiones=500):
+    """Corre todos los micro-benchmarks y devuelve {nombre: resumen}"""
+    directorio = tempfile.mkdtemp(prefix="bench_micro_")
+    os.environ.setdefault("DB_PATH", os.path.join(directorio, "arbitraje.db"))
+    os.environ.setdefault("CATALOGO_DB", os.path.join(directorio, "catalogo.db"))
+    import main
+    import arbitraje_api
+    resultados = {}
+    try:
+        main.registro_tiendas.cargar_todas()
+        bench_prompts(main, resultados, repeticiones)
+        bench_config(main, resultados, repeticiones)
+        bench_whatsapp(main, resultados, repeticiones)
+        for filas in escalas:
+            bench_sqlite(arbitraje_api, resultados, filas, repeticiones)
+    finally:
+        shutil.rmtree(directorio, ignore_errors=True)
+    return resultados
@@ -0,0 +1,54 @@
+"""Suite de benchmarks reproducible (sin red ni claves reales).
+
+    python -m bench.run micro                       # micro-benchmarks, SQLite a 10k y 100k filas
+    python -m bench.run micro --filas 10000,100000,1000000
+    python -m bench.run carga --total 2000 --concurrencia 32
+    python -m bench.run todo --guardar bench/baseline.json       # fija un baseline
+    python -m bench.run todo --baseline bench/baseline.json      # compara; sale con 1 si hay regresiones
+
+Se reporta n, ops/s y p50/p95/p99 (ms) por benchmark. Las regresiones se evalúan sobre ops/s y p95
+con la tolerancia dada (0.2 = 20 %). El baseline depende de la máquina: genéralo en la misma donde se compara."""
+import argparse
+import logging
+import sys
+
+from bench import comun
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.run", description="Benchmarks de chat y arbitraje")
+    parser.add_argument("suite", choices=("micro", "carga", "todo"))
+    parser.add_argument("--filas", default="10000,100000", help="escalas SQLite del micro-benchmark, separadas por coma")
+    parser.add_argument("--repeticiones", type=int, default=500, help="llamadas por micro-benchmark")
+    parser.add_argument("--total", type=int, default=2000, help="peticiones por escenario de carga")
+    parser.add_argument("--concurrencia", type=int, default=32)
+    parser.add_argument("--filas-carga", type=int, default=10000, help="operaciones precargadas en la API de arbitraje")
+    parser.add_argument("--baseline", help="JSON de un baseline previo contra el cual comparar")
+    parser.add_argument("--tolerancia", type=float, default=0.2)
+    parser.add_argument("--guardar", help="ruta donde guardar los resultados como nuevo baseline")
+    args = parser.parse_args(argv)
+    logging.disable(logging.INFO)   # los logs INFO de las apps ensucian el reporte
+
+    resultados = {}
+    if args.suite in ("micro", "todo"):
+        from bench import micro
+        escalas = [int(f) for f in args.filas.split(",") if f.strip()]
+        resultados.update(micro.ejecutar(escalas, args.repeticiones))
+    if args.suite in ("carga", "todo"):
+        from bench import carga
+        resultados.update(carga.ejecutar(args.total, args.concurrencia, args.filas_carga))
+
+    comun.imprimir(resultados)
+    if args.guardar:
+        comun.guardar(args.guardar, resultados)
+        print(f"\nBaseline guardado en {args.guardar}")
+    if args.baseline:
+        regresiones = comun.comparar(resultados, args.baseline, args.tolerancia)
+        if regresiones:
+            print(f"\nRegresiones (> {args.tolerancia:.0%}):")
+            for r in regresiones: print(f"  {r}")
+            return 1
+        print(f"\nSin regresiones respecto a {args.baseline}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,61 @@
+"""Caché HTTP compartida por ambas apps: ETags, GET condicionales (304), compresión y JSON rápido.
+
+Uso:
+    from cache_http import comprimir, etag_de, respuesta_condicional
+    comprimir(app)                                          # gzip para respuestas > COMPRESION_MIN_BYTES
+    etag = etag_de("config", store_id, version)
+    return respuesta_condicional(request, etag, lambda: datos, "public, no-cache")
+
+orjson es opcional: si está instalado se usa para serializar, si no se recurre a json."""
+import hashlib
+import json
+import os
+from typing import Callable, Optional
+
+from fastapi import Request, Response
+from starlette.middleware.gzip import GZipMiddleware
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depende del entorno
+    orjson = None
+
+COMPRESION_MIN_BYTES = int(os.environ.get("COMPRESION_MIN_BYTES", 1024))
+
+def json_bytes(datos) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(datos, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(datos, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class RespuestaJSON(Response):
+    """JSONResponse serializada con orjson cuando está disponible"""
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return json_bytes(content)
+
+def etag_de(*partes) -> str:
+    """ETag débil derivado de los validadores (versiones, contadores, marcas de tiempo) y no del cuerpo:
+    así un acierto no requiere construir ni serializar la respuesta. Débil porque gzip cambia los bytes."""
+    resumen = hashlib.blake2b(repr(partes).encode("utf-8"), digest_size=8).hexdigest()
+    return f'W/"{resumen}"'
+
+def coincide(request: Request, etag: str) -> bool:
+    """Comparación débil de If-None-Match (RFC 9110 §13.1.2)"""
+    cabecera = request.headers.get("if-none-match")
+    if not cabecera: return False
+    if cabecera.strip() == "*": return True
+    propia = etag[2:] if etag.startswith("W/") else etag
+    return any((e.strip()[2:] if e.strip().startswith("W/") else e.strip()) == propia for e in cabecera.split(","))
+
+def respuesta_condicional(request: Request, etag: str, generar: Callable, cache_control: str,
+                          headers: Optional[dict] = None) -> Response:
+    """304 sin cuerpo si el cliente ya tiene `etag`; si no, llama a generar() y responde JSON"""
+    cabeceras = {"ETag": etag, "Cache-Control": cache_control, **(headers or {})}
+    if coincide(request, etag):
+        return Response(status_code=304, headers=cabeceras)
+    return RespuestaJSON(generar(), headers=cabeceras)
+
+def comprimir(app, minimo: int = COMPRESION_MIN_BYTES):
+    """gzip para respuestas mayores a `minimo` bytes (SSE y cuerpos ya comprimidos se dejan intactos)"""
+    app.add_middleware(GZipMiddleware, minimum_size=minimo)
@@ -0,0 +1,35 @@
+"""Lanzador de producción para ambas apps: gunicorn como maestro y workers uvicorn.
+
+    gunicorn -c gunicorn.conf.py main:app             # chat multi-tienda
+    gunicorn -c gunicorn.conf.py arbitraje_api:app    # ArbitrajePro
+
+Con preload_app la app se importa una sola vez en el maestro y on_starting llama a `preparar()` del módulo
+(migraciones, carga de tiendas, calentado de prompts) antes del fork: los workers heredan ese trabajo
+(copy-on-write) en vez de repetirlo. uvloop y httptools se usan si están instalados (uvicorn[standard]).
+
+Variables: PORT, WEB_CONCURRENCY (workers; por defecto uno por núcleo), GUNICORN_TIMEOUT, GUNICORN_KEEPALIVE.
+Un módulo puede acotar sus workers con WORKERS_MAX (ver arbitraje_api)."""
+import importlib
+import importlib.util
+import os
+import time
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+worker_class = "uvicorn.workers.UvicornWorker"   # loop/http "auto": uvloop y httptools cuando existen
+preload_app = True
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))       # respuestas en streaming del LLM
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+
+def on_starting(server):
+    modulo = importlib.import_module(server.app.app_uri.split(":")[0])
+    inicio = time.perf_counter()
+    if hasattr(modulo, "preparar"): modulo.preparar()
+    tope = getattr(modulo, "WORKERS_MAX", None)
+    if tope and server.num_workers > tope:
+        server.log.warning(f"{modulo.__name__} admite hasta {tope} worker(s) (WORKERS_MAX); se ignoran los demás")
+        server.num_workers = tope
+    extras = [m for m in ("uvloop", "httptools") if importlib.util.find_spec(m)]
+    server.log.info(f"{modulo.__name__} preparado en {time.perf_counter() - inicio:.2f}s antes del fork; "
+                    f"{server.num_workers} worker(s), {' + '.join(extras) or 'asyncio + h11'}")
@@ -1,17 +1,46 @@
 import os
 import logging
-import requests
 import json
-from fastapi import FastAPI, HTTPException
+import asyncio
+import hashlib
+import sqlite3
+import heapq
+import math
+import re
+import unicodedata
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from groq import Groq
-from datetime import datetime, timedelta
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field
+import httpx
+import metricas
+from metricas import span, instrumentar
+from cache_http import RespuestaJSON, comprimir, etag_de, respuesta_condicional
+from collections import OrderedDict, deque
+from datetime import datetime
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Sistema Multi-Tienda con IA Especializada", version="9.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    preparar()
+    clientes.abrir()
+    cache_respuestas.abrir()
+    refresco_tasa = asyncio.create_task(servicio_tasa.ciclo())
+    vigilancia = asyncio.create_task(registro_tiendas.vigilar())
+    yield
+    refresco_tasa.cancel()
+    vigilancia.cancel()
+    await clientes.cerrar()
+    cache_respuestas.cerrar()
+    if registro_tiendas.catalogo is not None: registro_tiendas.catalogo.cerrar()
+
+app = FastAPI(title="Sistema Multi-Tienda con IA Especializada", version="9.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -20,41 +49,483 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+comprimir(app)
+instrumentar(app, "chat")
 
 # ========== CONFIGURACIÓN POR TIENDA ==========
+TIENDAS_DIR = os.environ.get("TIENDAS_DIR", os.path.dirname(os.path.abspath(__file__)))
+CONFIG_CHECK_SEG = float(os.environ.get("CONFIG_CHECK_SEG", 2))
+ADMIN_PASSWORD = os.environ.get("ADMIN_PASSWORD")
+
+class ItemCatalogo(BaseModel):
+    model_config = ConfigDict(extra="allow")
+    nombre: str
+    precio: float
+    emoji: Optional[str] = None
+    detalles: Optional[str] = None
+    descripcion: Optional[str] = None
+    marcas_compatibles: List[str] = []
+    modelos_compatibles: List[str] = []
+    especificaciones: Optional[str] = None
+    stock: Optional[int] = None
+    categoria: Optional[str] = None
+
+class ConfigTienda(BaseModel):
+    model_config = ConfigDict(extra="allow")
+    nombre_tienda: str
+    tipo: Optional[str] = None
+    contacto_whatsapp: Optional[str] = None
+    horario: Optional[str] = None
+    ubicacion: Optional[str] = None
+    envios: Optional[str] = None
+    metodos_pago: Optional[str] = None
+    preguntas_frecuentes: Optional[str] = None
+
+    def catalogos(self) -> Dict[str, List[ItemCatalogo]]:
+        """Listas `catalogo_*` de la tienda validadas como ItemCatalogo"""
+        return {k: [ItemCatalogo.model_validate(i) for i in v]
+                for k, v in (self.model_extra or {}).items() if k.startswith("catalogo_")}
+
+CATALOGO_DB = os.environ.get("CATALOGO_DB", os.path.join(TIENDAS_DIR, "catalogo.db"))   # "" = solo JSON
+
+def es_catalogo(clave: str, valor) -> bool:
+    return clave.startswith("catalogo_") and isinstance(valor, list)
+
+def sku_item(catalogo: str, item: dict, usados: set) -> str:
+    """SKU explícito del ítem o uno derivado de catálogo + nombre (único dentro de la tienda)"""
+    base = str(item.get("sku") or "-".join([catalogo[len("catalogo_"):]] + palabras(str(item.get("nombre", "item")))))
+    sku, n = base, 2
+    while sku in usados: sku, n = f"{base}-{n}", n + 1
+    usados.add(sku)
+    return sku
+
+class CatalogoSQLite:
+    """Catálogos de todas las tiendas en SQLite: una fila por ítem (tienda, SKU) indexada por tienda y catálogo.
+    Los JSON del directorio son la vía de importación; precio y stock se parchean por SKU.
+    Cada cambio sube `revision` de la tienda, así los demás workers aplican solo los ítems modificados."""
+
+    def __init__(self, ruta: str = CATALOGO_DB):
+        self.ruta = ruta
+        self._db = None
+        self._lock = threading.Lock()
+
+    def abrir(self):
+        if self._db is not None: return
+        self._db = sqlite3.connect(self.ruta, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS tiendas (store_id TEXT PRIMARY KEY, datos TEXT NOT NULL,
+                            huella TEXT NOT NULL, revision INTEGER NOT NULL) WITHOUT ROWID""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS items (store_id TEXT NOT NULL, sku TEXT NOT NULL,
+                            catalogo TEXT NOT NULL, posicion INTEGER NOT NULL, nombre TEXT, precio REAL, stock INTEGER,
+                            datos TEXT NOT NULL, revision INTEGER NOT NULL, PRIMARY KEY (store_id, sku)) WITHOUT ROWID""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_items_catalogo ON items (store_id, catalogo, posicion)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_items_revision ON items (store_id, revision)")
+        self._db.commit()
+
+    def cerrar(self):
+        if self._db is not None: self._db.close(); self._db = None
+
+    def _conexion(self):
+        if self._db is None: self.abrir()
+        return self._db
+
+    def ids(self) -> List[str]:
+        with self._lock:
+            return [r[0] for r in self._conexion().execute("SELECT store_id FROM tiendas ORDER BY store_id")]
+
+    def estado(self, store_id: str):
+        """(huella, revision) de la tienda o None"""
+        with self._lock:
+            return self._conexion().execute("SELECT huella, revision FROM tiendas WHERE store_id = ?", (store_id,)).fetchone()
+
+    def importar(self, store_id: str, datos: dict, huella: str, forzar: bool = False) -> bool:
+        """Reemplaza los ítems de la tienda por los del JSON; no hace nada si ese mismo JSON ya fue importado"""
+        with self._lock:
+            conn = self._conexion()
+            previa = conn.execute("SELECT huella, revision FROM tiendas WHERE store_id = ?", (store_id,)).fetchone()
+            if previa and previa[0] == huella and not forzar: return False
+            revision = (previa[1] if previa else 0) + 1
+            base, filas, usados = {}, [], set()
+            for clave, valor in datos.items():
+                if not es_catalogo(clave, valor):
+                    base[clave] = valor; continue
+                base[clave] = []   # conserva el orden de las claves; los ítems viven en `items`
+                for posicion, item in enumerate(valor):
+                    filas.append((store_id, sku_item(clave, item, usados), clave, posicion, item.get("nombre"),
+                                  item.get("precio"), item.get("stock"), json.dumps(item, ensure_ascii=False), revision))
+            try:
+                conn.execute("DELETE FROM items WHERE store_id = ?", (store_id,))
+                conn.executemany("INSERT INTO items VALUES (?,?,?,?,?,?,?,?,?)", filas)
+                conn.execute("INSERT OR REPLACE INTO tiendas VALUES (?,?,?,?)",
+                             (store_id, json.dumps(base, ensure_ascii=False), huella, revision))
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback(); raise
+            logger.info(f"Catálogo importado: {store_id} ({len(filas)} ítems, revisión {revision})")
+            return True
+
+    def cargar(self, store_id: str):
+        """(datos completos, huella, revision) o None si la tienda no existe"""
+        with self._lock:
+            conn = self._conexion()
+            fila = conn.execute("SELECT datos, huella, revision FROM tiendas WHERE store_id = ?", (store_id,)).fetchone()
+            if fila is None: return None
+            datos = json.loads(fila[0])
+            for catalogo, item in conn.execute(
+                    "SELECT catalogo, datos FROM items WHERE store_id = ? ORDER BY catalogo, posicion", (store_id,)):
+                datos.setdefault(catalogo, []).append(json.loads(item))
+            return datos, fila[1], fila[2]
+
+    def cambios_desde(self, store_id: str, revision: int):
+        """Ítems modificados después de `revision`: [(catalogo, posicion, item)]"""
+        with self._lock:
+            filas = self._conexion().execute(
+                "SELECT catalogo, posicion, datos FROM items WHERE store_id = ? AND revision > ?", (store_id, revision)).fetchall()
+        return [(c, p, json.loads(d)) for c, p, d in filas]
+
+    def listar(self, store_id: str, catalogo: Optional[str] = None, limite: int = 100, desde_sku: Optional[str] = None):
+        sql = "SELECT sku, catalogo, posicion, nombre, precio, stock FROM items WHERE store_id = ?"
+        params = [store_id]
+        if catalogo: sql += " AND catalogo = ?"; params.append(catalogo)
+        if desde_sku: sql += " AND sku > ?"; params.append(desde_sku)
+        sql += " ORDER BY sku LIMIT ?"; params.append(limite)
+        columnas = ("sku", "catalogo", "posicion", "nombre", "precio", "stock")
+        with self._lock:
+            return [dict(zip(columnas, f)) for f in self._conexion().execute(sql, params)]
+
+    def parchear(self, store_id: str, parches: List[tuple]):
+        """Aplica [(sku, {"precio": .., "stock": ..})] en una transacción.
+        Devuelve (revision, [(sku, catalogo, posicion, item)]); KeyError si falta un SKU, ValueError si el ítem queda inválido."""
+        with self._lock:
+            conn = self._conexion()
+            fila = conn.execute("SELECT revision FROM tiendas WHERE store_id = ?", (store_id,)).fetchone()
+            if fila is None: raise KeyError(store_id)
+            revision = fila[0] + 1
+            aplicados = []
+            try:
+                for sku, cambios in parches:
+                    actual = conn.execute("SELECT catalogo, posicion, datos FROM items WHERE store_id = ? AND sku = ?",
+                                          (store_id, sku)).fetchone()
+                    if actual is None: raise KeyError(sku)
+                    item = {**json.loads(actual[2]), **cambios}
+                    ItemCatalogo.model_validate(item)
+                    conn.execute("UPDATE items SET precio = ?, stock = ?, datos = ?, revision = ? WHERE store_id = ? AND sku = ?",
+                                 (item.get("precio"), item.get("stock"), json.dumps(item, ensure_ascii=False), revision,
+                                  store_id, sku))
+                    aplicados.append((sku, actual[0], actual[1], item))
+                conn.execute("UPDATE tiendas SET revision = ? WHERE store_id = ?", (revision, store_id))
+                conn.commit()
+            except Exception:
+                conn.rollback(); raise
+            return revision, aplicados
+
+class RegistroTiendas:
+    """Configuraciones de tienda validadas y servidas desde memoria.
+    Con catálogo SQLite, los JSON se importan al arrancar o cuando cambia su contenido, y los parches por SKU
+    (propios o hechos por otro worker, detectados por `revision`) se aplican ítem a ítem sin recargar la tienda.
+    Se revisan cada CONFIG_CHECK_SEG desde la tarea `vigilar`; /admin/recargar-config fuerza la relectura.
+    La memoria solo se modifica en el event loop (o al arrancar); la E/S de recarga y parches va a hilos."""
+
+    def __init__(self, directorio: str = TIENDAS_DIR, catalogo: Optional[CatalogoSQLite] = None):
+        self.directorio = directorio
+        self.catalogo = catalogo
+        self._tiendas = {}   # store_id -> {"datos", "modelo", "mtime", "huella", "revision", "version"}
+        self.cargado = False
+        self._lock = threading.Lock()
+
+    def _ruta(self, store_id: str):
+        return os.path.join(self.directorio, f"{store_id}.json")
+
+    def _registrar(self, store_id: str, datos: dict, mtime, huella: str, revision: int = 0):
+        modelo = ConfigTienda.model_validate(datos)
+        modelo.catalogos()
+        anterior = self._tiendas.get(store_id)
+        self._tiendas[store_id] = {"datos": datos, "modelo": modelo, "mtime": mtime,
+                                   "huella": huella, "revision": revision,
+                                   "version": (anterior["version"] + 1) if anterior else 1}
+        logger.info(f"Configuración cargada: {store_id} (v{self._tiendas[store_id]['version']})")
+
+    def _cargar(self, store_id: str, forzar: bool = False):
+        """(E/S bloqueante, apta para hilos) Lee el JSON, lo importa al catálogo si hace falta y devuelve
+        (datos, mtime, huella, revision) sin tocar el registro en memoria"""
+        ruta = self._ruta(store_id)
+        if not os.path.exists(ruta) and self.catalogo is not None:
+            return self._cargar_catalogo(store_id)
+        mtime = os.stat(ruta).st_mtime
+        with open(ruta, "rb") as f:
+            crudo = f.read()
+        datos = json.loads(crudo)
+        huella = hashlib.sha1(crudo).hexdigest()
+        if self.catalogo is None: return datos, mtime, huella, 0
+        ConfigTienda.model_validate(datos).catalogos()   # no importar un JSON inválido
+        self.catalogo.importar(store_id, datos, huella, forzar)
+        return self._cargar_catalogo(store_id, mtime)
+
+    def _cargar_catalogo(self, store_id: str, mtime=None):
+        cargado = self.catalogo.cargar(store_id)
+        if cargado is None: raise OSError(f"Tienda {store_id} no existe en el catálogo")
+        datos, huella, revision = cargado
+        return datos, mtime, huella, revision
+
+    def _leer(self, store_id: str, forzar: bool = False):
+        self._registrar(store_id, *self._cargar(store_id, forzar))
+
+    def cargar_todas(self):
+        """Carga síncrona de todas las tiendas (arranque, antes de servir peticiones)"""
+        with self._lock:
+            nombres = sorted(n[:-5] for n in os.listdir(self.directorio) if n.endswith(".json"))
+            if self.catalogo is not None:
+                nombres += [t for t in self.catalogo.ids() if t not in nombres]
+            for store_id in nombres:
+                try:
+                    self._leer(store_id)
+                except (OSError, ValueError) as e:
+                    logger.error(f"Configuración inválida en {store_id}: {e}")
+            self.cargado = True
+
+    async def recargar(self, store_id: Optional[str] = None, forzar: bool = False):
+        """Relee una tienda conocida (o todas, detectando archivos nuevos). `forzar` reimporta el JSON
+        aunque no haya cambiado, descartando los parches hechos sobre el catálogo.
+        La E/S corre en un hilo; el registro en memoria solo se modifica en el event loop."""
+        if store_id is None:
+            nombres = await asyncio.to_thread(lambda: sorted(
+                {n[:-5] for n in os.listdir(self.directorio) if n.endswith(".json")} | set(self._tiendas)))
+        elif store_id in self._tiendas:
+            nombres = [store_id]
+        else:
+            return
+        for t in nombres:
+            try:
+                cargado = await asyncio.to_thread(self._cargar, t, forzar)
+            except (OSError, ValueError, sqlite3.Error) as e:
+                logger.error(f"Configuración inválida en {t}: {e}"); continue
+            self._registrar(t, *cargado)
+
+    def _aplicar_items(self, store_id: str, entrada: dict, cambios: list, revision: int):
+        """Reemplaza en memoria solo los ítems modificados e invalida lo que dependía de ellos"""
+        datos = entrada["datos"]
+        for catalogo, posicion, item in cambios:
+            lista = datos.get(catalogo)
+            if isinstance(lista, list) and posicion < len(lista): lista[posicion] = item
+        entrada["revision"] = revision
+        entrada["version"] += 1
+        cache_prompts.invalidar_items(store_id, cambios, entrada["version"])
+
+    def _pendiente(self, store_id: str, mtime, huella: str, revision: int):
+        """(E/S bloqueante, apta para hilos) Qué cambió desde lo registrado: None,
+        ("recargar", cargado) si cambió el JSON o lo reimportó otro worker, o ("items", cambios, revision)"""
+        ruta = self._ruta(store_id)
+        if os.path.exists(ruta) and os.stat(ruta).st_mtime != mtime:
+            return "recargar", self._cargar(store_id)
+        if self.catalogo is None: return None
+        estado = self.catalogo.estado(store_id)
+        if estado is None or estado[1] == revision: return None
+        if estado[0] != huella: return "recargar", self._cargar_catalogo(store_id, mtime)
+        return "items", self.catalogo.cambios_desde(store_id, revision), estado[1]
+
+    def _aplicar(self, store_id: str, pendiente: tuple):
+        entrada = self._tiendas.get(store_id)
+        if entrada is None: return
+        if pendiente[0] == "recargar":
+            self._registrar(store_id, *pendiente[1])
+        else:
+            self._aplicar_items(store_id, entrada, pendiente[1], pendiente[2])
+        cache_prompts.calentar(store_id)   # sin efecto si _aplicar_items ya revalidó los fragmentos
+
+    async def revisar(self):
+        """Detecta JSON modificados y parches de otros workers; la E/S va a un hilo y los cambios se aplican en el loop"""
+        for store_id, entrada in list(self._tiendas.items()):
+            revision = entrada["revision"]
+            try:
+                pendiente = await asyncio.to_thread(self._pendiente, store_id, entrada["mtime"], entrada["huella"], revision)
+            except (OSError, ValueError, sqlite3.Error) as e:
+                logger.error(f"No se pudo recargar {store_id}, se mantiene la versión anterior: {e}"); continue
+            # si entretanto se recargó o parcheó la tienda, el resultado quedó viejo: la próxima revisión lo recalcula
+            if pendiente is not None and self._tiendas.get(store_id) is entrada and entrada["revision"] == revision:
+                self._aplicar(store_id, pendiente)
+
+    async def vigilar(self):
+        """Revisión periódica cada CONFIG_CHECK_SEG (tarea del lifespan)"""
+        while True:
+            await asyncio.sleep(CONFIG_CHECK_SEG)
+            await self.revisar()
+
+    async def parchear(self, store_id: str, parches: List[tuple]):
+        """Parchea precio/stock por SKU: la escritura en SQLite corre en un hilo y la memoria se actualiza en el loop.
+        Devuelve los ítems resultantes."""
+        if self.catalogo is None: raise RuntimeError("Catálogo SQLite desactivado (CATALOGO_DB vacío)")
+        entrada = self.obtener(store_id)
+        if entrada is None: raise KeyError(store_id)
+        desde = entrada["revision"]
+
+        def escribir():
+            revision, aplicados = self.catalogo.parchear(store_id, parches)
+            if revision == desde + 1: return revision, aplicados, [(c, p, item) for _, c, p, item in aplicados]
+            return revision, aplicados, self.catalogo.cambios_desde(store_id, desde)   # hubo cambios de otro worker
+        revision, aplicados, cambios = await asyncio.to_thread(escribir)
+        if self._tiendas.get(store_id) is entrada and entrada["revision"] == desde:
+            self._aplicar_items(store_id, entrada, cambios, revision)
+        # si no, otra recarga se adelantó: `vigilar` trae estos ítems por `revision` en la próxima pasada
+        return [{"sku": sku, "catalogo": c, **item} for sku, c, _, item in aplicados]
+
+    def obtener(self, store_id: str):
+        """Entrada completa de la tienda o None si no está registrada (sin tocar el disco)"""
+        if not self.cargado: self.cargar_todas()
+        return self._tiendas.get(store_id)
+
+    def version(self, store_id: str) -> int:
+        entrada = self.obtener(store_id)
+        return entrada["version"] if entrada else 0
+
+    def huella(self, store_id: str) -> Optional[str]:
+        """Hash del JSON importado + revisión del catálogo: igual en todos los workers, a diferencia de `version`"""
+        entrada = self.obtener(store_id)
+        return f"{entrada['huella']}:{entrada['revision']}" if entrada else None
+
+    def ids(self):
+        return list(self._tiendas)
+
+registro_tiendas = RegistroTiendas(catalogo=CatalogoSQLite() if CATALOGO_DB else None)
+
 def cargar_config_tienda(store_id: str):
-    """Carga la configuración de una tienda específica desde la raíz"""
-    nombre_archivo = f"{store_id}.json"
-    try:
-        if os.path.exists(nombre_archivo):
-            with open(nombre_archivo, "r", encoding="utf-8") as f:
-                return json.load(f)
-        logger.error(f"Archivo no encontrado: {nombre_archivo}")
-        return None
-    except Exception as e:
-        logger.error(f"Error cargando {nombre_archivo}: {e}")
+    """Devuelve la configuración (dict) de una tienda registrada o None si no existe"""
+    with span("cargar_config_tienda"):
+        entrada = registro_tiendas.obtener(store_id)
+    if entrada is None:
+        logger.error(f"Tienda no registrada: {store_id}")
         return None
+    return entrada["datos"]
+
+# ========== CLIENTES HTTP (UNO POR PROCESO) ==========
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", 5))
+GROQ_MODEL = os.environ.get("GROQ_MODEL", "llama-3.1-8b-instant")
+GROQ_TIMEOUT = float(os.environ.get("GROQ_TIMEOUT", 30))
+GROQ_CONNECT_TIMEOUT = float(os.environ.get("GROQ_CONNECT_TIMEOUT", 5))
+GROQ_MAX_RETRIES = int(os.environ.get("GROQ_MAX_RETRIES", 2))
+GROQ_MAX_CONEXIONES = int(os.environ.get("GROQ_MAX_CONEXIONES", 100))
+BCV_REINTENTOS = int(os.environ.get("BCV_REINTENTOS", 1))
+BCV_BACKOFF_SEG = float(os.environ.get("BCV_BACKOFF_SEG", 0.5))
+
+class Clientes:
+    """Clientes asíncronos reutilizados durante toda la vida de la app (keep-alive y pool de conexiones)"""
+
+    def __init__(self):
+        self.http = None
+        self._groq = None
+
+    def abrir(self):
+        if self.http is None:
+            self.http = httpx.AsyncClient(timeout=HTTP_TIMEOUT, limits=httpx.Limits(max_connections=20, max_keepalive_connections=10))
+
+    def groq(self):
+        """Cliente Groq compartido; None si falta GROQ_API_KEY. Reintenta con backoff exponencial (max_retries)."""
+        if self._groq is None:
+            api_key = os.environ.get("GROQ_API_KEY")
+            if not api_key: return None
+            from groq import AsyncGroq   # import diferido: el SDK pesa en el arranque y solo hace falta al primer chat
+            self._groq = AsyncGroq(
+                api_key=api_key, max_retries=GROQ_MAX_RETRIES,
+                timeout=httpx.Timeout(GROQ_TIMEOUT, connect=GROQ_CONNECT_TIMEOUT),
+                http_client=httpx.AsyncClient(limits=httpx.Limits(
+                    max_connections=GROQ_MAX_CONEXIONES, max_keepalive_connections=GROQ_MAX_CONEXIONES // 2,
+                    keepalive_expiry=60)))
+        return self._groq
+
+    async def cerrar(self):
+        if self._groq is not None: await self._groq.close(); self._groq = None
+        if self.http is not None: await self.http.aclose(); self.http = None
+
+clientes = Clientes()
 
 # ========== TASA BCV ==========
-cache_tasa = {"valor": None, "fecha": None}
-
-def obtener_tasa_bcv():
-    ahora = datetime.now()
-    if cache_tasa["valor"] and cache_tasa["fecha"] > ahora - timedelta(hours=1):
-        return cache_tasa["valor"]
-    
-    urls = ["https://ve.dolarapi.com/v1/dolares/oficial", "https://pydolarve.org/api/v1/dollar?monitor=bcv"]
-    for url in urls:
+TASA_FUENTES = [("dolarapi", "https://ve.dolarapi.com/v1/dolares/oficial"),
+                ("pydolarve", "https://pydolarve.org/api/v1/dollar?monitor=bcv")]
+# TASA_FUENTES_URLS="nombre=url,nombre=url" reemplaza las fuentes (p. ej. un BCV falso en bench/)
+if os.environ.get("TASA_FUENTES_URLS"):
+    TASA_FUENTES = [tuple(f.split("=", 1)) for f in os.environ["TASA_FUENTES_URLS"].split(",") if "=" in f]
+TASA_TTL_SEG = float(os.environ.get("TASA_TTL_SEG", 3600))
+TASA_REFRESCO_SEG = float(os.environ.get("TASA_REFRESCO_SEG", 1800))
+TASA_HISTORIAL_MAX = int(os.environ.get("TASA_HISTORIAL_MAX", 500))
+TASA_POR_DEFECTO = 45.00
+
+class ServicioTasa:
+    """Tasa BCV refrescada en segundo plano.
+    - Consulta todas las fuentes a la vez y se queda con la primera respuesta válida.
+    - Single-flight: peticiones concurrentes comparten una misma consulta en curso.
+    - Stale-while-revalidate: si la tasa venció se sirve la anterior mientras se refresca."""
+
+    def __init__(self, fuentes=TASA_FUENTES):
+        self.fuentes = fuentes
+        self.valor = None
+        self.fuente = None
+        self.fecha = None
+        self._actualizada = 0.0   # time.monotonic() de la última actualización
+        self.historial = deque(maxlen=TASA_HISTORIAL_MAX)
+        self._en_vuelo = None
+
+    async def _consultar_fuente(self, nombre: str, url: str):
+        for intento in range(BCV_REINTENTOS + 1):
+            if intento: await asyncio.sleep(BCV_BACKOFF_SEG * 2 ** (intento - 1))
+            try:
+                res = await clientes.http.get(url)
+                if res.status_code == 200:
+                    data = res.json()
+                    v = data.get("price") or data.get("promedio") or data.get("valor")
+                    if v and float(v) > 0: return nombre, float(v)
+            except Exception as e:
+                logger.warning(f"Fuente de tasa {nombre} falló: {e}")
+        return nombre, None
+
+    async def _consultar(self):
+        clientes.abrir()
+        tareas = [asyncio.create_task(self._consultar_fuente(n, u)) for n, u in self.fuentes]
         try:
-            res = requests.get(url, timeout=5)
-            if res.status_code == 200:
-                data = res.json()
-                v = data.get("price") or data.get("promedio") or data.get("valor")
-                if v:
-                    cache_tasa.update({"valor": float(v), "fecha": ahora})
-                    return float(v)
-        except: continue
-    return cache_tasa["valor"] or 45.00
+            for siguiente in asyncio.as_completed(tareas):
+                nombre, valor = await siguiente
+                if valor is not None:
+                    self._registrar(valor, nombre)
+                    return valor
+            logger.error("Ninguna fuente de tasa BCV respondió")
+            return self.valor
+        finally:
+            for t in tareas: t.cancel()
+
+    def _registrar(self, valor: float, fuente: str):
+        self.valor, self.fuente, self.fecha = valor, fuente, datetime.now()
+        self._actualizada = time.monotonic()
+        self.historial.append({"tasa": valor, "fuente": fuente, "fecha": self.fecha.isoformat()})
+
+    def refrescar(self):
+        """Inicia (o reutiliza) la consulta en curso y devuelve su tarea"""
+        if self._en_vuelo is None or self._en_vuelo.done():
+            self._en_vuelo = asyncio.create_task(self._consultar())
+        return self._en_vuelo
+
+    def vencida(self) -> bool:
+        return self.valor is None or time.monotonic() - self._actualizada > TASA_TTL_SEG
+
+    async def obtener(self) -> float:
+        if self.valor is None:
+            await asyncio.shield(self.refrescar())
+        elif self.vencida():
+            self.refrescar()
+        return self.valor or TASA_POR_DEFECTO
+
+    async def ciclo(self):
+        """Refresco periódico en segundo plano (tarea del lifespan)"""
+        while True:
+            try:
+                await self.refrescar()
+            except Exception as e:
+                logger.error(f"Error refrescando tasa BCV: {e}")
+            await asyncio.sleep(TASA_REFRESCO_SEG)
+
+servicio_tasa = ServicioTasa()
+
+async def obtener_tasa_bcv():
+    with span("obtener_tasa_bcv"):
+        return await servicio_tasa.obtener()
 
 # ========== MODELOS ==========
 class Message(BaseModel):
@@ -62,21 +533,233 @@ class Message(BaseModel):
     historial: list = []
     advisor: str = "default"
 
+# ========== ÍNDICE DE BÚSQUEDA DE CATÁLOGOS (BM25) ==========
+RETRIEVAL_UMBRAL = int(os.environ.get("RETRIEVAL_UMBRAL", 25))
+RETRIEVAL_TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", 8))
+CAMPOS_INDEXADOS = ("nombre", "detalles", "descripcion", "marcas_compatibles", "modelos_compatibles",
+                    "categoria", "especificaciones", "marcas")
+PALABRAS_VACIAS = frozenset("""de la el los las un una unos unas y o a en para por con sin del al que se mi tu su
+es son hay tienen tiene me te le lo cual cuanto cuesta quiero necesito busco precio""".split())
+
+def palabras(texto: str) -> List[str]:
+    """Minúsculas sin acentos, separado en palabras"""
+    texto = unicodedata.normalize("NFKD", texto.lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    return re.findall(r"\w+", texto)
+
+def tokenizar(texto: str) -> List[str]:
+    return [t for t in palabras(texto) if t not in PALABRAS_VACIAS]
+
+def texto_item(item: dict) -> str:
+    partes = [str(item.get("nombre", ""))]  # el nombre cuenta doble
+    for campo in CAMPOS_INDEXADOS:
+        valor = item.get(campo)
+        if isinstance(valor, list): partes.extend(str(v) for v in valor)
+        elif valor: partes.append(str(valor))
+    return " ".join(partes)
+
+class IndiceCatalogo:
+    """Índice invertido BM25 sobre los ítems de un catálogo"""
+    K1, B = 1.2, 0.75
+
+    def __init__(self, items: list):
+        self.items = items
+        self.postings = {}   # token -> [(posición del ítem, frecuencia)]
+        self.longitudes = []
+        self.textos = []
+        for i, item in enumerate(items):
+            self.longitudes.append(0)
+            self.textos.append(None)
+            self._indexar(i, item)
+        self.promedio = (sum(self.longitudes) / len(items)) if items else 0
+
+    def _indexar(self, i: int, item: dict):
+        texto = texto_item(item)
+        tokens = tokenizar(texto)
+        self.textos[i] = texto
+        self.longitudes[i] = len(tokens)
+        frecuencias = {}
+        for t in tokens: frecuencias[t] = frecuencias.get(t, 0) + 1
+        for t, f in frecuencias.items(): self.postings.setdefault(t, []).append((i, f))
+
+    def actualizar(self, i: int, item: dict):
+        """Reindexa un solo ítem; si su texto indexado no cambió (p. ej. solo precio o stock) no hay nada que hacer.
+        `items` es la misma lista de la configuración, así que el ítem nuevo ya se devuelve en las búsquedas."""
+        if i >= len(self.textos) or texto_item(item) == self.textos[i]: return
+        for t in set(tokenizar(self.textos[i])):
+            restantes = [p for p in self.postings.get(t, []) if p[0] != i]
+            if restantes: self.postings[t] = restantes
+            else: self.postings.pop(t, None)
+        self._indexar(i, item)
+        self.promedio = sum(self.longitudes) / len(self.longitudes)
+
+    def buscar(self, consulta: str, k: int = RETRIEVAL_TOP_K) -> list:
+        """Top-k ítems más relevantes; sin coincidencias devuelve los primeros k"""
+        n = len(self.items)
+        puntajes = {}
+        for t in set(tokenizar(consulta)):
+            postings = self.postings.get(t)
+            if not postings: continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for i, f in postings:
+                norma = f + self.K1 * (1 - self.B + self.B * self.longitudes[i] / self.promedio)
+                puntajes[i] = puntajes.get(i, 0.0) + idf * f * (self.K1 + 1) / norma
+        if not puntajes: return self.items[:k]
+        return [self.items[i] for i in heapq.nlargest(k, puntajes, key=puntajes.get)]
+
+# ========== CACHÉ DE PROMPTS ==========
+class FragmentosPrompt(dict):
+    """JSON de catálogos (y de la tienda completa en 'info') serializado una sola vez, al primer uso.
+    Los catálogos con más de RETRIEVAL_UMBRAL ítems quedan como marcador en la plantilla y se
+    completan por mensaje con los top-k ítems del índice BM25 (ver completar)."""
+
+    def __init__(self, info: dict):
+        super().__init__()
+        self.info = info
+        self.indices = {}
+        self.usadas = set()   # claves leídas por la última plantilla construida (dependencias del prompt)
+
+    def __getitem__(self, clave):
+        self.usadas.add(clave)
+        return super().__getitem__(clave)
+
+    @staticmethod
+    def marcador(clave: str) -> str:
+        return f"\x00{clave}\x00"
+
+    def grande(self, clave: str) -> bool:
+        valor = self.info.get(clave)
+        return clave.startswith("catalogo_") and isinstance(valor, list) and len(valor) > RETRIEVAL_UMBRAL
+
+    def __missing__(self, clave):
+        if clave == "info":
+            grandes = [k for k in self.info if self.grande(k)]
+            texto = json.dumps({k: v for k, v in self.info.items() if k not in grandes}, indent=2, ensure_ascii=False)
+            texto += "".join(f"\n{k}: {self.marcador(k)}" for k in grandes)
+        elif self.grande(clave):
+            texto = self.marcador(clave)
+        else:
+            texto = json.dumps(self.info.get(clave, []), indent=2, ensure_ascii=False)
+        self[clave] = texto
+        return texto
+
+    def indice(self, clave: str) -> IndiceCatalogo:
+        if clave not in self.indices: self.indices[clave] = IndiceCatalogo(self.info.get(clave, []))
+        return self.indices[clave]
+
+    def completar(self, prompt: str, consulta: str) -> str:
+        """Sustituye los marcadores de catálogos grandes por los ítems relevantes a la consulta"""
+        if "\x00" not in prompt: return prompt
+        def reemplazo(m):
+            return json.dumps(self.indice(m.group(1)).buscar(consulta), indent=2, ensure_ascii=False)
+        return re.sub(r"\x00(catalogo_\w+)\x00", reemplazo, prompt)
+
+def asesor_de(info: dict, advisor: str) -> str:
+    """`advisor` viene del cliente: solo se respeta si la tienda tiene su catálogo (catalogo_<advisor>), así las
+    claves de la caché quedan acotadas por la configuración. Los demás producen el mismo prompt que "default"."""
+    return advisor if isinstance(info.get(f"catalogo_{advisor}"), list) else "default"
+
+class CachePrompts:
+    """Prompt del sistema por (store_id, advisor) válido para una versión de config y una tasa.
+    Si cambia la versión de la tienda o la tasa BCV, la entrada se reconstruye."""
+
+    def __init__(self):
+        self._fragmentos = {}   # store_id -> (version, FragmentosPrompt)
+        self._prompts = {}      # (store_id, advisor) -> (version, tasa, prompt, claves de fragmentos usadas)
+        self.aciertos = 0
+        self.fallos = 0
+
+    def obtener(self, store_id: str, info: dict, tasa: float, advisor: str, consulta: str = ""):
+        advisor = asesor_de(info, advisor)
+        entrada = registro_tiendas.obtener(store_id)
+        if entrada is None or entrada["datos"] is not info:
+            fragmentos = FragmentosPrompt(info)
+            return fragmentos.completar(construir_prompt(store_id, info, tasa, advisor, fragmentos), consulta)
+        version = entrada["version"]
+        fragmentos = self._fragmentos.get(store_id)
+        if fragmentos is None or fragmentos[0] != version:
+            fragmentos = (version, FragmentosPrompt(info))
+            self._fragmentos[store_id] = fragmentos
+        guardado = self._prompts.get((store_id, advisor))
+        acierto = bool(guardado and guardado[0] == version and guardado[1] == tasa)
+        metricas.cache("prompts", acierto)
+        if acierto:
+            self.aciertos += 1
+            prompt = guardado[2]
+        else:
+            self.fallos += 1
+            fragmentos[1].usadas = set()
+            prompt = construir_prompt(store_id, info, tasa, advisor, fragmentos[1])
+            self._prompts[(store_id, advisor)] = (version, tasa, prompt, frozenset(fragmentos[1].usadas))
+        return fragmentos[1].completar(prompt, consulta)
+
+    def invalidar_items(self, store_id: str, cambios: list, version: int):
+        """Tras parchear ítems [(catalogo, posicion, item)]: descarta solo los fragmentos serializados de esos
+        catálogos (y 'info', que los incluye), reindexa los ítems en BM25 y reconstruye solo los prompts que los
+        usaban. El resto de entradas se revalida con la nueva `version`."""
+        guardado = self._fragmentos.get(store_id)
+        if guardado is None: return
+        fragmentos = guardado[1]
+        afectadas = set()
+        for catalogo, posicion, item in cambios:
+            indice = fragmentos.indices.get(catalogo)
+            if indice is not None: indice.actualizar(posicion, item)
+            if not fragmentos.grande(catalogo): afectadas.update((catalogo, "info"))
+        for clave in afectadas: dict.pop(fragmentos, clave, None)
+        self._fragmentos[store_id] = (version, fragmentos)
+        for clave, (_, tasa, prompt, usadas) in list(self._prompts.items()):
+            if clave[0] != store_id: continue
+            if usadas & afectadas: del self._prompts[clave]
+            else: self._prompts[clave] = (version, tasa, prompt, usadas)
+
+    def calentar(self, store_id: Optional[str] = None):
+        """Serializa los fragmentos y construye los índices BM25 de una tienda o de todas (no dependen de la tasa)"""
+        for store_id in ([store_id] if store_id else registro_tiendas.ids()):
+            entrada = registro_tiendas.obtener(store_id)
+            guardado = self._fragmentos.get(store_id)
+            if entrada is None or (guardado and guardado[0] == entrada["version"]): continue
+            fragmentos = FragmentosPrompt(entrada["datos"])
+            for clave in ["info", *(k for k in entrada["datos"] if k.startswith("catalogo_"))]:
+                fragmentos[clave]
+                if fragmentos.grande(clave): fragmentos.indice(clave)
+            self._fragmentos[store_id] = (entrada["version"], fragmentos)
+
+    def calentadas(self) -> int:
+        return sum(1 for t in registro_tiendas.ids()
+                   if registro_tiendas.version(t) == self._fragmentos.get(t, (None,))[0])
+
+    def invalidar(self, store_id: Optional[str] = None):
+        if store_id is None:
+            self._fragmentos.clear(); self._prompts.clear(); return
+        self._fragmentos.pop(store_id, None)
+        for clave in [k for k in self._prompts if k[0] == store_id]: del self._prompts[clave]
+
+cache_prompts = CachePrompts()
+
+def preparar():
+    """Arranque en frío, idempotente. Con gunicorn --preload corre en el maestro antes del fork (ver gunicorn.conf.py):
+    los workers heredan las tiendas validadas y los fragmentos/índices ya construidos en vez de rehacerlos cada uno."""
+    if not registro_tiendas.cargado: registro_tiendas.cargar_todas()
+    cache_prompts.calentar()
+    if registro_tiendas.catalogo is not None: registro_tiendas.catalogo.cerrar()   # se reabre al usarse, ya en el worker
+
+def generar_prompt_segun_tienda(store_id: str, info: dict, tasa: float, advisor: str = "default", consulta: str = ""):
+    """Prompt del sistema para la tienda/asesor, servido desde la caché de prompts.
+    `consulta` (mensaje + historial reciente) elige los ítems de los catálogos grandes."""
+    with span("generar_prompt_segun_tienda"):
+        return cache_prompts.obtener(store_id, info, tasa, advisor, consulta)
+
 # ========== GENERADOR DE PROMPTS CON MÉTODO PERFECT ==========
-def generar_prompt_segun_tienda(store_id: str, info: dict, tasa: float, advisor: str = "default"):
+def construir_prompt(store_id: str, info: dict, tasa: float, advisor: str, fragmentos: FragmentosPrompt):
     """Genera el prompt del sistema usando el método PERFECT"""
     
     tienda_nombre = info.get("nombre_tienda", "").upper()
     
     # ===== MULTIKAP CON MÉTODO PERFECT =====
     if store_id == "multikap":
-        # Extraer catálogos para usarlos en el prompt
-        catalogo_motos = json.dumps(info.get('catalogo_motos', []), indent=2, ensure_ascii=False)
-        catalogo_papeleria = json.dumps(info.get('catalogo_papeleria', []), indent=2, ensure_ascii=False)
-        catalogo_hogar = json.dumps(info.get('catalogo_hogar', []), indent=2, ensure_ascii=False)
-        
+        # Solo se construye el asesor pedido
         prompts_asesor = {
-            "motos": f"""
+            "motos": lambda: f"""
 [PERSONIFICACIÓN]
 Eres TAZ MOTOS 🏍️, un experto vendedor de repuestos para motos con 12 años de experiencia en el sector. 
 Conoces a fondo las motos más populares de Venezuela: Bera, Empire, Haojin, Keller, Yamaha, Suzuki.
@@ -84,7 +767,7 @@ Tienes una personalidad enérgica y apasionada por las motos, como un mecánico
 
 [ESCOPO - INFORMACIÓN DISPONIBLE]
 Tienes acceso COMPLETO al catálogo de MultiKAP para motos:
-{catalogo_motos}
+{fragmentos['catalogo_motos']}
 
 Tienes metadatos detallados de cada producto:
 - Marcas y modelos compatibles
@@ -207,7 +890,7 @@ TAZ MOTOS: "¡Clásico! Batería con carga baja pero no muerta. Para tu Empire 2
 La batería nueva te dura 2-3 años sin problemas. ¿Te la llevas?"
             """,
             
-            "papeleria": f"""
+            "papeleria": lambda: f"""
 [PERSONIFICACIÓN]
 Eres TAZ PAPELERÍA 📚, un experto en útiles escolares y de oficina con 8 años de experiencia.
 Trabajaste en una librería universitaria y conoces las marcas y productos que los estudiantes necesitan.
@@ -215,7 +898,7 @@ Eres creativo, ordenado y siempre tienes el dato exacto de lo que buscan.
 
 [ESCOPO - INFORMACIÓN DISPONIBLE]
 Tienes acceso al catálogo de papelería:
-{catalogo_papeleria}
+{fragmentos['catalogo_papeleria']}
 
 Tasa BCV: {tasa} Bs.
 SIEMPRE muestra precios en $ y Bs.
@@ -239,7 +922,7 @@ TAZ PAPELERÍA: "¡Perfecto! Para la universidad lo mejor es:
 ¿Llevas algún color en especial?"
             """,
             
-            "hogar": f"""
+            "hogar": lambda: f"""
 [PERSONIFICACIÓN]
 Eres TAZ HOGAR 🏠, un experto en productos de limpieza y organización del hogar.
 Tienes experiencia en mantenimiento del hogar y sabes qué productos funcionan mejor para cada superficie.
@@ -247,7 +930,7 @@ Eres práctico, cálido y siempre das consejos útiles.
 
 [ESCOPO - INFORMACIÓN DISPONIBLE]
 Tienes acceso al catálogo de hogar:
-{catalogo_hogar}
+{fragmentos['catalogo_hogar']}
 
 Tasa BCV: {tasa} Bs.
 
@@ -271,13 +954,11 @@ TAZ HOGAR: "¡Claro! Para empezar, te recomiendo el combo básico:
 ¿Necesitas algo más específico para baño o cocina?"
             """
         }
-        return prompts_asesor.get(advisor, "Eres TAZ, el asistente virtual de MultiKAP.")
+        constructor = prompts_asesor.get(advisor)
+        return constructor() if constructor else "Eres TAZ, el asistente virtual de MultiKAP."
     
     # ===== PANADERÍA CON MÉTODO PERFECT =====
     elif store_id == "panaderia":
-        catalogo_panes = json.dumps(info.get('catalogo_panes', []), indent=2, ensure_ascii=False)
-        catalogo_dulces = json.dumps(info.get('catalogo_dulces', []), indent=2, ensure_ascii=False)
-        
         return f"""
 [PERSONIFICACIÓN]
 Eres Javier, el panadero virtual con 20 años de experiencia en panadería artesanal.
@@ -286,8 +967,8 @@ Hablas con cariño de tus productos como si fueran tus hijos.
 
 [ESCOPO]
 Panadería: {info.get('nombre_tienda')}
-Catálogo de panes: {catalogo_panes}
-Catálogo de dulces: {catalogo_dulces}
+Catálogo de panes: {fragmentos['catalogo_panes']}
+Catálogo de dulces: {fragmentos['catalogo_dulces']}
 Horario: {info.get('horario')}
 Ubicación: {info.get('ubicacion')}
 Tasa BCV: {tasa} Bs.
@@ -312,9 +993,6 @@ JAVIER: "¡Buenos días! 🥖 Hoy tenemos baguettes recién horneadas y croissan
     
     # ===== FERRETERÍA CON MÉTODO PERFECT =====
     elif store_id == "ferreteria":
-        catalogo_herramientas = json.dumps(info.get('catalogo_herramientas', []), indent=2, ensure_ascii=False)
-        catalogo_electricidad = json.dumps(info.get('catalogo_electricidad', []), indent=2, ensure_ascii=False)
-        
         return f"""
 [PERSONIFICACIÓN]
 Eres un maestro de obra con 25 años de experiencia. Has construido casas, reparado tuberías e instalado sistemas eléctricos.
@@ -323,8 +1001,8 @@ Hablas con seguridad y das consejos prácticos.
 
 [ESCOPO]
 Ferretería: {info.get('nombre_tienda')}
-Catálogo herramientas: {catalogo_herramientas}
-Catálogo electricidad: {catalogo_electricidad}
+Catálogo herramientas: {fragmentos['catalogo_herramientas']}
+Catálogo electricidad: {fragmentos['catalogo_electricidad']}
 Horario: {info.get('horario')}
 Tasa BCV: {tasa} Bs.
 
@@ -351,9 +1029,6 @@ Experto: "Para colgar un cuadro liviano, usa:
     
     # ===== MOTO-REPUESTOS CON MÉTODO PERFECT =====
     elif store_id == "motorepuestos":
-        catalogo_motores = json.dumps(info.get('catalogo_motores', []), indent=2, ensure_ascii=False)
-        catalogo_frenos = json.dumps(info.get('catalogo_frenos', []), indent=2, ensure_ascii=False)
-        
         return f"""
 [PERSONIFICACIÓN]
 Eres un mecánico de motos con 15 años de experiencia en taller.
@@ -363,8 +1038,8 @@ Hablas con seguridad y usas jerga técnica pero la explicas.
 
 [ESCOPO]
 Tienda: {info.get('nombre_tienda')}
-Catálogo motores: {catalogo_motores}
-Catálogo frenos: {catalogo_frenos}
+Catálogo motores: {fragmentos['catalogo_motores']}
+Catálogo frenos: {fragmentos['catalogo_frenos']}
 Tasa BCV: {tasa} Bs.
 
 [ROTEIRO]
@@ -391,75 +1066,615 @@ Experto: "Puede ser carburación o transmisión. ¿De qué moto se trata? ¿Sien
 Eres el asistente virtual de {info.get('nombre_tienda', 'la tienda')}.
 Tasa BCV de hoy: {tasa} Bs.
 
-Información de la tienda: {json.dumps(info, indent=2, ensure_ascii=False)}
+Información de la tienda: {fragmentos['info']}
 
 Sé amable, breve y útil. Usa emojis cuando sea apropiado.
 Responde preguntas sobre productos, horarios, pagos y envíos.
         """
 
+# ========== RESPUESTAS RÁPIDAS (SIN LLM) ==========
+RAPIDAS_MAX_PALABRAS = int(os.environ.get("RAPIDAS_MAX_PALABRAS", 14))
+
+def raiz(t: str) -> str:
+    return t[:-1] if len(t) > 3 and t.endswith("s") else t
+
+def raices(texto: str) -> set:
+    return set(map(raiz, texto.split()))
+
+INTENCIONES_PRECIO = raices("cuanto cuesta cuestan precio precios vale valen costo")
+INTENCIONES_STOCK = raices("stock tienen tienes hay queda quedan disponible disponibles existencia")
+INTENCIONES_INFO = {
+    "horario": raices("horario horarios abren cierran abierto abiertos atienden hora"),
+    "metodos_pago": raices("pago pagos pagar zelle binance efectivo transferencia movil aceptan tarjeta"),
+    "ubicacion": raices("ubicacion ubicados direccion donde tienda fisica local"),
+    "envios": raices("envio envios envian enviar delivery despacho despachan encomienda"),
+}
+
+class RespuestasRapidas:
+    """Responde desde la config, sin LLM, preguntas tipo FAQ: horario, pagos, envíos,
+    preguntas_frecuentes, precio y stock de un producto. Si la intención no es clara devuelve None."""
+
+    def __init__(self):
+        self._compilado = {}   # store_id -> (version, datos compilados)
+        self.consultas = 0
+        self.aciertos = {}
+
+    def _compilar(self, info: dict):
+        faq = []
+        for pregunta, respuesta in re.findall(r"¿([^?]+)\?\s*([^¿]+)", info.get("preguntas_frecuentes") or ""):
+            faq.append((set(map(raiz, tokenizar(pregunta))), respuesta.strip()))
+        items = []
+        for clave, lista in info.items():
+            if not clave.startswith("catalogo_") or not isinstance(lista, list): continue
+            for item in lista:
+                if not isinstance(item, dict) or "nombre" not in item: continue
+                nombre = {raiz(t) for t in tokenizar(item["nombre"]) if not t.isdigit() and t != "pack"}
+                if nombre: items.append((clave, nombre, item))
+        return {"faq": faq, "items": items}
+
+    def _datos(self, store_id: str, info: dict):
+        version = registro_tiendas.version(store_id) if cargar_config_tienda(store_id) is info else None
+        guardado = self._compilado.get(store_id)
+        if version is not None and guardado and guardado[0] == version: return guardado[1]
+        datos = self._compilar(info)
+        if version is not None: self._compilado[store_id] = (version, datos)
+        return datos
+
+    @staticmethod
+    def _formato_item(item: dict, tasa: float, con_stock: bool) -> str:
+        precio = float(item.get("precio", 0))
+        texto = f"{item.get('emoji', '🛒')} {item['nombre']}: ${precio:g} (Bs {precio * tasa:.2f})"
+        stock = item.get("stock")
+        if stock is not None and (con_stock or stock < 5):
+            texto += " - Agotado temporalmente" if stock <= 0 else f" - Stock: {stock}"
+        return texto
+
+    def responder(self, store_id: str, info: dict, tasa: float, mensaje: str, advisor: str = "default"):
+        with span("respuestas_rapidas"):
+            respuesta = self._responder(store_id, info, tasa, mensaje, advisor)
+        metricas.cache("respuestas_rapidas", respuesta is not None)
+        return respuesta
+
+    def _responder(self, store_id: str, info: dict, tasa: float, mensaje: str, advisor: str):
+        self.consultas += 1
+        crudas = palabras(mensaje)
+        if not crudas or len(crudas) > RAPIDAS_MAX_PALABRAS: return None
+        conjunto = set(map(raiz, crudas))
+        datos = self._datos(store_id, info)
+
+        if conjunto & INTENCIONES_PRECIO or conjunto & INTENCIONES_STOCK:
+            catalogo = f"catalogo_{advisor}"
+            candidatos = [(len(nombre & conjunto) / len(nombre), item) for clave, nombre, item in datos["items"]
+                          if (clave == catalogo or catalogo not in info) and nombre & conjunto]
+            candidatos = [c for c in candidatos if c[0] >= 0.5]
+            if candidatos:
+                mejor = max(p for p, _ in candidatos)
+                elegidos = [item for p, item in candidatos if p == mejor]
+                if len(elegidos) > 3: return None
+                con_stock = bool(conjunto & INTENCIONES_STOCK)
+                lineas = "\n".join(self._formato_item(i, tasa, con_stock) for i in elegidos)
+                return self._acierto("stock" if con_stock else "precio", f"{lineas}\n\nTasa BCV: {tasa} Bs. ¿Te lo aparto? 🛒")
+
+        for pregunta, respuesta in datos["faq"]:
+            if pregunta and len(pregunta & conjunto) / len(pregunta | conjunto) >= 0.5:
+                return self._acierto("preguntas_frecuentes", respuesta)
+
+        intenciones = [campo for campo, claves in INTENCIONES_INFO.items() if conjunto & claves and info.get(campo)]
+        if len(intenciones) == 1:
+            return self._acierto(intenciones[0], info[intenciones[0]])
+        return None
+
+    def _acierto(self, intencion: str, respuesta: str):
+        self.aciertos[intencion] = self.aciertos.get(intencion, 0) + 1
+        return respuesta
+
+    def estadisticas(self):
+        total = sum(self.aciertos.values())
+        return {"consultas": self.consultas, "aciertos": total,
+                "ratio": round(total / self.consultas, 4) if self.consultas else 0.0,
+                "por_intencion": dict(self.aciertos)}
+
+respuestas_rapidas = RespuestasRapidas()
+
+# ========== HISTORIAL CON PRESUPUESTO DE TOKENS ==========
+HISTORIAL_MAX_TOKENS = int(os.environ.get("HISTORIAL_MAX_TOKENS", 1200))
+HISTORIAL_MAX_TURNOS = int(os.environ.get("HISTORIAL_MAX_TURNOS", 10))
+MENSAJE_MAX_CHARS = int(os.environ.get("MENSAJE_MAX_CHARS", 2000))
+HISTORIAL_RESUMEN = os.environ.get("HISTORIAL_RESUMEN", "0") == "1"
+RESPUESTA_MAX_TOKENS = 1000
+# Tokens de prompt que aceptamos mandar por petición a cada modelo (latencia/costo, no la ventana máxima)
+PRESUPUESTO_MODELO = {"llama-3.1-8b-instant": 6000, "llama-3.3-70b-versatile": 8000}
+PRESUPUESTO_POR_DEFECTO = 6000
+
+class GestorHistorial:
+    """Valida el historial del cliente (roles user/assistant, contenido texto) y conserva los turnos
+    más recientes que caben en el presupuesto. Opcionalmente resume los turnos descartados."""
+    ROLES = ("user", "assistant")
+
+    def __init__(self, max_tokens: int = HISTORIAL_MAX_TOKENS, max_turnos: int = HISTORIAL_MAX_TURNOS,
+                 resumen: bool = HISTORIAL_RESUMEN):
+        self.max_tokens = max_tokens
+        self.max_turnos = max_turnos
+        self.resumen = resumen
+        self._resumenes = OrderedDict()   # hash de turnos descartados -> resumen
+
+    @staticmethod
+    def tokens(texto: str) -> int:
+        """Estimación rápida (~3.5 caracteres por token en español)"""
+        return int(len(texto) / 3.5) + 1
+
+    def tokens_mensaje(self, m: dict) -> int:
+        return self.tokens(m["content"]) + 4   # + marcas de rol/formato
+
+    @staticmethod
+    def recortar(texto: str, limite: int = MENSAJE_MAX_CHARS) -> str:
+        return texto if len(texto) <= limite else texto[:limite] + "…"
+
+    def validar(self, historial: list) -> list:
+        validos = []
+        for m in historial if isinstance(historial, list) else []:
+            if not isinstance(m, dict) or m.get("role") not in self.ROLES: continue
+            contenido = m.get("content")
+            if not isinstance(contenido, str) or not contenido.strip(): continue
+            validos.append({"role": m["role"], "content": self.recortar(contenido)})
+        return validos
+
+    def compactar(self, historial: list, presupuesto: Optional[int] = None) -> list:
+        presupuesto = self.max_tokens if presupuesto is None else presupuesto
+        validos = self.validar(historial)
+        conservados, usados = [], 0
+        for m in reversed(validos[-self.max_turnos:]):
+            costo = self.tokens_mensaje(m)
+            if usados + costo > presupuesto: break
+            conservados.append(m); usados += costo
+        conservados.reverse()
+        descartados = validos[:len(validos) - len(conservados)]
+        if self.resumen and descartados:
+            resumen = self._resumir(descartados)
+            if self.tokens(resumen) + usados <= presupuesto:
+                conservados.insert(0, {"role": "system", "content": resumen})
+        return conservados
+
+    def _resumir(self, turnos: list) -> str:
+        """Resumen extractivo (primera frase de cada turno del cliente), cacheado por contenido"""
+        clave = hashlib.sha1(json.dumps(turnos, ensure_ascii=False).encode()).hexdigest()
+        if clave in self._resumenes:
+            self._resumenes.move_to_end(clave)
+            return self._resumenes[clave]
+        frases = [re.split(r"(?<=[.?!])\s", t["content"], 1)[0][:160] for t in turnos if t["role"] == "user"]
+        resumen = "Resumen de la conversación anterior (el cliente dijo): " + " | ".join(frases[-8:])
+        self._resumenes[clave] = resumen
+        if len(self._resumenes) > 500: self._resumenes.popitem(last=False)
+        return resumen
+
+    def ajustar_al_modelo(self, mensajes: list, modelo: str) -> list:
+        """Quita los turnos intermedios más antiguos hasta que system + historial + mensaje quepan en el modelo"""
+        limite = PRESUPUESTO_MODELO.get(modelo, PRESUPUESTO_POR_DEFECTO)
+        total = sum(self.tokens_mensaje(m) for m in mensajes)
+        while total > limite and len(mensajes) > 2:
+            total -= self.tokens_mensaje(mensajes.pop(1))
+        return mensajes
+
+gestor_historial = GestorHistorial()
+
+# ========== CONTROL DE ADMISIÓN PARA EL LLM ==========
+LLM_MAX_GLOBAL = int(os.environ.get("LLM_MAX_GLOBAL", 32))
+LLM_MAX_TIENDA = int(os.environ.get("LLM_MAX_TIENDA", 8))
+LLM_COLA_MAX = int(os.environ.get("LLM_COLA_MAX", 64))
+LLM_ESPERA_MAX_SEG = float(os.environ.get("LLM_ESPERA_MAX_SEG", 5))
+RATE_POR_SEG = float(os.environ.get("RATE_POR_SEG", 0.5))     # recarga de la cubeta por IP y tienda
+RATE_RAFAGA = float(os.environ.get("RATE_RAFAGA", 10))
+RATE_CUBETAS_MAX = int(os.environ.get("RATE_CUBETAS_MAX", 10000))   # cubetas en memoria (LRU)
+CB_FALLOS = int(os.environ.get("CB_FALLOS", 5))
+CB_ENFRIAMIENTO_SEG = float(os.environ.get("CB_ENFRIAMIENTO_SEG", 30))
+
+class Rechazado(Exception):
+    def __init__(self, motivo: str, reintentar_en: Optional[float] = None):
+        super().__init__(motivo)
+        self.motivo = motivo
+        self.reintentar_en = reintentar_en
+
+def fallo_del_proveedor(e: BaseException) -> bool:
+    """Errores que cuentan para el circuito: transporte, timeouts y respuestas 429/5xx del proveedor.
+    Un 400/401/422 o un error de nuestro código no dicen nada de la salud de Groq."""
+    if isinstance(e, (httpx.HTTPError, asyncio.TimeoutError, TimeoutError, ConnectionError)): return True
+    estado = getattr(e, "status_code", None)
+    if isinstance(estado, int): return estado == 429 or estado >= 500
+    return type(e).__module__.startswith("groq") and type(e).__name__ in ("APIConnectionError", "APITimeoutError")
+
+class CircuitoLLM:
+    """Circuit breaker: tras CB_FALLOS fallos seguidos se abre y falla rápido durante
+    CB_ENFRIAMIENTO_SEG; luego (semiabierto) deja pasar una sola petición de prueba y rechaza
+    las demás hasta que termine: si sale bien se cierra, si falla se vuelve a abrir."""
+
+    def __init__(self, umbral: int = CB_FALLOS, enfriamiento: float = CB_ENFRIAMIENTO_SEG):
+        self.umbral = umbral
+        self.enfriamiento = enfriamiento
+        self.fallos = 0
+        self.abierto_hasta = 0.0
+        self.sonda_en_curso = False
+
+    @property
+    def estado(self) -> str:
+        if self.fallos < self.umbral: return "cerrado"
+        return "abierto" if time.monotonic() < self.abierto_hasta else "semiabierto"
+
+    def permitir(self) -> Optional[str]:
+        """None si hay que rechazar; "sonda" si esta petición es la prueba del estado semiabierto
+        (quien la recibe debe llamar a `soltar_sonda()` al terminar, pase lo que pase)."""
+        estado = self.estado
+        if estado == "abierto": return None
+        if estado == "semiabierto":
+            if self.sonda_en_curso: return None
+            self.sonda_en_curso = True
+            return "sonda"
+        return "normal"
+
+    def soltar_sonda(self):
+        self.sonda_en_curso = False
+
+    def exito(self):
+        self.fallos = 0
+
+    def fallo(self):
+        self.fallos += 1
+        if self.fallos >= self.umbral:
+            if self.fallos == self.umbral or self.estado == "semiabierto":
+                logger.warning("Circuito del LLM abierto: se responde con el respaldo de WhatsApp")
+            self.abierto_hasta = time.monotonic() + self.enfriamiento
+
+class ControlAdmision:
+    """Semáforos global y por tienda con cola de espera acotada y plazo, más cubetas de tokens
+    por (IP, tienda) y el circuit breaker del proveedor."""
+
+    def __init__(self):
+        self._global = asyncio.Semaphore(LLM_MAX_GLOBAL)
+        self._tiendas = {}
+        self._cubetas = OrderedDict()   # (ip, store_id) -> [tokens, último time.monotonic()], en orden LRU
+        self.circuito = CircuitoLLM()
+        self.esperando = 0
+        self.en_curso = 0
+        self.rechazos = {}
+
+    def _rechazar(self, motivo: str, reintentar_en: Optional[float] = None):
+        self.rechazos[motivo] = self.rechazos.get(motivo, 0) + 1
+        return Rechazado(motivo, reintentar_en)
+
+    def limitar(self, ip: str, store_id: str):
+        ahora = time.monotonic()
+        cubeta = self._cubetas.get((ip, store_id))
+        if cubeta is None:
+            cubeta = self._cubetas[(ip, store_id)] = [RATE_RAFAGA, ahora]
+            if len(self._cubetas) > RATE_CUBETAS_MAX: self._cubetas.popitem(last=False)   # la menos reciente
+        else:
+            self._cubetas.move_to_end((ip, store_id))
+        cubeta[0] = min(RATE_RAFAGA, cubeta[0] + (ahora - cubeta[1]) * RATE_POR_SEG)
+        cubeta[1] = ahora
+        if cubeta[0] < 1:
+            raise self._rechazar("limite", (1 - cubeta[0]) / RATE_POR_SEG)
+        cubeta[0] -= 1
+
+    @asynccontextmanager
+    async def admitir(self, store_id: str):
+        paso = self.circuito.permitir()
+        if paso is None: raise self._rechazar("circuito_abierto", CB_ENFRIAMIENTO_SEG)
+        try:
+            async with self._ocupar(store_id):
+                yield
+        finally:
+            if paso == "sonda": self.circuito.soltar_sonda()
+
+    @asynccontextmanager
+    async def _ocupar(self, store_id: str):
+        if self.esperando >= LLM_COLA_MAX: raise self._rechazar("cola_llena", 1)
+        tienda = self._tiendas.setdefault(store_id, asyncio.Semaphore(LLM_MAX_TIENDA))
+        plazo = time.monotonic() + LLM_ESPERA_MAX_SEG
+        adquiridos = []
+        self.esperando += 1
+        try:
+            for semaforo in (tienda, self._global):
+                await asyncio.wait_for(semaforo.acquire(), timeout=max(plazo - time.monotonic(), 0.001))
+                adquiridos.append(semaforo)
+        except BaseException as e:
+            for semaforo in adquiridos: semaforo.release()
+            if isinstance(e, asyncio.TimeoutError): raise self._rechazar("espera_agotada", 1)
+            raise
+        finally:
+            self.esperando -= 1
+        self.en_curso += 1
+        try:
+            yield
+            self.circuito.exito()
+        except Exception as e:
+            if fallo_del_proveedor(e): self.circuito.fallo()
+            raise
+        finally:
+            self.en_curso -= 1
+            for semaforo in adquiridos: semaforo.release()
+
+    def estadisticas(self):
+        return {"en_curso": self.en_curso, "esperando": self.esperando, "circuito": self.circuito.estado,
+                "fallos_seguidos": self.circuito.fallos, "sonda_en_curso": self.circuito.sonda_en_curso,
+                "rechazos": dict(self.rechazos)}
+
+admision = ControlAdmision()
+
+def ip_cliente(request: Request) -> str:
+    """IP del par TCP. X-Forwarded-For lo controla el cliente, así que no se lee aquí: uvicorn/gunicorn lo aplican
+    solo si viene de un proxy listado en FORWARDED_ALLOW_IPS (p. ej. "*" detrás del balanceador de Render)."""
+    return request.client.host if request.client else "desconocida"
+
+# ========== CACHÉ DE RESPUESTAS DEL LLM ==========
+RESP_CACHE_MAX = int(os.environ.get("RESP_CACHE_MAX", 2000))
+RESP_CACHE_TTL = float(os.environ.get("RESP_CACHE_TTL", 3600))
+RESP_CACHE_DB = os.environ.get("RESP_CACHE_DB")   # ruta SQLite opcional para sobrevivir reinicios
+RESP_CACHE_PODA_CADA = int(os.environ.get("RESP_CACHE_PODA_CADA", 100))   # escrituras entre podas de la tabla
+TASA_BUCKET = float(os.environ.get("TASA_BUCKET", 0.5))
+CABECERA_BYPASS = "X-Cache-Bypass"
+
+class CacheRespuestas:
+    """Respuestas del LLM por (tienda, huella de la config, asesor, mensaje normalizado, historial, tasa agrupada).
+    LRU acotada en memoria con TTL y, si RESP_CACHE_DB está definida, persistencia en SQLite (podada al escribir).
+    La huella es el hash del contenido: igual entre workers y reinicios, a diferencia del contador `version`."""
+
+    def __init__(self, max_entradas: int = RESP_CACHE_MAX, ttl: float = RESP_CACHE_TTL, ruta_db: Optional[str] = RESP_CACHE_DB):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self.ruta_db = ruta_db
+        self._entradas = OrderedDict()   # clave -> (expira (time.time), respuesta)
+        self._db = None
+        self.aciertos = 0
+        self.fallos = 0
+        self.omitidas = 0
+        self._escrituras = 0
+        self._lock = threading.Lock()   # la conexión se comparte entre los hilos de asyncio.to_thread
+
+    @staticmethod
+    def clave(store_id: str, advisor: str, mensaje: str, historial: list, tasa: float) -> str:
+        hist = hashlib.sha1(json.dumps(historial, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+        partes = [store_id, str(registro_tiendas.huella(store_id)), advisor, " ".join(palabras(mensaje)), hist,
+                  str(round(tasa / TASA_BUCKET))]
+        return hashlib.sha256("\x1f".join(partes).encode()).hexdigest()
+
+    def abrir(self):
+        if not self.ruta_db or self._db is not None: return
+        self._db = sqlite3.connect(self.ruta_db, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS respuestas (clave TEXT PRIMARY KEY, respuesta TEXT, expira REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_respuestas_expira ON respuestas (expira)")
+        with self._lock: self._podar()
+        filas = self._db.execute("SELECT clave, respuesta, expira FROM respuestas ORDER BY expira DESC LIMIT ?",
+                                 (self.max_entradas,)).fetchall()
+        for clave, respuesta, expira in reversed(filas):
+            self._entradas[clave] = (expira, respuesta)
+        logger.info(f"Caché de respuestas: {len(filas)} entradas restauradas")
+
+    def cerrar(self):
+        with self._lock:
+            if self._db is not None: self._db.close(); self._db = None
+
+    def obtener(self, clave: str) -> Optional[str]:
+        entrada = self._entradas.get(clave)
+        if entrada is None or entrada[0] <= time.time():
+            if entrada is not None: del self._entradas[clave]
+            self.fallos += 1
+            metricas.cache("respuestas_llm", False)
+            return None
+        self._entradas.move_to_end(clave)
+        self.aciertos += 1
+        metricas.cache("respuestas_llm", True)
+        return entrada[1]
+
+    async def guardar(self, clave: str, respuesta: str):
+        expira = time.time() + self.ttl
+        self._entradas[clave] = (expira, respuesta)
+        self._entradas.move_to_end(clave)
+        while len(self._entradas) > self.max_entradas:
+            self._entradas.popitem(last=False)
+        if self._db is not None:
+            await asyncio.to_thread(self._persistir, clave, respuesta, expira)
+
+    def _persistir(self, clave: str, respuesta: str, expira: float):
+        try:
+            with self._lock:
+                if self._db is None: return
+                self._db.execute("INSERT OR REPLACE INTO respuestas (clave, respuesta, expira) VALUES (?,?,?)", (clave, respuesta, expira))
+                self._escrituras += 1
+                if self._escrituras % RESP_CACHE_PODA_CADA == 0: self._podar()
+                self._db.commit()
+        except sqlite3.Error as e:
+            logger.error(f"No se pudo persistir la respuesta en caché: {e}")
+
+    def _podar(self):
+        """(Con _lock tomado) Borra las vencidas y deja solo las max_entradas más recientes (las demás no se restaurarían)"""
+        self._db.execute("DELETE FROM respuestas WHERE expira <= ?", (time.time(),))
+        self._db.execute("""DELETE FROM respuestas WHERE expira < (SELECT expira FROM respuestas
+                            ORDER BY expira DESC LIMIT 1 OFFSET ?)""", (self.max_entradas - 1,))
+        self._db.commit()
+
+    def estadisticas(self):
+        consultas = self.aciertos + self.fallos
+        return {"entradas": len(self._entradas), "aciertos": self.aciertos, "fallos": self.fallos,
+                "omitidas": self.omitidas, "ratio": round(self.aciertos / consultas, 4) if consultas else 0.0}
+
+cache_respuestas = CacheRespuestas()
+
+def omitir_cache(request: Request) -> bool:
+    if request.headers.get(CABECERA_BYPASS, "").lower() in ("1", "true", "si", "yes"):
+        cache_respuestas.omitidas += 1
+        return True
+    return False
+
 # ========== ENDPOINTS ==========
 @app.get("/config/{store_id}")
-async def get_config(store_id: str):
-    """Obtiene la configuración de una tienda específica"""
+async def get_config(store_id: str, request: Request):
+    """Obtiene la configuración de una tienda específica (304 si el cliente ya tiene esta versión)"""
     config = cargar_config_tienda(store_id)
     if config is None:
         raise HTTPException(status_code=404, detail="Tienda no encontrada")
-    return config
+    etag = etag_de("config", store_id, registro_tiendas.huella(store_id))
+    return respuesta_condicional(request, etag, lambda: config, "public, no-cache")
+
+def verificar_admin(password: str):
+    if not ADMIN_PASSWORD or password != ADMIN_PASSWORD:
+        raise HTTPException(status_code=401)
+
+@app.post("/admin/recargar-config")
+async def recargar_config(password: str, store_id: Optional[str] = None, forzar: bool = False):
+    """Fuerza la recarga de una tienda (o de todas) desde disco.
+    Con `forzar` el JSON se reimporta al catálogo aunque no haya cambiado (se pierden los parches por SKU)."""
+    verificar_admin(password)
+    await registro_tiendas.recargar(store_id, forzar)
+    cache_prompts.invalidar(store_id)
+    cache_prompts.calentar(store_id)   # /salud/listo sigue en 200 tras la recarga
+    return {"status": "success", "tiendas": {t: registro_tiendas.version(t) for t in registro_tiendas.ids()}}
+
+# ========== CATÁLOGO: CONSULTA Y PARCHES POR SKU ==========
+class ParcheItem(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    precio: Optional[float] = Field(None, gt=0)
+    stock: Optional[int] = Field(None, ge=0)
+
+class ParcheSku(ParcheItem):
+    sku: str
+
+async def aplicar_parches(store_id: str, parches: List[tuple]):
+    if any(not cambios for _, cambios in parches):
+        raise HTTPException(status_code=400, detail="Cada parche debe incluir precio y/o stock")
+    try:
+        items = await registro_tiendas.parchear(store_id, parches)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=f"No encontrado: {e.args[0]}")
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"status": "success", "version": registro_tiendas.version(store_id), "items": items}
+
+@app.get("/admin/catalogo/{store_id}/items")
+async def listar_items(store_id: str, password: str, catalogo: Optional[str] = None,
+                       limite: int = Query(100, ge=1, le=1000), desde: Optional[str] = None):
+    """SKUs de la tienda (paginado por SKU: la siguiente página se pide con `desde` = último sku)"""
+    verificar_admin(password)
+    if registro_tiendas.catalogo is None: raise HTTPException(status_code=409, detail="Catálogo SQLite desactivado")
+    if registro_tiendas.obtener(store_id) is None: raise HTTPException(status_code=404, detail="Tienda no encontrada")
+    return await asyncio.to_thread(registro_tiendas.catalogo.listar, store_id, catalogo, limite, desde)
+
+@app.patch("/admin/catalogo/{store_id}/items/{sku}")
+async def parchear_item(store_id: str, sku: str, parche: ParcheItem, password: str):
+    """Actualiza precio y/o stock de un ítem; solo se invalidan los prompts e índices que lo incluyen"""
+    verificar_admin(password)
+    return await aplicar_parches(store_id, [(sku, parche.model_dump(exclude_none=True))])
+
+@app.patch("/admin/catalogo/{store_id}/items")
+async def parchear_items(store_id: str, parches: List[ParcheSku], password: str):
+    """Parches por lote en una sola transacción (todo o nada)"""
+    verificar_admin(password)
+    return await aplicar_parches(store_id, [(p.sku, p.model_dump(exclude_none=True, exclude={"sku"})) for p in parches])
+
+# ===== DISPARADORES DE WHATSAPP MEJORADOS =====
+DISPARADORES_WHATSAPP = [
+    "comprar", "precio", "pago", "disponible", "cuanto", 
+    "ubicacion", "oferta", "interesado", "quiero", "deseo", 
+    "adquirir", "pedir", "ordenar", "cotizar", "presupuesto",
+    "llevar", "compro", "adquirir", "reservar", "apartar"
+]
+
+def debe_mostrar_whatsapp(mensaje: str, respuesta: str) -> bool:
+    texto_completo = (mensaje + " " + respuesta).lower()
+    return any(p in texto_completo for p in DISPARADORES_WHATSAPP)
+
+MENSAJE_SIN_IA = "Lo siento, el servicio de IA no está configurado. Por favor contacta al administrador."
+MENSAJE_FALLBACK = "Disculpa, estoy recibiendo muchas consultas. ¿Podemos concretar por WhatsApp para darte una mejor atención? 🚀"
+
+PROMPT_TOKENS = metricas.registro.medidor("prompt_tokens", "Tokens estimados del último prompt enviado al LLM", ("store",))
+LLM_DURACION = metricas.registro.histograma("llm_completion_segundos", "Duración de la llamada al LLM", ("store", "modo"))
+
+def historial_valido(msg: Message) -> list:
+    """Historial validado y recortado al presupuesto de tokens (ver GestorHistorial)"""
+    return gestor_historial.compactar(msg.historial)
+
+def construir_mensajes(store_id: str, info: dict, tasa: float, msg: Message):
+    # Generar prompt mejorado con método PERFECT
+    consulta = " ".join([m.get("content", "") for m in msg.historial[-4:]
+                         if isinstance(m, dict) and m.get("role") == "user" and isinstance(m.get("content"), str)]
+                        + [msg.mensaje])
+    prompt_sistema = generar_prompt_segun_tienda(store_id, info, tasa, msg.advisor, consulta)
+
+    mensajes_groq = [{"role": "system", "content": prompt_sistema}]
+    mensajes_groq.extend(historial_valido(msg))
+    mensajes_groq.append({"role": "user", "content": gestor_historial.recortar(msg.mensaje)})
+    mensajes_groq = gestor_historial.ajustar_al_modelo(mensajes_groq, GROQ_MODEL)
+    PROMPT_TOKENS.set(sum(gestor_historial.tokens_mensaje(m) for m in mensajes_groq), store=store_id)
+    return mensajes_groq
 
 @app.post("/chat/{store_id}")
-async def chat(store_id: str, msg: Message):
+async def chat(store_id: str, msg: Message, request: Request, response: Response):
     """Procesa mensajes para una tienda específica con IA mejorada"""
     try:
         INFO = cargar_config_tienda(store_id)
         if INFO is None:
             raise HTTPException(status_code=404, detail="Tienda no encontrada")
         
-        tasa = obtener_tasa_bcv()
-        api_key = os.environ.get("GROQ_API_KEY")
-        if not api_key:
+        tasa = await obtener_tasa_bcv()
+        rapida = respuestas_rapidas.responder(store_id, INFO, tasa, msg.mensaje, msg.advisor)
+        if rapida is not None:
+            return {
+                "respuesta": rapida,
+                "mostrar_whatsapp": debe_mostrar_whatsapp(msg.mensaje, rapida),
+                "tasa": tasa
+            }
+
+        bypass = omitir_cache(request)
+        clave = cache_respuestas.clave(store_id, msg.advisor, msg.mensaje, historial_valido(msg), tasa)
+        resp = None if bypass else cache_respuestas.obtener(clave)
+        response.headers["X-Cache"] = "BYPASS" if bypass else ("HIT" if resp is not None else "MISS")
+        if resp is not None:
+            return {
+                "respuesta": resp,
+                "mostrar_whatsapp": debe_mostrar_whatsapp(msg.mensaje, resp),
+                "tasa": tasa
+            }
+
+        client = clientes.groq()
+        if client is None:
             logger.error("GROQ_API_KEY no configurada")
             return {
-                "respuesta": "Lo siento, el servicio de IA no está configurado. Por favor contacta al administrador.",
+                "respuesta": MENSAJE_SIN_IA,
                 "mostrar_whatsapp": True,
                 "tasa": tasa
             }
-        
-        client = Groq(api_key=api_key)
 
-        # Generar prompt mejorado con método PERFECT
-        prompt_sistema = generar_prompt_segun_tienda(store_id, INFO, tasa, msg.advisor)
-
-        # HISTORIAL AMPLIADO a 10 mensajes (mejor contexto)
-        mensajes_groq = [{"role": "system", "content": prompt_sistema}]
-        for m in msg.historial[-10:]:  # Cambiado de 6 a 10
-            if isinstance(m, dict) and "role" in m:
-                mensajes_groq.append(m)
-        
-        mensajes_groq.append({"role": "user", "content": msg.mensaje})
+        mensajes_groq = construir_mensajes(store_id, INFO, tasa, msg)
 
-        # Temperatura ajustada para más creatividad pero controlada
-        completion = client.chat.completions.create(
-            model="llama-3.1-8b-instant",
-            messages=mensajes_groq,
-            temperature=0.7,  # Balance entre creatividad y precisión
-            max_tokens=1000   # Aumentado para respuestas más detalladas
-        )
+        try:
+            admision.limitar(ip_cliente(request), store_id)
+            async with admision.admitir(store_id):
+                with LLM_DURACION.medir(store=store_id, modo="completo"):
+                    # Temperatura ajustada para más creatividad pero controlada
+                    completion = await client.chat.completions.create(
+                        model=GROQ_MODEL,
+                        messages=mensajes_groq,
+                        temperature=0.7,  # Balance entre creatividad y precisión
+                        max_tokens=RESPUESTA_MAX_TOKENS   # Aumentado para respuestas más detalladas
+                    )
+        except Rechazado as r:
+            if r.motivo == "limite":
+                response.status_code = 429
+            if r.reintentar_en: response.headers["Retry-After"] = str(math.ceil(r.reintentar_en))
+            return {
+                "respuesta": MENSAJE_FALLBACK,
+                "mostrar_whatsapp": True,
+                "tasa": tasa
+            }
 
         resp = completion.choices[0].message.content
-        
-        # ===== DISPARADORES DE WHATSAPP MEJORADOS =====
-        disparadores = [
-            "comprar", "precio", "pago", "disponible", "cuanto", 
-            "ubicacion", "oferta", "interesado", "quiero", "deseo", 
-            "adquirir", "pedir", "ordenar", "cotizar", "presupuesto",
-            "llevar", "compro", "adquirir", "reservar", "apartar"
-        ]
-        texto_completo = (msg.mensaje + " " + resp).lower()
-        mostrar_ws = any(p in texto_completo for p in disparadores)
+        if resp and not bypass: await cache_respuestas.guardar(clave, resp)
 
         return {
             "respuesta": resp, 
-            "mostrar_whatsapp": mostrar_ws,
+            "mostrar_whatsapp": debe_mostrar_whatsapp(msg.mensaje, resp),
             "tasa": tasa
         }
         
@@ -468,15 +1683,132 @@ async def chat(store_id: str, msg: Message):
     except Exception as e:
         logger.error(f"Error en chat: {str(e)}")
         return {
-            "respuesta": "Disculpa, estoy recibiendo muchas consultas. ¿Podemos concretar por WhatsApp para darte una mejor atención? 🚀", 
+            "respuesta": MENSAJE_FALLBACK, 
             "mostrar_whatsapp": True,
-            "tasa": obtener_tasa_bcv()
+            "tasa": await obtener_tasa_bcv()
         }
 
+# ========== CHAT EN STREAMING (SSE) ==========
+def evento_sse(evento: str, datos: dict) -> str:
+    return f"event: {evento}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
+
+@app.post("/chat/{store_id}/stream")
+async def chat_stream(store_id: str, msg: Message, request: Request):
+    """Igual que /chat pero reenvía los tokens por Server-Sent Events a medida que llegan.
+    Eventos: `token` ({"t": texto}) repetido, luego `fin` con mostrar_whatsapp y tasa
+    (o `error` con la respuesta de respaldo antes de `fin`)."""
+    INFO = cargar_config_tienda(store_id)
+    if INFO is None:
+        raise HTTPException(status_code=404, detail="Tienda no encontrada")
+    bypass = omitir_cache(request)
+    ip = ip_cliente(request)
+
+    async def eventos():
+        yield ": conectado\n\n"  # comentario SSE: envía cabeceras y primer byte de inmediato
+        tasa = await obtener_tasa_bcv()
+        rapida = respuestas_rapidas.responder(store_id, INFO, tasa, msg.mensaje, msg.advisor)
+        if rapida is not None:
+            yield evento_sse("token", {"t": rapida})
+            yield evento_sse("fin", {"mostrar_whatsapp": debe_mostrar_whatsapp(msg.mensaje, rapida), "tasa": tasa})
+            return
+        clave = cache_respuestas.clave(store_id, msg.advisor, msg.mensaje, historial_valido(msg), tasa)
+        guardada = None if bypass else cache_respuestas.obtener(clave)
+        if guardada is not None:
+            yield evento_sse("token", {"t": guardada})
+            yield evento_sse("fin", {"mostrar_whatsapp": debe_mostrar_whatsapp(msg.mensaje, guardada), "tasa": tasa})
+            return
+        client = clientes.groq()
+        if client is None:
+            logger.error("GROQ_API_KEY no configurada")
+            yield evento_sse("error", {"respuesta": MENSAJE_SIN_IA})
+            yield evento_sse("fin", {"mostrar_whatsapp": True, "tasa": tasa})
+            return
+        partes = []
+        try:
+            admision.limitar(ip, store_id)
+            async with admision.admitir(store_id):
+                with LLM_DURACION.medir(store=store_id, modo="stream"):
+                    stream = await client.chat.completions.create(
+                        model=GROQ_MODEL,
+                        messages=construir_mensajes(store_id, INFO, tasa, msg),
+                        temperature=0.7,
+                        max_tokens=RESPUESTA_MAX_TOKENS,
+                        stream=True
+                    )
+                    async for chunk in stream:
+                        texto = chunk.choices[0].delta.content if chunk.choices else None
+                        if texto:
+                            partes.append(texto)
+                            yield evento_sse("token", {"t": texto})
+        except Rechazado as r:
+            yield evento_sse("error", {"respuesta": MENSAJE_FALLBACK, "motivo": r.motivo})
+            yield evento_sse("fin", {"mostrar_whatsapp": True, "tasa": tasa})
+            return
+        except Exception as e:
+            logger.error(f"Error en chat stream: {str(e)}")
+            yield evento_sse("error", {"respuesta": MENSAJE_FALLBACK})
+            yield evento_sse("fin", {"mostrar_whatsapp": True, "tasa": tasa})
+            return
+        resp = "".join(partes)
+        if resp and not bypass: await cache_respuestas.guardar(clave, resp)
+        yield evento_sse("fin", {"mostrar_whatsapp": debe_mostrar_whatsapp(msg.mensaje, resp), "tasa": tasa})
+
+    return StreamingResponse(eventos(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/respuestas-rapidas")
+async def get_respuestas_rapidas():
+    """Tasa de aciertos de las respuestas sin LLM (para ajustar las intenciones)"""
+    return respuestas_rapidas.estadisticas()
+
+@app.get("/cache-respuestas")
+async def get_cache_respuestas():
+    """Aciertos/fallos de la caché de respuestas del LLM"""
+    return cache_respuestas.estadisticas()
+
+@app.get("/admision")
+async def get_admision():
+    """Estado del control de admisión del LLM (concurrencia, cola, circuito y rechazos)"""
+    return admision.estadisticas()
+
+@app.get("/salud/vivo")
+async def salud_vivo():
+    """Liveness: el proceso responde (no revisa dependencias)"""
+    return {"status": "vivo", "pid": os.getpid()}
+
+@app.get("/salud/listo")
+def salud_listo():
+    """Readiness: 200 cuando todas las tiendas están cargadas y sus prompts calentados; 503 mientras no"""
+    tiendas = registro_tiendas.ids()
+    calentadas = cache_prompts.calentadas()
+    listo = bool(tiendas) and calentadas == len(tiendas)
+    return RespuestaJSON({
+        "status": "listo" if listo else "calentando",
+        "pid": os.getpid(),
+        "tiendas": len(tiendas),
+        "prompts_calentados": calentadas,
+        "prompts_en_cache": len(cache_prompts._prompts),
+        "catalogo_sqlite": registro_tiendas.catalogo is not None,
+        "tasa": servicio_tasa.valor,
+        "llm_configurado": bool(os.environ.get("GROQ_API_KEY")),
+    }, status_code=200 if listo else 503, headers={"Cache-Control": "no-store"})
+
+TASA_CACHE_CONTROL = f"public, max-age={int(os.environ.get('TASA_MAX_AGE_SEG', 60))}"
+
 @app.get("/tasa-bcv")
-async def get_tasa():
-    """Endpoint para obtener tasa BCV actualizada"""
-    return {"tasa": obtener_tasa_bcv()}
+async def get_tasa(request: Request, historial: int = Query(10, ge=0, le=TASA_HISTORIAL_MAX)):
+    """Endpoint para obtener tasa BCV actualizada (con fuente, fecha e historial reciente)"""
+    tasa = await obtener_tasa_bcv()
+    actualizada = servicio_tasa.fecha.isoformat() if servicio_tasa.fecha else None
+    vencida = servicio_tasa.vencida()
+    etag = etag_de("tasa", tasa, servicio_tasa.fuente, actualizada, vencida, historial)
+    return respuesta_condicional(request, etag, lambda: {
+        "tasa": tasa,
+        "fuente": servicio_tasa.fuente,
+        "actualizada": actualizada,
+        "vencida": vencida,
+        "historial": list(servicio_tasa.historial)[-historial:] if historial else []
+    }, TASA_CACHE_CONTROL)
 
 if __name__ == "__main__":
     import uvicorn
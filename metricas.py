@@ -0,0 +1,181 @@
+"""Métricas en formato de texto Prometheus, sin dependencias externas.
+
+Uso:
+    from metricas import registro, span, instrumentar
+    instrumentar(app, "chat")          # latencia por ruta + GET /metrics
+    with span("generar_prompt"): ...   # histograma span_duracion_segundos{span="generar_prompt"}
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Tuple
+
+from fastapi.responses import PlainTextResponse
+
+BUCKETS_POR_DEFECTO = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _escapar(valor) -> str:
+    return str(valor).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _etiquetas(nombres: Tuple[str, ...], valores: Tuple, extra: str = "") -> str:
+    partes = [f'{n}="{_escapar(v)}"' for n, v in zip(nombres, valores)]
+    if extra: partes.append(extra)
+    return "{" + ",".join(partes) + "}" if partes else ""
+
+class _Metrica:
+    tipo = "untyped"
+
+    def __init__(self, nombre: str, ayuda: str, etiquetas: Tuple[str, ...] = ()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._valores: Dict[Tuple, object] = {}
+        self._lock = threading.Lock()
+
+    def _clave(self, etiquetas: dict) -> Tuple:
+        return tuple(etiquetas.get(n, "") for n in self.etiquetas)
+
+    def exponer(self):
+        yield f"# HELP {self.nombre} {self.ayuda}"
+        yield f"# TYPE {self.nombre} {self.tipo}"
+        with self._lock:
+            valores = list(self._valores.items())
+        for clave, valor in valores:
+            yield from self._lineas(clave, valor)
+
+    def _lineas(self, clave, valor):
+        yield f"{self.nombre}{_etiquetas(self.etiquetas, clave)} {valor}"
+
+class Contador(_Metrica):
+    tipo = "counter"
+
+    def inc(self, valor: float = 1, **etiquetas):
+        clave = self._clave(etiquetas)
+        with self._lock:
+            self._valores[clave] = self._valores.get(clave, 0) + valor
+
+class Medidor(_Metrica):
+    tipo = "gauge"
+
+    def set(self, valor: float, **etiquetas):
+        with self._lock:
+            self._valores[self._clave(etiquetas)] = valor
+
+    def inc(self, valor: float = 1, **etiquetas):
+        clave = self._clave(etiquetas)
+        with self._lock:
+            self._valores[clave] = self._valores.get(clave, 0) + valor
+
+class Histograma(_Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nombre: str, ayuda: str, etiquetas: Tuple[str, ...] = (), buckets=BUCKETS_POR_DEFECTO):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.buckets = tuple(sorted(buckets))
+
+    def observar(self, valor: float, **etiquetas):
+        clave = self._clave(etiquetas)
+        i = bisect_left(self.buckets, valor)
+        with self._lock:
+            estado = self._valores.get(clave)
+            if estado is None:
+                estado = self._valores[clave] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            estado[0][i] += 1
+            estado[1] += valor
+            estado[2] += 1
+
+    @contextmanager
+    def medir(self, **etiquetas):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(time.perf_counter() - inicio, **etiquetas)
+
+    def _lineas(self, clave, valor):
+        conteos, suma, total = valor[0][:], valor[1], valor[2]
+        acumulado = 0
+        for limite, n in zip(self.buckets + (float("inf"),), conteos):
+            acumulado += n
+            le = "+Inf" if limite == float("inf") else repr(float(limite))
+            etiquetas = _etiquetas(self.etiquetas, clave, 'le="' + le + '"')
+            yield f"{self.nombre}_bucket{etiquetas} {acumulado}"
+        yield f"{self.nombre}_sum{_etiquetas(self.etiquetas, clave)} {suma}"
+        yield f"{self.nombre}_count{_etiquetas(self.etiquetas, clave)} {total}"
+
+class Registro:
+    """Colección de métricas del proceso; registrar dos veces el mismo nombre devuelve la misma métrica"""
+
+    def __init__(self):
+        self._metricas: Dict[str, _Metrica] = {}
+        self._lock = threading.Lock()
+
+    def _registrar(self, clase, nombre, *args, **kwargs):
+        with self._lock:
+            if nombre not in self._metricas:
+                self._metricas[nombre] = clase(nombre, *args, **kwargs)
+            return self._metricas[nombre]
+
+    def contador(self, nombre: str, ayuda: str, etiquetas=()) -> Contador:
+        return self._registrar(Contador, nombre, ayuda, etiquetas)
+
+    def medidor(self, nombre: str, ayuda: str, etiquetas=()) -> Medidor:
+        return self._registrar(Medidor, nombre, ayuda, etiquetas)
+
+    def histograma(self, nombre: str, ayuda: str, etiquetas=(), buckets=BUCKETS_POR_DEFECTO) -> Histograma:
+        return self._registrar(Histograma, nombre, ayuda, etiquetas, buckets=buckets)
+
+    def exponer(self) -> str:
+        with self._lock:
+            metricas = list(self._metricas.values())
+        return "\n".join(linea for m in metricas for linea in m.exponer()) + "\n"
+
+registro = Registro()
+
+LATENCIA_HTTP = registro.histograma("http_request_duration_seconds", "Latencia de las peticiones HTTP por ruta",
+                                    ("app", "method", "route", "status"))
+SPANS = registro.histograma("span_duracion_segundos", "Duración de tramos internos del camino caliente", ("span",))
+CACHE = registro.contador("cache_eventos_total", "Aciertos y fallos de las cachés internas", ("cache", "resultado"))
+
+def span(nombre: str):
+    """Mide un tramo de código: `with span("obtener_tasa_bcv"): ...`"""
+    return SPANS.medir(span=nombre)
+
+def cache(nombre: str, acierto: bool):
+    CACHE.inc(cache=nombre, resultado="hit" if acierto else "miss")
+
+class MiddlewareLatencia:
+    """Middleware ASGI (sin BaseHTTPMiddleware) que mide cada petición hasta el último byte enviado"""
+
+    def __init__(self, app, nombre_app: str):
+        self.app = app
+        self.nombre_app = nombre_app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        inicio = time.perf_counter()
+        estado = {"status": 500}
+
+        async def enviar(mensaje):
+            if mensaje["type"] == "http.response.start":
+                estado["status"] = mensaje["status"]
+            await send(mensaje)
+
+        try:
+            await self.app(scope, receive, enviar)
+        finally:
+            ruta = scope.get("route")
+            endpoint = scope.get("endpoint")
+            nombre_ruta = getattr(ruta, "path", None) or getattr(endpoint, "__name__", None) or "sin_ruta"
+            LATENCIA_HTTP.observar(time.perf_counter() - inicio, app=self.nombre_app, method=scope["method"],
+                                   route=nombre_ruta, status=estado["status"])
+
+def instrumentar(app, nombre_app: str):
+    """Agrega el middleware de latencia y el endpoint GET /metrics a una app FastAPI"""
+    app.add_middleware(MiddlewareLatencia, nombre_app=nombre_app)
+
+    @app.get("/metrics", include_in_schema=False)
+    def metrics():
+        return PlainTextResponse(registro.exponer(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,55 @@
+"""Entorno aislado para las pruebas: bases SQLite, catálogo y tiendas en un directorio temporal y fuentes de tasas
+apuntando a un puerto cerrado (sin red). Los módulos leen el entorno al importarse, así que se fija aquí antes.
+
+    python -m pytest -q"""
+import glob
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIRECTORIO = tempfile.mkdtemp(prefix="pruebas_")
+SIN_RED = "http://127.0.0.1:9/"
+CLAVE_ADMIN = "clave-pruebas"
+
+for archivo in glob.glob(os.path.join(RAIZ, "*.json")):
+    shutil.copy(archivo, DIRECTORIO)
+os.environ.update({
+    "DB_PATH": os.path.join(DIRECTORIO, "arbitraje.db"),
+    "CATALOGO_DB": os.path.join(DIRECTORIO, "catalogo.db"),
+    "RESP_CACHE_DB": os.path.join(DIRECTORIO, "respuestas.db"),
+    "TIENDAS_DIR": DIRECTORIO,
+    "ADMIN_PASSWORD": CLAVE_ADMIN,
+    "BCV_URL": SIN_RED, "BINANCE_P2P_URL": SIN_RED,
+    "TASA_FUENTES_URLS": f"local={SIN_RED}", "BCV_REINTENTOS": "0",
+})
+os.environ.pop("GROQ_API_KEY", None)
+sys.path.insert(0, RAIZ)
+
+from fastapi.testclient import TestClient   # noqa: E402
+
+@pytest.fixture(scope="session")
+def api():
+    import arbitraje_api
+    return arbitraje_api
+
+@pytest.fixture(scope="session")
+def cliente_api(api):
+    with TestClient(api.app) as cliente:
+        yield cliente
+
+@pytest.fixture(scope="session")
+def chat():
+    import main
+    return main
+
+@pytest.fixture(scope="session")
+def cliente_chat(chat):
+    with TestClient(chat.app) as cliente:
+        yield cliente
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(DIRECTORIO, ignore_errors=True)
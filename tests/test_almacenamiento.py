@@ -0,0 +1,78 @@
+"""Esquema de arbitraje_api: migraciones versionadas y resumen mantenido por triggers"""
+import os
+import sqlite3
+
+import pytest
+
+COLUMNAS_RESUMEN = "inv, etapa, tipo, dia, n, round(miBs, 6), round(miUsd, 6), round(resultBs, 6), round(resultUsd, 6)"
+AGRUPADO = """SELECT COALESCE(inv, ''), COALESCE(etapa, 0), COALESCE(tipo, ''), substr(COALESCE(fecha, ''), 1, 10), COUNT(*),
+                     round(TOTAL(miBs), 6), round(TOTAL(miUsd), 6), round(TOTAL(resultBs), 6), round(TOTAL(resultUsd), 6)
+              FROM operaciones GROUP BY 1, 2, 3, 4 ORDER BY 1, 2, 3, 4"""
+
+def resumen_y_agrupado(conn):
+    resumen = [tuple(f) for f in conn.execute(f"SELECT {COLUMNAS_RESUMEN} FROM operaciones_resumen ORDER BY 1, 2, 3, 4")]
+    return resumen, [tuple(f) for f in conn.execute(AGRUPADO)]
+
+@pytest.fixture
+def base_nueva(api, tmp_path, monkeypatch):
+    """Pool sobre un archivo vacío, para migrar desde cero o desde una versión anterior"""
+    pool = api.PoolSQLite(str(tmp_path / "esquema.db"))
+    monkeypatch.setattr(api, "pool", pool)
+    yield pool
+    pool.cerrar()
+
+def test_migracion_desde_cero_llega_a_la_ultima_version(api, base_nueva):
+    api.init_db()
+    api.init_db()   # idempotente
+    with api.get_db() as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == api.MIGRACIONES[-1][0]
+        tablas = {f[0] for f in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert {"operaciones", "sesiones", "operaciones_resumen", "contadores"} <= tablas
+
+def test_resumen_coincide_con_group_by_tras_insertar_actualizar_y_borrar(api, base_nueva):
+    api.init_db()
+    filas = [(None, f"2025-03-0{1 + i % 3}", 1 + i % 3, ("MAU", "MD")[i % 2], 100.0 + i, 2.0 + i, 100.0 + i, 2.0 + i, f"tipo{i % 3}")
+             for i in range(30)]
+    with api.get_db() as conn:
+        conn.executemany(api.SQL_INSERT_OPERACION, filas)
+        conn.execute("UPDATE operaciones SET miBs = miBs * 2, fecha = '2025-04-01' WHERE id % 4 = 0")
+        conn.execute("UPDATE operaciones SET inv = 'CP' WHERE id % 5 = 0")
+        conn.execute("DELETE FROM operaciones WHERE id % 3 = 0")
+        conn.execute("INSERT INTO operaciones (fecha, etapa, inv) VALUES (NULL, NULL, NULL)")
+        resumen, agrupado = resumen_y_agrupado(conn)
+        version = api.version_tabla(conn, "operaciones")
+    assert resumen == agrupado
+    assert version > 0
+
+def test_borrar_un_grupo_completo_lo_quita_del_resumen(api, base_nueva):
+    api.init_db()
+    with api.get_db() as conn:
+        conn.executemany(api.SQL_INSERT_OPERACION, [(None, "2025-05-05", 1, "JB", 10, 1, 10, 1, "Compra BDV")] * 3)
+        conn.execute("DELETE FROM operaciones WHERE inv = 'JB'")
+        assert conn.execute("SELECT COUNT(*) FROM operaciones_resumen WHERE inv = 'JB'").fetchone()[0] == 0
+
+def test_migracion_5_desde_una_base_en_version_4(api, base_nueva):
+    conn = sqlite3.connect(base_nueva.path)
+    for version, sentencias in api.MIGRACIONES:
+        if version > 4: break
+        for sql in sentencias: conn.execute(sql)
+        conn.execute(f"PRAGMA user_version = {version}")
+    conn.executemany(api.SQL_INSERT_OPERACION, [(None, "2025-06-01", 3, "MD", 50, 1, 50, 1, "Venta P2P")] * 4)
+    conn.commit()
+    conn.close()
+    api.init_db()
+    with api.get_db() as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == 5
+        disparador = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'trg_operaciones_resumen_del'").fetchone()[0]
+        conn.execute("DELETE FROM operaciones WHERE id <= 2")
+        resumen, agrupado = resumen_y_agrupado(conn)
+    assert "OLD.inv" in disparador.split("DELETE FROM operaciones_resumen")[1]   # borra solo el grupo de OLD
+    assert resumen == agrupado
+
+def test_pool_reutiliza_conexiones(api, base_nueva):
+    api.init_db()
+    with api.get_db() as primera: pass
+    with api.get_db() as segunda: pass
+    assert primera is segunda
+    assert segunda.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert os.path.exists(base_nueva.path)
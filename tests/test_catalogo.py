@@ -0,0 +1,45 @@
+"""App de chat: parches de catálogo por SKU, invalidación selectiva de prompts y GET condicionales"""
+from conftest import CLAVE_ADMIN
+
+def test_config_y_tasa_responden_304_con_el_mismo_etag(cliente_chat):
+    for ruta in ("/config/panaderia", "/tasa-bcv"):
+        primera = cliente_chat.get(ruta)
+        assert primera.status_code == 200, ruta
+        repetida = cliente_chat.get(ruta, headers={"If-None-Match": primera.headers["ETag"]})
+        assert repetida.status_code == 304, ruta
+        assert repetida.content == b""
+
+def test_parche_invalida_solo_los_prompts_que_usan_el_item(cliente_chat, chat):
+    tienda = chat.registro_tiendas.obtener("multikap")
+    for asesor in ("motos", "papeleria", "hogar"):
+        chat.cache_prompts.obtener("multikap", tienda["datos"], 45.0, asesor)
+    etag = cliente_chat.get("/config/multikap").headers["ETag"]
+
+    respuesta = cliente_chat.patch(f"/admin/catalogo/multikap/items/hogar-escoba?password={CLAVE_ADMIN}",
+                                   json={"precio": 11.5, "stock": 7})
+    assert respuesta.status_code == 200
+    version = respuesta.json()["version"]
+    prompts = chat.cache_prompts._prompts
+    assert ("multikap", "hogar") not in prompts
+    assert prompts[("multikap", "motos")][0] == version and prompts[("multikap", "papeleria")][0] == version
+
+    nueva = cliente_chat.get("/config/multikap", headers={"If-None-Match": etag})
+    assert nueva.status_code == 200 and nueva.headers["ETag"] != etag
+    escoba = next(i for i in nueva.json()["catalogo_hogar"] if i["nombre"] == "Escoba")
+    assert (escoba["precio"], escoba["stock"]) == (11.5, 7)
+    prompt = chat.cache_prompts.obtener("multikap", chat.registro_tiendas.obtener("multikap")["datos"], 45.0, "hogar")
+    assert "11.5" in prompt
+
+def test_parches_invalidos_se_rechazan_sin_cambiar_la_version(cliente_chat, chat):
+    version = chat.registro_tiendas.version("multikap")
+    ruta = f"/admin/catalogo/multikap/items/hogar-escoba?password={CLAVE_ADMIN}"
+    assert cliente_chat.patch(ruta, json={"stock": -1}).status_code == 422
+    assert cliente_chat.patch(ruta, json={"precio": 0}).status_code == 422
+    assert cliente_chat.patch(ruta, json={}).status_code == 400
+    assert cliente_chat.patch(f"/admin/catalogo/multikap/items/no-existe?password={CLAVE_ADMIN}",
+                              json={"precio": 1}).status_code == 404
+    assert cliente_chat.patch(ruta.replace(CLAVE_ADMIN, "otra"), json={"precio": 1}).status_code == 401
+    assert chat.registro_tiendas.version("multikap") == version
+
+def test_listo_tras_parchear(cliente_chat):
+    assert cliente_chat.get("/salud/listo").status_code == 200
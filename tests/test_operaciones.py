@@ -0,0 +1,78 @@
+"""API de operaciones: carga masiva idempotente, paginación por cursor, GET condicionales y validación"""
+import threading
+from datetime import datetime, timezone
+
+from conftest import CLAVE_ADMIN
+
+def operacion(id_, inv, fecha="2025-02-10", bs=4000.0, usd=100.0):
+    """Etapa 1 consistente (resultados = montos); fechada en el pasado para no compararla con el mercado"""
+    return {"id": id_, "fecha": fecha, "etapa": 1, "inv": inv, "miBs": bs, "miUsd": usd,
+            "resultBs": bs, "resultUsd": usd, "tipo": "Compra BDV"}
+
+def test_reenviar_el_mismo_lote_no_duplica(cliente_api):
+    lote = [operacion(10_000 + i, "lote") for i in range(50)]
+    primera = cliente_api.post("/api/operaciones/bulk", json=lote).json()
+    segunda = cliente_api.post("/api/operaciones/bulk", json=lote).json()
+    assert (primera["insertadas"], primera["duplicadas"]) == (50, 0)
+    assert (segunda["insertadas"], segunda["duplicadas"]) == (0, 50)
+    assert len(cliente_api.get("/api/operaciones?user=lote").json()) == 50
+
+def test_lotes_concurrentes_insertan_cada_id_una_vez(cliente_api, api):
+    lote = [operacion(20_000 + i, "concurrente") for i in range(300)]
+    respuestas = []
+    def enviar(): respuestas.append(cliente_api.post("/api/operaciones/bulk", json=lote))
+    hilos = [threading.Thread(target=enviar) for _ in range(4)]
+    for h in hilos: h.start()
+    for h in hilos: h.join()
+    assert all(r.status_code == 200 for r in respuestas)
+    assert sum(r.json()["insertadas"] for r in respuestas) == 300
+    with api.get_db() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM operaciones WHERE inv = 'concurrente'").fetchone()[0] == 300
+
+def test_lote_rechaza_filas_sin_id(cliente_api):
+    fila = operacion(None, "sin_id")
+    resultado = cliente_api.post("/api/operaciones/bulk", json=[fila]).json()
+    assert resultado["errores"] == 1 and resultado["resultados"][0]["status"] == "error"
+
+def test_paginacion_por_cursor_recorre_todo_sin_repetir(cliente_api):
+    cliente_api.post("/api/operaciones/bulk", json=[operacion(30_000 + i, "paginador") for i in range(25)])
+    ids, paginas, url = [], 0, "/api/operaciones?user=paginador&limit=10&campos=fecha,inv"
+    while url:
+        respuesta = cliente_api.get(url)
+        paginas += 1
+        ids += [op["id"] for op in respuesta.json()]
+        siguiente = respuesta.headers.get("X-Next-Cursor")
+        url = f"/api/operaciones?user=paginador&limit=10&cursor={siguiente}" if siguiente else None
+    assert paginas == 3
+    assert ids == sorted(range(30_000, 30_025), reverse=True)
+
+def test_get_condicional_de_operaciones_y_estadisticas(cliente_api):
+    cliente_api.post("/api/operaciones/bulk", json=[operacion(40_000, "condicional")])
+    for ruta in ("/api/operaciones?user=condicional", "/api/operaciones/stats?agrupar=inv,mes", "/api/sesiones"):
+        primera = cliente_api.get(ruta)
+        etag = primera.headers["ETag"]
+        repetida = cliente_api.get(ruta, headers={"If-None-Match": etag})
+        assert repetida.status_code == 304, ruta
+        assert repetida.content == b"" and repetida.headers["ETag"] == etag
+    etag = cliente_api.get("/api/operaciones?user=condicional").headers["ETag"]
+    cliente_api.post("/api/operaciones", json=operacion(40_001, "condicional"))
+    cambiada = cliente_api.get("/api/operaciones?user=condicional", headers={"If-None-Match": etag})
+    assert cambiada.status_code == 200 and len(cambiada.json()) == 2
+
+def test_validacion_contra_la_tasa_de_mercado(cliente_api, api, monkeypatch):
+    monkeypatch.setitem(api.servicio_tasas.valores, "bcv", {"datos": {"precio": 40.0}})
+    hoy = datetime.now(timezone.utc).date().isoformat()
+    assert cliente_api.post("/api/operaciones", json=operacion(50_000, "mercado", hoy, 4000, 100)).status_code == 200
+    fuera = cliente_api.post("/api/operaciones", json=operacion(50_001, "mercado", hoy, 5000, 100))
+    assert fuera.status_code == 422
+    assert fuera.json()["detail"]["errores"][0]["campo"] == "tasa_bcv"
+    assert cliente_api.post("/api/operaciones?validar=false", json=operacion(50_002, "mercado", hoy, 5000, 100)).status_code == 200
+    descuadrada = dict(operacion(50_003, "mercado"), resultUsd=1)
+    assert cliente_api.post("/api/operaciones", json=descuadrada).status_code == 422
+
+def test_feed_de_cambios_de_admin_exige_clave(cliente_api, api):
+    assert cliente_api.get("/api/cambios?admin=true").status_code == 401
+    assert cliente_api.get("/api/cambios?admin=true&password=otra").status_code == 401
+    with cliente_api.websocket_connect(f"/api/cambios/ws?admin=true&password={CLAVE_ADMIN}") as ws:
+        api.cambios.publicar("sesion.activa", "MD", {"usuario": "MD"})
+        assert ws.receive_json()["tipo"] == "sesion.activa"